@@ -0,0 +1,116 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Latency of OpenAIHTTPLLM against the stub server in llm_stub_server.py.
+
+    python benchmark/llm_client_bench.py --calls=400 --concurrency=8 --slow_rate=0.03 --error_rate=0.05
+
+Runs the same workload (calls spread over concurrency agents sharing one
+client) without and with hedging and reports p50/p95/p99/max call latency,
+retries, hedges and the connections the pool opened. Exits with status 1 if
+a call fails.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from loguru import logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from cmd_gpt.llm.http import ClientPool, OpenAIHTTPLLM, RateLimiter
+from llm_stub_server import RESPONSE, StubLLMServer
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+async def run_calls(llm, calls, concurrency):
+    latencies, failures = [], 0
+    queue = list(range(calls))
+
+    async def agent():
+        nonlocal failures
+        while len(queue) > 0:
+            queue.pop()
+            start = time.monotonic()
+            try:
+                output = await llm.apredict("T: benchmark\n")
+                assert output == RESPONSE, output
+                latencies.append(time.monotonic() - start)
+            except Exception as e:
+                logger.error("Call failed: {}".format(e))
+                failures += 1
+    await asyncio.gather(*[agent() for _ in range(concurrency)])
+    return latencies, failures
+
+
+def run_case(name, calls, concurrency, server_kwargs, llm_kwargs):
+    server = StubLLMServer(**server_kwargs).start()
+    try:
+        llm = OpenAIHTTPLLM("stub", base_url=server.base_url, pool=ClientPool(server.base_url, max_connections=concurrency * 2), **llm_kwargs)
+        start = time.monotonic()
+        latencies, failures = asyncio.run(run_calls(llm, calls, concurrency))
+        elapsed = time.monotonic() - start
+    finally:
+        server.stop()
+    return {
+        "case": name,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies),
+        "elapsed": elapsed,
+        "failures": failures,
+        "retries": llm.retries,
+        "hedges": llm.hedges,
+        "hedge_wins": llm.hedge_wins,
+        "connections": llm.pool.opened,
+        "server_requests": server.stats["requests"],
+    }
+
+
+def format_table(records):
+    columns = ["case", "p50", "p95", "p99", "max", "elapsed", "failures", "retries", "hedges", "hedge_wins", "connections", "server_requests"]
+    rows = [columns] + [[("{:.3f}".format(r[c]) if isinstance(r[c], float) else str(r[c])) for c in columns] for r in records]
+    widths = [max(len(row[k]) for row in rows) for k in range(len(columns))]
+    return "\n".join("  ".join(cell.ljust(widths[k]) for k, cell in enumerate(row)).rstrip() for row in rows)
+
+
+def main(calls=400, concurrency=8, latency=0.05, slow_rate=0.03, slow_latency=2.0, error_rate=0.05, timeout=10,
+         hedge_percentile=95, rate_limit_rpm=0, seed=1, logger_level="ERROR"):
+    logger.remove()
+    logger.add(sys.stderr, level=logger_level)
+    server_kwargs = {"latency": latency, "slow_rate": slow_rate, "slow_latency": slow_latency, "error_rate": error_rate, "seed": seed}
+    llm_kwargs = {"timeout": timeout, "backoff": 0.05}
+    records = []
+    for name, kwargs in [("plain", {}), ("hedged", {"hedge_percentile": hedge_percentile})]:
+        if rate_limit_rpm > 0:
+            kwargs["rate_limiter"] = RateLimiter(rate_limit_rpm)
+        records.append(run_case(name, calls, concurrency, server_kwargs, dict(llm_kwargs, **kwargs)))
+    print(format_table(records))
+    if any(r["failures"] > 0 for r in records):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,163 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+OpenAI-compatible stub LLM server with injected delays and errors.
+
+    python benchmark/llm_stub_server.py --port=8089 --slow_rate=0.05 --slow_latency=5 --error_rate=0.1
+
+Serves /v1/chat/completions and /v1/completions (streamed when asked) on
+127.0.0.1 with keep-alive. Each request waits latency seconds, or
+slow_latency for a slow_rate share of them, and an error_rate share fails
+with one of error_statuses (a 429 comes with Retry-After). Point the agent
+at it with LLM_BACKEND: "http" and LLM_API_BASE: "http://127.0.0.1:8089/v1".
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPONSE = "A: The stub server answered.\nP: end\nE: end\n"
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # hedges open connections in bursts
+
+
+class StubLLMServer:
+    def __init__(self, port=0, response=RESPONSE, latency=0.05, slow_rate=0.0, slow_latency=2.0, error_rate=0.0,
+                 error_statuses=(429, 500, 503), retry_after=0, chunk_delay=0.01, seed=None):
+        self.response = response
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.error_statuses = list(error_statuses)
+        self.retry_after = retry_after
+        self.chunk_delay = chunk_delay
+        self.rng = random.Random(seed)
+        self.stats = {"connections": 0, "requests": 0, "slow": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self.server = _Server(("127.0.0.1", port), self._handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}/v1".format(self.server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def draw(self):
+        """(seconds to wait, error status or None) for the next request."""
+        with self._lock:
+            slow = self.rng.random() < self.slow_rate
+            error = self.rng.choice(self.error_statuses) if self.rng.random() < self.error_rate else None
+        if slow:
+            self._count("slow")
+        if error is not None:
+            self._count("errors")
+        return (self.slow_latency if slow else self.latency), error
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                stub._count("connections")
+
+            def send_json(self, status, data, headers=()):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_stream(self, request):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for k, piece in enumerate(stub.response.split(" ")):
+                    text = piece if k == 0 else " " + piece
+                    choice = {"delta": {"content": text}} if "messages" in request else {"text": text}
+                    self.write_chunk("data: {}\n\n".format(json.dumps({"choices": [choice]})).encode("utf-8"))
+                    time.sleep(stub.chunk_delay)
+                self.write_chunk(b"data: [DONE]\n\n")
+                self.write_chunk(b"")
+
+            def write_chunk(self, data):
+                self.wfile.write("{:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stub._count("requests")
+                if not self.path.endswith(("/chat/completions", "/completions")):
+                    self.send_json(404, {"error": {"message": "Unknown path " + self.path}})
+                    return
+                delay, error = stub.draw()
+                time.sleep(delay)
+                try:
+                    if error is not None:
+                        headers = [("Retry-After", str(stub.retry_after))] if error == 429 else []
+                        self.send_json(error, {"error": {"message": "injected {}".format(error)}}, headers)
+                    elif request.get("stream"):
+                        self.send_stream(request)
+                    elif "messages" in request:
+                        self.send_json(200, {"choices": [{"message": {"role": "assistant", "content": stub.response}}]})
+                    else:
+                        self.send_json(200, {"choices": [{"text": stub.response}]})
+                except (BrokenPipeError, ConnectionResetError): # the client gave up, e.g. a hedge that lost
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main(port=8089, latency=0.05, slow_rate=0.0, slow_latency=2.0, error_rate=0.0, retry_after=0):
+    server = StubLLMServer(port, latency=latency, slow_rate=slow_rate, slow_latency=slow_latency, error_rate=error_rate, retry_after=retry_after)
+    print("Serving {}".format(server.base_url))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(server.stats)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
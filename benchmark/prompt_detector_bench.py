@@ -0,0 +1,130 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Microbenchmark and accuracy check for PromptDetector.
+
+    python benchmark/prompt_detector_bench.py --lines=200000
+
+Builds a labelled corpus of prompt, question and ordinary output lines and
+reports accuracy and ns/line for PromptDetector.is_prompt_or_question against
+the regexes it replaced.
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cmd_gpt.tool.terminal.prompt_detector import PromptDetector
+
+
+PROMPTS = [
+    "ubuntu@ip-10-0-0-12:~$ ",
+    "root@vm:/etc/nginx# ",
+    "eric@macbook ~ % ",
+    "[ec2-user@ip-172-31-5-9 ~]$ ",
+    "eric@macbook ~/src> ",
+    "sh-4.2$ ",
+    ">>> ",
+    "In [12]: ",
+    "postgres=# ",
+    "mysql> ",
+    "PS C:\\Users\\eric> ",
+]
+
+QUESTIONS = [
+    "Do you want to continue? [Y/n] ",
+    "Proceed ([y]/n)? [y/N] ",
+    "Are you sure you want to continue connecting (yes/no/[fingerprint])? ",
+    "[sudo] password for ubuntu: ",
+    "Password:",
+    "ubuntu@10.23.12.34's password: ",
+    "Enter passphrase for key '/home/eric/.ssh/id_rsa': ",
+    ":",
+    "(END)",
+    "--More--(42%)",
+]
+
+OUTPUT = [
+    "Reading package lists... Done",
+    "Get:1 http://archive.ubuntu.com/ubuntu focal InRelease [265 kB]",
+    "  Downloading numpy-1.26.4-cp311-cp311-manylinux_2_17_x86_64.whl (18.3 MB)",
+    "drwxr-xr-x  5 eric staff  160 Oct  1 12:00 src",
+    "ubuntu@ip-10-0-0-12:~$ sudo apt-get install -y nginx",
+    "WARNING: Running pip as the 'root' user can result in broken permissions",
+    "echo $HOME # print the home directory",
+    "Selecting previously unselected package nginx-common.",
+    "x" * 5000,
+]
+
+
+def legacy_is_prompt_or_question(line):
+    if re.match(r"^[^@]*@[^$@]*\$$", line.strip()):
+        return True
+    elif re.match(r"^[^@]*@[^$@]*\%$", line.strip()):
+        return True
+    elif re.match(r"^[^?]*? [Y/n]$", line.strip()):
+        return True
+    elif re.match(r"^Password:", line.strip()):
+        return True
+    elif re.match(r"[sudo] password for .*:", line.strip()):
+        return True
+    elif re.match(r".* password:", line.strip()):
+        return True
+    else:
+        return False
+
+
+def build_corpus(n, seed=0):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(n):
+        kind = rng.random()
+        if kind < 0.1:
+            corpus.append((rng.choice(PROMPTS), True))
+        elif kind < 0.2:
+            corpus.append((rng.choice(QUESTIONS), True))
+        else:
+            corpus.append((rng.choice(OUTPUT), False))
+    return corpus
+
+
+def measure(name, fn, corpus):
+    start = time.perf_counter()
+    results = [fn(line) for line, _ in corpus]
+    elapsed = time.perf_counter() - start
+    correct = sum(1 for r, (_, label) in zip(results, corpus) if r == label)
+    missed = sorted(set(line for r, (line, label) in zip(results, corpus) if label and not r))
+    false_positive = sorted(set(line[:60] for r, (line, label) in zip(results, corpus) if r and not label))
+    print("{:<10} {:>10.0f} ns/line  accuracy {:.3f}".format(name, elapsed / len(corpus) * 1e9, correct / len(corpus)))
+    for line in missed:
+        print("    missed:         {!r}".format(line))
+    for line in false_positive:
+        print("    false positive: {!r}".format(line))
+
+
+def main(lines=200000):
+    corpus = build_corpus(int(lines))
+    measure("legacy", legacy_is_prompt_or_question, corpus)
+    measure("detector", PromptDetector().is_prompt_or_question, corpus)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,253 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+End-to-end agent benchmark against a scripted LLM and a simulated terminal.
+
+    python benchmark/run_benchmark.py --repeat=3 --output=bench.jsonl
+
+Every scenario in benchmark/scenarios (or the given file or directory) is run
+through DeploymentCmdAgent.run. Wall-clock time per task is split into LLM
+calls, tool calls (terminal waits and answers) and confirmation waits. One JSON
+line per run is appended to --output so results can be compared across
+revisions, and --metrics_path writes the aggregated OpenMetrics histograms.
+
+--route runs with ModelRouter over a fast and a strong replay of the same
+script (--fast_latency, default a third of the LLM latency) and counts the
+steps sent to the strong tier.
+
+Exits with status 1 if a scenario does not reach its expected outcome.
+"""
+
+import asyncio
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import yaml
+from loguru import logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent
+from cmd_gpt.agent.planner import arun_plan
+from cmd_gpt.llm.router import FAST, STRONG, ModelRouter
+from cmd_gpt.llm.scripted import ScriptedLLM
+from cmd_gpt.metrics import REGISTRY
+from cmd_gpt.tool.basic.probe import ProbeTool
+from cmd_gpt.tool.terminal.simulated import SimulatedTerminal
+from cmd_gpt.tool.terminal.spool import SpoolTools
+
+DEFAULT_SCENARIOS = os.path.join(os.path.dirname(__file__), "scenarios")
+
+
+def load_scenarios(path):
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, "*.yaml")))
+    else:
+        paths = [path]
+    scenarios = []
+    for p in paths:
+        with open(p, "r") as f:
+            scenario = yaml.safe_load(f)
+        scenario.setdefault("name", os.path.splitext(os.path.basename(p))[0])
+        scenarios.append(scenario)
+    return scenarios
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def scripted_ask(answers, latency=0.0):
+    # latency stands in for the time a human takes to reply
+    answers = list(answers)
+
+    async def ask(question):
+        ask.questions.append(question)
+        answer = answers.pop(0) if len(answers) > 0 else "I don't know."
+        await asyncio.sleep(latency)
+        return answer
+    ask.questions = []
+    return ask
+
+
+def scenario_agent(scenario, terminal, llm, ask, **kwargs):
+    spool_tools = SpoolTools(terminal)
+    return DeploymentCmdAgent(
+        dict({"EXAMPLE_DB": ":memory:", "TRACE_DB": "off"}, **scenario.get("config", {})), # built-in examples only, runs do not learn from each other
+        llm=llm,
+        cmd=terminal,
+        max_steps=scenario.get("max_steps", 20),
+        max_actions_per_step=scenario.get("max_actions_per_step", 1),
+        action_mapping={
+            "terminal_run": terminal.async_run_command_and_get_reply,
+            "terminal_read": spool_tools.read,
+            "terminal_search": spool_tools.search,
+            "ask": ask,
+            "probe": ProbeTool(runner=terminal.async_probe).arun,
+        },
+        **kwargs,
+    )
+
+
+def commands_ran(scenario, terminal):
+    for pattern in scenario.get("expect_commands", []):
+        if not any(re.search(pattern, command) for command in terminal.history):
+            return False
+    return True
+
+
+def run_scenario(scenario, action_delay=None, llm_latency=None, route=False, fast_latency=None):
+    if "subtasks" in scenario:
+        return run_plan_scenario(scenario, action_delay=action_delay, llm_latency=llm_latency)
+    terminal = SimulatedTerminal(**scenario.get("terminal", {}))
+    llm = ScriptedLLM(scenario["responses"], latency=scenario.get("llm_latency", 0.0) if llm_latency is None else llm_latency)
+    ask = scripted_ask(scenario.get("answers", []), scenario.get("answer_latency", 0.0))
+    kwargs = {} if action_delay is None else {"action_delay": action_delay}
+    if route: # both tiers replay the same script, only their latency differs
+        fast = llm.fork("scripted-fast", scenario.get("fast_latency", llm.latency / 3) if fast_latency is None else fast_latency)
+        kwargs["router"] = ModelRouter({FAST: fast, STRONG: llm})
+    agent = scenario_agent(scenario, terminal, llm, ask, **kwargs)
+    try:
+        result = agent.run(scenario["task"])
+    finally:
+        agent.close()
+
+    success = result.status == scenario.get("expect_status", "done") and commands_ran(scenario, terminal)
+    for pattern in scenario.get("expect_probes", []):
+        if not any(re.search(pattern, command) for command in terminal.probe_history):
+            success = False
+    if len(terminal.interrupts) != scenario.get("expect_interrupts", 0):
+        success = False
+    if "expect_questions" in scenario and len(ask.questions) != scenario["expect_questions"]:
+        success = False
+    timings = result.timings
+    return {
+        "scenario": scenario["name"],
+        "status": result.status,
+        "success": success,
+        "steps": result.steps,
+        "elapsed": round(result.elapsed, 4),
+        "llm_time": round(timings["llm"], 4),
+        "tool_time": round(timings["tool"], 4),
+        "sleep_time": round(timings["sleep"], 4),
+        "terminal_wait_time": round(sum(step.terminal_wait_seconds for step in result.step_metrics), 4),
+        "terminal_quiet_time": round(sum(step.terminal_quiet_seconds for step in result.step_metrics), 4),
+        "other_time": round(result.elapsed - sum(timings.values()), 4),
+        "llm_calls": result.llm_calls,
+        "prompt_tokens": result.prompt_tokens,
+        "completion_tokens": result.completion_tokens,
+        "commands": len(terminal.history),
+        "probes": len(terminal.probe_history),
+        "interrupts": len(terminal.interrupts),
+        "questions": len(ask.questions),
+        "strong_steps": sum(1 for d in result.routing if d.tier == STRONG) if route else result.steps,
+    }
+
+
+def run_plan_scenario(scenario, action_delay=None, llm_latency=None):
+    """
+    A planned task: the scripted plan, then every subtask with its own script
+    and simulated terminal. Times are summed over the subtasks, other_time is
+    the part of the wall-clock time not on the critical path or planning.
+    """
+    latency = scenario.get("llm_latency", 0.0) if llm_latency is None else llm_latency
+    kwargs = {} if action_delay is None else {"action_delay": action_delay}
+    runs = {} # subtask id -> (agent, terminal, ask)
+
+    async def make_agent(config, subtask, agent_kwargs):
+        script = scenario["subtasks"][subtask.id]
+        terminal = SimulatedTerminal(**script.get("terminal", {}))
+        ask = scripted_ask(script.get("answers", []), scenario.get("answer_latency", 0.0))
+        agent = scenario_agent(dict(scenario, **script), terminal, ScriptedLLM(script["responses"], latency=latency), ask,
+                               answers=agent_kwargs["answers"], **kwargs)
+        runs[subtask.id] = (agent, terminal, ask)
+        return agent
+
+    result = asyncio.run(arun_plan({}, scenario["task"], concurrency=scenario.get("concurrency", 4),
+                                   agent_kwargs={"llm": ScriptedLLM([scenario["plan"]], latency=latency)}, make_agent=make_agent))
+    success = result.status == scenario.get("expect_status", "done")
+    for subtask_id, script in scenario["subtasks"].items():
+        if subtask_id not in runs or not commands_ran(script, runs[subtask_id][1]):
+            success = False
+    agents = [agent for agent, _, _ in runs.values()]
+    terminals = [terminal for _, terminal, _ in runs.values()]
+    steps = sum(r.steps for r in result.subtasks)
+    return {
+        "scenario": scenario["name"],
+        "status": result.status,
+        "success": success,
+        "steps": steps,
+        "elapsed": round(result.elapsed, 4),
+        "llm_time": round(sum(a.timings["llm"] for a in agents), 4),
+        "tool_time": round(sum(a.timings["tool"] for a in agents), 4),
+        "sleep_time": round(sum(a.timings["sleep"] for a in agents), 4),
+        "terminal_wait_time": round(sum(t.timings["wait"] for t in terminals), 4),
+        "terminal_quiet_time": round(sum(t.timings["quiet"] for t in terminals), 4),
+        "other_time": round(result.elapsed - result.critical_path() - result.planning_seconds, 4),
+        "critical_path": round(result.critical_path(), 4),
+        "serial_time": round(result.serial_seconds(), 4),
+        "llm_calls": sum(a.llm_calls for a in agents) + 1,
+        "prompt_tokens": sum(a.prompt_tokens for a in agents),
+        "completion_tokens": sum(a.completion_tokens for a in agents),
+        "commands": sum(len(t.history) for t in terminals),
+        "probes": sum(len(t.probe_history) for t in terminals),
+        "interrupts": sum(len(t.interrupts) for t in terminals),
+        "questions": sum(len(ask.questions) for _, _, ask in runs.values()),
+        "strong_steps": steps,
+    }
+
+
+def format_table(records):
+    columns = ["scenario", "success", "steps", "strong_steps", "elapsed", "llm_time", "tool_time", "sleep_time", "other_time", "prompt_tokens"]
+    rows = [columns] + [[str(r[c]) for c in columns] for r in records]
+    widths = [max(len(row[k]) for row in rows) for k in range(len(columns))]
+    return "\n".join("  ".join(cell.ljust(w) for cell, w in zip(row, widths)) for row in rows)
+
+
+def main(scenarios=DEFAULT_SCENARIOS, repeat=1, output=None, action_delay=None, llm_latency=None, logger_level="WARNING", metrics_path=None, route=False, fast_latency=None):
+    logger.remove()
+    logger.add(sys.stderr, level=logger_level)
+
+    revision = git_revision()
+    records = []
+    for scenario in load_scenarios(scenarios):
+        for k in range(int(repeat)):
+            record = run_scenario(scenario, action_delay=action_delay, llm_latency=llm_latency, route=route, fast_latency=fast_latency)
+            record.update({"run": k, "route": bool(route), "revision": revision, "timestamp": time.time()})
+            records.append(record)
+
+    print(format_table(records))
+    if metrics_path is not None:
+        REGISTRY.write(metrics_path)
+    if output is not None:
+        with open(output, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    if not all(r["success"] for r in records):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
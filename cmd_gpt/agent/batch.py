@@ -0,0 +1,172 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import yaml
+from loguru import logger
+from pydantic import BaseModel
+
+from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent, add_shared_models
+from cmd_gpt.compat import model_dump_json
+from cmd_gpt.tool.basic.ask import AskChannel
+from cmd_gpt.tool.terminal import async_setup_terminal_tool
+
+# tasks with one of these statuses in the results file are skipped on resume, errors are retried
+COMPLETED_STATUSES = ("done", "max_steps")
+
+
+class BatchTask(BaseModel):
+    id: str
+    task: str
+
+
+class TaskResult(BaseModel):
+    id: str
+    task: str
+    status: str # "done", "max_steps" or "error"
+    steps: int = 0
+    duration: float = 0.0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    last_observation: str = ""
+    error: str = ""
+    worker: int = 0
+    finished_at: float = 0.0
+
+
+def load_tasks(path):
+    """
+    Tasks from a YAML list or a JSONL file. Each entry is a task string or an
+    object with "task" and an optional "id"; without an id, one is derived from
+    the task text so results can be matched up on resume.
+    """
+    with open(path, "r") as f:
+        if path.endswith(".jsonl"):
+            entries = [json.loads(line) for line in f if line.strip() != ""]
+        else:
+            entries = yaml.safe_load(f) or []
+
+    tasks = []
+    seen = {}
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"task": entry}
+        task = entry["task"]
+        task_id = entry.get("id")
+        if task_id is None:
+            task_id = hashlib.sha1(task.encode("utf-8")).hexdigest()[:12]
+            seen[task_id] = seen.get(task_id, 0) + 1
+            if seen[task_id] > 1: # the same task listed again runs again
+                task_id += "-" + str(seen[task_id])
+        tasks.append(BatchTask(id=str(task_id), task=task))
+    return tasks
+
+
+def completed_ids(output):
+    ids = set()
+    if not os.path.exists(output):
+        return ids
+    with open(output, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError: # a line cut short by an interrupted run
+                continue
+            if record.get("status") in COMPLETED_STATUSES:
+                ids.add(record["id"])
+    return ids
+
+
+async def arun_batch(config, tasks, output, workers=4, agent_kwargs=None, resume=True):
+    """
+    Run tasks on a pool of workers, each with its own terminal session and
+    agent reused from task to task. The LLM clients, the router's tiers
+    included, are shared. One TaskResult per task is appended to output as
+    soon as it finishes.
+    """
+    agent_kwargs = dict(agent_kwargs or {})
+    cmd_confg = agent_kwargs.pop("cmd_confg", {})
+    add_shared_models(config, agent_kwargs)
+    ask_channel = None
+    if "ask_channel" not in agent_kwargs: # one reader of stdin for every worker's questions
+        ask_channel = agent_kwargs["ask_channel"] = AskChannel.from_config(config)
+
+    skip = completed_ids(output) if resume else set()
+    pending = [t for t in tasks if t.id not in skip]
+    if len(skip) > 0:
+        logger.info("Resuming: {} of {} tasks already completed".format(len(tasks) - len(pending), len(tasks)))
+    queue = asyncio.Queue()
+    for task in pending:
+        queue.put_nowait(task)
+
+    results = []
+    out = open(output, "a")
+
+    def write(result):
+        results.append(result)
+        out.write(model_dump_json(result) + "\n")
+        out.flush()
+        logger.info("[{}/{}] {} {} in {:.1f}s".format(len(results), len(pending), result.id, result.status, result.duration))
+
+    async def worker(k):
+        agent = None
+        while not queue.empty():
+            task = queue.get_nowait()
+            start = time.monotonic()
+            try:
+                if agent is None:
+                    agent = DeploymentCmdAgent(config, cmd=await async_setup_terminal_tool(**cmd_confg), **agent_kwargs)
+                r = await agent.arun(task.task)
+                write(TaskResult(
+                    id=task.id, task=task.task, status=r.status, steps=r.steps, duration=time.monotonic() - start,
+                    llm_calls=r.llm_calls, prompt_tokens=r.prompt_tokens, completion_tokens=r.completion_tokens,
+                    last_observation=r.last_observation, worker=k, finished_at=time.time(),
+                ))
+            except Exception as e:
+                logger.exception("Task {} failed".format(task.id))
+                write(TaskResult(id=task.id, task=task.task, status="error", duration=time.monotonic() - start,
+                                 error=str(e), worker=k, finished_at=time.time()))
+                if agent is not None: # the session may be in any state, start the next task on a new one
+                    agent.close()
+                    agent = None
+        if agent is not None:
+            agent.close()
+
+    try:
+        await asyncio.gather(*[worker(k) for k in range(max(1, min(int(workers), len(pending))))])
+    finally:
+        out.close()
+        if ask_channel is not None:
+            ask_channel.close()
+    return results
+
+
+def run_batch(config, tasks, output, workers=4, agent_kwargs=None, resume=True):
+    return asyncio.run(arun_batch(config, tasks, output, workers, agent_kwargs, resume))
+
+
+def format_batch_summary(results, elapsed):
+    counts = {}
+    for r in results:
+        counts[r.status] = counts.get(r.status, 0) + 1
+    rate = len(results) / elapsed * 60 if elapsed > 0 else 0.0
+    return "{} tasks in {:.1f}s ({:.1f} tasks/min): {}".format(
+        len(results), elapsed, rate, ", ".join("{} {}".format(n, s) for s, n in sorted(counts.items())) or "nothing to do")
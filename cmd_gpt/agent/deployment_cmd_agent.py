@@ -13,14 +13,32 @@
 # limitations under the License.
 
 
-import re
+import asyncio
+import inspect
 import time
+from typing import Dict, List
 
 from loguru import logger
-from langchain.llms import OpenAI
-
-from cmd_gpt.tool.basic.ask import ask
-from cmd_gpt.tool.terminal.iterm2 import iTerm2Interaction, setup_iterm2_tool
+from pydantic import BaseModel
+
+from cmd_gpt.agent.examples import BUILTIN_EXAMPLES, ExampleStore
+from cmd_gpt.agent.observation import ObservationCompressor
+from cmd_gpt.agent.playbook import PlaybookStore, make_playbook
+from cmd_gpt.agent.scratchpad import Scratchpad
+from cmd_gpt.agent.trace import TraceStore, prompt_hash
+from cmd_gpt.compat import model_dump
+from cmd_gpt.llm.backend import make_llm
+from cmd_gpt.llm.cache import LLMResponseCache, make_cache_key
+from cmd_gpt.llm.router import ModelRouter, RoutingDecision
+from cmd_gpt.llm.streaming import astream_until_action
+from cmd_gpt.llm.tokens import count_tokens
+from cmd_gpt.metrics import REGISTRY, TOKEN_BUCKETS
+from cmd_gpt.tool.basic.ask import ANSWER_REJECTED, AnswerCache, AskChannel, async_ask, prompt_host, question_class
+from cmd_gpt.tool.basic.probe import ProbeTool
+from cmd_gpt.tool.executor import ToolExecutor
+from cmd_gpt.tool.terminal import setup_terminal_tool
+from cmd_gpt.tool.terminal.common import last_non_empty_line, observation_is_question
+from cmd_gpt.tool.terminal.spool import SpoolTools, parse_line_range
 
 EXAMPLE_TEMPLATE = """
 Task: Make sure Vim is install in 10.23.12.34
@@ -82,12 +100,14 @@ The following are the tool you have access to:
 1. terminal_run: you can type in the terminal to execute commands and return the last 5 lines of the terminal. Usage: terminal[command]
 2. terminal_read: you can read the output of the terminal; it is helpful when you need to read more on the screen. Usage: terminal_read[lines]
 3. ask: you can ask your team members or boss if you have question or need help. Usage: ask[content]
+{extra_tools}
 
 Guideline:
 1. Do not try to upgrade system unless you absolutely need to
 2. DO NOT COPY THE EXAMPLES BELOW!
 3. END WHEN EVER YOU CAN!
 4. when you are done, write E: end
+{multi_action_guideline}
 
 
 ## Examples
@@ -100,9 +120,15 @@ Task: {task_info}
 ONLY PERFORM ONE STEP OF MAPE, make sure A,P,E are all provided. Think if you stop here?
 """
 
+PROBE_TOOL = "probe: you can run read-only checks (OS, packages, disk, services) at once in a side session {location}, faster than several terminal_run. Usage: probe[command1; command2]"
+
+SEARCH_TOOL = "terminal_search: you can grep the full output of earlier commands for a regex and get matching lines with line numbers; terminal_read[start-end] reads a line range. Usage: terminal_search[pattern]"
+
+MULTI_ACTION_GUIDELINE = "5. you can write up to {max_actions} E: lines, one action per line; they run in order and stop at the first one that waits for input (e.g. a password or Y/n question)"
+
 
 
-def processing_output(text):
+def parse_output(text):
     lines = text.split("\n")
 
     analysis = ""
@@ -120,97 +146,579 @@ def processing_output(text):
         elif line[:2] == "E:":
             action = line.strip()
 
-    if action[2:].strip() in ["end", "exit"]:
-        is_done = True
-    elif plan[2:].strip() == "end":
+    return analysis, plan, action
+
+
+def parse_actions(text):
+    # the first block of consecutive E: lines, in order
+    actions = []
+    for line in text.split("\n"):
+        if line[:2] == "E:":
+            actions.append(line.strip())
+        elif len(actions) > 0:
+            break
+    return actions
+
+
+def split_action(action):
+    act_parts = action.split("[")
+    name = act_parts[0][2:].strip()
+    action_input = "[".join(act_parts[1:])[:-1]
+    return name, action_input
+
+
+def action_is_end(action):
+    return action[2:].strip() in ["end", "exit"]
+
+
+def processing_output_multi(text, max_actions=1):
+    """
+    The response text to keep, the ordered list of (action, action_input) from
+    the first block of at most max_actions E: lines, and whether the task is
+    done. Actions before an "E: end" still run.
+    """
+    analysis, plan, _ = parse_output(text)
+    action_lines = parse_actions(text)[:max_actions]
+
+    is_done = False
+    actions = []
+    for action in action_lines:
+        if action_is_end(action):
+            is_done = True
+            break
+        actions.append(split_action(action))
+
+    if plan[2:].strip() == "end" or (plan == "" and len(action_lines) == 0):
         is_done = True
-    elif plan == "" and action == "": # no plan an action, assume done
-        is_done = True 
-    else:    
-        is_done = False
-    
-    
-    ret_text = analysis + "\n" + plan + "\n" + action + "\n"
-
-    if not is_done:
-        act_parts = action.split("[")
-        action = act_parts[0][2:].strip()
-        action_input = "[".join(act_parts[1:])[:-1]
-    else:
-        action = ""
-        action_input = ""
-    
-    return ret_text, action, action_input, is_done
+        actions = []
+
+    ret_text = analysis + "\n" + plan + "\n" + "\n".join(action_lines) + "\n"
+    return ret_text, actions, is_done
+
+
+class StepMetrics(BaseModel):
+    step: int
+    model: str = ""
+    render_seconds: float = 0.0
+    llm_seconds: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    tool_seconds: float = 0.0
+    sleep_seconds: float = 0.0
+    terminal_wait_seconds: float = 0.0 # part of tool_seconds
+    terminal_quiet_seconds: float = 0.0 # part of terminal_wait_seconds
+    observation_chars: int = 0
+    observation_tokens: int = 0
+
+
+class AgentRunResult(BaseModel):
+    status: str # "done" or "max_steps"
+    steps: int
+    last_observation: str = ""
+    elapsed: float = 0.0
+    started_at: float = 0.0 # wall clock
+    first_llm_latency: float = 0.0 # seconds from the start of the run to the first LLM request
+    timings: Dict[str, float] = {} # seconds spent in "render", "llm", "tool" and "sleep"
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    step_metrics: List[StepMetrics] = []
+    routing: List[RoutingDecision] = []
+    replayed_steps: int = 0 # steps run from a playbook without the LLM
+    run_id: str = "" # id in the trace store, empty when tracing is off
+
+    def summary(self):
+        wait = sum(step.terminal_wait_seconds for step in self.step_metrics)
+        quiet = sum(step.terminal_quiet_seconds for step in self.step_metrics)
+        return ("{} in {} steps, {:.2f}s: llm {:.2f}s ({} calls, {} prompt / {} completion tokens), "
+                "tools {:.2f}s (terminal wait {:.2f}s, of which quiet {:.2f}s), confirmation waits {:.2f}s, render {:.3f}s").format(
+            self.status, self.steps, self.elapsed, self.timings.get("llm", 0.0), self.llm_calls, self.prompt_tokens,
+            self.completion_tokens, self.timings.get("tool", 0.0), wait, quiet, self.timings.get("sleep", 0.0),
+            self.timings.get("render", 0.0))
+
+
+def combine_observations(results):
+    if len(results) == 1:
+        return results[0][0], results[0][2]
+    obs = ""
+    for name, action_input, action_obs in results:
+        obs += "\n" + name + "[" + action_input + "]: " + action_obs
+    return "actions", obs
 
     
 
+def add_shared_models(config, agent_kwargs):
+    """
+    Put the llm and, when ROUTER_FAST_MODEL is configured, the router into
+    agent_kwargs unless an llm is there already, so agents working side by
+    side share their model clients.
+    """
+    if "llm" not in agent_kwargs:
+        agent_kwargs["llm"] = make_llm(config)
+        if "router" not in agent_kwargs:
+            agent_kwargs["router"] = ModelRouter.from_config(config, lambda model_name: make_llm(config, model_name))
+    return agent_kwargs
+
+
 class DeploymentCmdAgent():
-    def __init__(self, config, llm=None, max_steps=100, action_mapping = {}, cmd_confg={}, max_scrtach_pad_rounds=3):
+    def __init__(self, config, llm=None, max_steps=100, action_mapping = {}, cmd_confg={}, max_scrtach_pad_rounds=3, scratch_pad_token_budget=1500, max_actions_per_step=1, cmd=None, observation_token_budget=500, action_delay=3, router=None, playbooks=None, examples=None, probe=None, traces=None, executor=None, ask_channel=None, answers=None):
         
-        cmd = setup_iterm2_tool(**cmd_confg)
+        if cmd is None: # an already set up terminal tool can be passed in, e.g. from async_setup_terminal_tool
+            if observation_token_budget is not None:
+                # the compressor decides what to keep, so let the terminal return the whole output
+                cmd_confg = dict(cmd_confg, read_max_length=cmd_confg.get("read_max_length", 0))
+            cmd = setup_terminal_tool(**cmd_confg)
         self.cmd = cmd
-        self.agent_scratch_pad = ""
         self.max_scratch_pad_rounds = max_scrtach_pad_rounds
+        self.scratch_pad_token_budget = scratch_pad_token_budget
+        self.scratch_pad = self.new_scratchpad()
 
         if llm is None:
-            self.llm = OpenAI(temperature=0, model_name=config["OPENAI_API_MODEL"])
+            llm = make_llm(config)
+            if router is None: # a cheaper model for routine steps when ROUTER_FAST_MODEL is configured
+                router = ModelRouter.from_config(config, lambda model_name: make_llm(config, model_name))
+        self.llm = llm
+        self.router = router.fork() if router is not None else None # agents working side by side may share one router's models
+        self.playbooks = playbooks if playbooks is not None else PlaybookStore.from_config(config)
+        self.examples = examples if examples is not None else ExampleStore.from_config(config, builtin=[EXAMPLE_TEMPLATE] + BUILTIN_EXAMPLES)
+        self.probe = probe if probe is not None else ProbeTool.from_config(config, runner=getattr(cmd, "async_probe", None))
+        self.traces = traces if traces is not None else TraceStore.from_config(config)
+        self.run_id = None
+        self.learn_examples = str(config.get("EXAMPLE_LEARN", "false")).lower() in ["1", "true", "yes"]
+        self.example_steps = int(config.get("EXAMPLE_STEPS", 2)) # examples go into the first steps only, 0 for every step
+        self.llm_cache = LLMResponseCache.from_config(config)
+        self.streaming = str(config.get("LLM_STREAMING", "false")).lower() in ["1", "true", "yes"]
         self.max_steps = max_steps
+        self.max_actions_per_step = max_actions_per_step
+        self.action_delay = action_delay # seconds to wait before a command the confirmation policy does not approve
+        self.executor = executor if executor is not None else ToolExecutor.from_config(config, self.arun_tool, cmd, confirm_delay=action_delay, ask=self.ask_operator)
+        self._task = None
+        # for the agent's lifetime, so a daemon or batch worker keeps them between tasks; agents working side by side can share them
+        self.answers = answers if answers is not None else AnswerCache()
+        self.defer_asks = str(config.get("ASK_DEFER", "true")).lower() in ["1", "true", "yes"]
+        self.ask_channel = ask_channel
+        self._owns_ask_channel = False
+        self.last_terminal_observation = ""
+        self.terminal_host = ""
+        self.reset_stats()
+        if observation_token_budget is not None:
+            self.observation_compressor = ObservationCompressor(token_budget=observation_token_budget)
+        else:
+            self.observation_compressor = None
+        self.spool_tools = SpoolTools(cmd) if getattr(cmd, "spool", None) is not None else None
         if action_mapping == {}:
+            if self.ask_channel is None:
+                self.ask_channel = AskChannel.from_config(config)
+                self._owns_ask_channel = True
             self.action_mapping = {
-                "terminal_run": cmd.run_command_and_get_reply,
-                "terminal_read": cmd.read_output,
-                "ask": ask,
+                "terminal_run": cmd.async_run_command_and_get_reply,
+                "terminal_read": cmd.async_read_output,
+                "ask": self.ask_channel.ask,
             }
+            if self.spool_tools is not None:
+                self.action_mapping["terminal_read"] = self.spool_tools.read
+                self.action_mapping["terminal_search"] = self.spool_tools.search
+            if self.probe is not None:
+                self.action_mapping["probe"] = self.probe.arun
+        else:
+            self.action_mapping = action_mapping
     
-    def num_scratchpad_rounds(self, scratch_pad):
-        count = 0
-        for line in scratch_pad.split("\n"):
-            if re.match(r"^M: .*: .*", line.strip()):
-                count += 1
-        return count
-    
-    def shrink_scratchpad_rounds(self, scratch_pad, n):
-        new_scratch_pad = []
-        count = 0
-        for line in reversed(scratch_pad.split("\n")):
-            new_scratch_pad.append(line)
-            if re.match(r"^M: .*: .*", line.strip()):
-                count += 1
-                if count >= n:
-                    break
-        return "\n".join(list(reversed(new_scratch_pad)))
+    def reset_stats(self):
+        self.timings = {"render": 0.0, "llm": 0.0, "tool": 0.0, "sleep": 0.0}
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.step_metrics = []
+        self.action_history = []
+        self.first_llm_at = None
+        self.trace = [] # (action, action_input, observation) of every action run
+        self.step_trace_start = 0
+        self.pending_asks = [] # (question, question class, trace index, task) of questions still waiting for a human
+
+    def _stats_snapshot(self):
+        return dict(self.timings), dict(getattr(self.cmd, "timings", {})), self.prompt_tokens, self.completion_tokens
+
+    def record_step(self, i, before, obs, model=""):
+        timings, terminal_timings, prompt_tokens, completion_tokens = before
+        terminal_now = getattr(self.cmd, "timings", {})
+        obs_tokens = count_tokens(obs)
+        step = StepMetrics(
+            step=i,
+            model=model,
+            render_seconds=self.timings["render"] - timings["render"],
+            llm_seconds=self.timings["llm"] - timings["llm"],
+            prompt_tokens=self.prompt_tokens - prompt_tokens,
+            completion_tokens=self.completion_tokens - completion_tokens,
+            tool_seconds=self.timings["tool"] - timings["tool"],
+            sleep_seconds=self.timings["sleep"] - timings["sleep"],
+            terminal_wait_seconds=terminal_now.get("wait", 0.0) - terminal_timings.get("wait", 0.0),
+            terminal_quiet_seconds=terminal_now.get("quiet", 0.0) - terminal_timings.get("quiet", 0.0),
+            observation_chars=len(obs),
+            observation_tokens=obs_tokens,
+        )
+        self.step_metrics.append(step)
+        REGISTRY.inc("agent_steps", 1, "Agent steps run.")
+        REGISTRY.observe("observation_tokens", obs_tokens, "Tokens per observation added to the scratchpad.", buckets=TOKEN_BUCKETS)
+        step_metrics = model_dump(step)
+        logger.bind(step_metrics=step_metrics).debug("Step {} metrics: {}".format(i, step_metrics))
+        if self.run_id is not None:
+            observations = [self.mask_secrets(obs) for _, _, obs in self.trace[self.step_trace_start:]]
+            self.traces.finish_step(self.run_id, i, observations, step)
+
+    def begin_trace_step(self, i, template, model, output, actions):
+        self.step_trace_start = len(self.trace)
+        if self.run_id is not None:
+            actions = [(action, self.mask_secrets(action_input)) for action, action_input in actions]
+            self.traces.add_step(self.run_id, i, prompt_hash(template) if template else "", model, self.mask_secrets(output), actions)
+
+    def mask_secrets(self, text):
+        # answers from ask are usually secrets
+        text = str(text)
+        for action, _, obs in self.trace:
+            if action == "ask" and str(obs).strip() != "":
+                text = text.replace(str(obs).strip(), "******")
+        return self.answers.redact(text)
+
+    def new_scratchpad(self):
+        return Scratchpad(max_verbatim_rounds=self.max_scratch_pad_rounds, token_budget=self.scratch_pad_token_budget)
+
+    async def apredict(self, template, llm=None):
+        llm = self.llm if llm is None else llm
+        if self.first_llm_at is None:
+            self.first_llm_at = time.perf_counter()
+        model_name = getattr(llm, "model_name", "")
+        prompt_tokens = count_tokens(template, model_name or "gpt-3.5-turbo")
+        self.llm_calls += 1
+        self.prompt_tokens += prompt_tokens
+        REGISTRY.inc("llm_prompt_tokens", prompt_tokens, "Prompt tokens sent to the LLM.", model=model_name)
+        start = time.perf_counter()
+        try:
+            output = await self._apredict(template, llm)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings["llm"] += elapsed
+            REGISTRY.observe("llm_request_seconds", elapsed, "LLM request latency, cache hits included.", model=model_name)
+        completion_tokens = count_tokens(output, model_name or "gpt-3.5-turbo")
+        self.completion_tokens += completion_tokens
+        REGISTRY.inc("llm_completion_tokens", completion_tokens, "Completion tokens received from the LLM.", model=model_name)
+        return output
+
+    async def _apredict(self, template, llm):
+        key = make_cache_key(getattr(llm, "model_name", ""), getattr(llm, "temperature", None), template, max_tokens=getattr(llm, "max_tokens", None))
+        output = self.llm_cache.get(key)
+        if output is not None:
+            logger.debug("LLM cache hit")
+            return output
+        if self.streaming:
+            output = await astream_until_action(llm, template, multi_action=self.max_actions_per_step > 1)
+        elif hasattr(llm, "apredict"):
+            output = await llm.apredict(template)
+        else:
+            output = await asyncio.to_thread(llm.predict, template)
+        self.llm_cache.put(key, output, getattr(llm, "model_name", ""))
+        return output
+
+    async def arun_action(self, action, action_input):
+        if action in self.action_mapping:
+            start = time.perf_counter()
+            approved = await self.executor.confirm(action, action_input)
+            elapsed = time.perf_counter() - start
+            self.timings["sleep"] += elapsed
+            REGISTRY.inc("action_delay_seconds", elapsed, "Time spent waiting for confirmation before actions.")
+            if not approved:
+                return "\nThe operator did not approve this command, it was not run."
+            return await self.executor.run(action, action_input)
+        else:
+            raise NotImplementedError("Unknown action: {}".format(action))
+
+    async def ask_operator(self, question):
+        # confirmations and open questions go through the same channel as the ask tool, e.g. the daemon's client
+        ask = self.action_mapping.get("ask", async_ask)
+        if inspect.iscoroutinefunction(ask):
+            return await ask(question)
+        return await asyncio.to_thread(ask, question)
+
+    async def arun_tool(self, action, *args):
+        tool = self.action_mapping[action]
+        start = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(tool):
+                return await tool(*args)
+            return await asyncio.to_thread(tool, *args) # plain functions from a custom action_mapping
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings["tool"] += elapsed
+            REGISTRY.observe("tool_seconds", elapsed, "Tool execution time.", action=action)
+
+    def compress_observation(self, obs, action=None, action_input=""):
+        if self.observation_compressor is None or not isinstance(obs, str):
+            return obs
+        if action == "terminal_search" or (action == "terminal_read" and parse_line_range(action_input) is not None):
+            return obs # the exact lines the model asked for
+        return self.observation_compressor.compress(obs)
+
+    def note_spooled(self, action, obs):
+        # point at the full output when the observation shows less of it than the spool holds
+        if action != "terminal_run" or self.spool_tools is None or "terminal_search" not in self.action_mapping or not isinstance(obs, str):
+            return obs
+        start, end = self.spool_tools.spool.command_lines()
+        if end - start <= obs.strip("\n").count("\n") + 2: # the command line and the prompt
+            return obs
+        return obs + "\n(full output: lines {}-{}, use terminal_search[pattern] or terminal_read[start-end])".format(start + 1, end)
+
+    def note_terminal(self, action, action_input, obs):
+        # what the terminal shows, for classifying questions asked about it
+        if action not in ["terminal_run", "terminal_read"] or parse_line_range(action_input) is not None or not isinstance(obs, str):
+            return
+        self.last_terminal_observation = obs
+        host = prompt_host(obs.split("\n"))
+        if host:
+            self.terminal_host = host
+
+    async def aask(self, question, defer=True):
+        """
+        Answer from the session's answer cache when the same kind of question (a
+        sudo password on this host, ...) was answered before. Otherwise ask; unless
+        the terminal is waiting on the answer, the question stays open and the run
+        goes on until the reply comes.
+        """
+        question = str(question)
+        key = question_class(question, last_non_empty_line(self.last_terminal_observation.split("\n")), self.terminal_host)
+        if key is not None:
+            if ANSWER_REJECTED.search(self.last_terminal_observation):
+                self.answers.forget(key)
+            answer = self.answers.get(key)
+            if answer is not None:
+                logger.info("Answered from the session's answer cache: " + key)
+                REGISTRY.inc("ask_cache_hits", 1, "Questions answered from the session's answer cache.")
+                return answer
+        if defer and self.defer_asks and not observation_is_question(self.last_terminal_observation):
+            logger.info("Asked, going on until the reply comes: " + question)
+            # the question's entry in the trace is the next one, its reply replaces the placeholder there;
+            # the wait overlaps other steps, so it is not counted as tool time
+            self.pending_asks.append((question, key, len(self.trace), asyncio.ensure_future(self.ask_operator(question))))
+            return "\n(asked; the reply comes with a later observation, go on with steps that do not need it)"
+        answer = await self.arun_action("ask", question)
+        self.remember_answer(key, answer)
+        return answer
+
+    def remember_answer(self, key, answer):
+        if key is not None and str(answer).strip() != "":
+            self.answers.put(key, str(answer).strip())
+
+    async def collect_answers(self, wait=False):
+        """
+        ("ask reply", question, answer) for every open question answered by now.
+        With wait, first wait until one of them is.
+        """
+        if len(self.pending_asks) == 0:
+            return []
+        if wait:
+            logger.info("Waiting for a reply to {} open question(s)".format(len(self.pending_asks)))
+            await asyncio.wait([task for *_, task in self.pending_asks], return_when=asyncio.FIRST_COMPLETED)
+        results, still_open = [], []
+        for question, key, k, task in self.pending_asks:
+            if not task.done():
+                still_open.append((question, key, k, task))
+                continue
+            try:
+                answer = task.result()
+            except Exception as e:
+                answer = "\n(no reply: {!r})".format(e)
+            else:
+                self.remember_answer(key, answer)
+                self.trace[k] = ("ask", question, answer) # playbooks and masking see the reply
+            results.append(("ask reply", question, answer))
+        self.pending_asks = still_open
+        return results
+
+    def cancel_open_questions(self):
+        for question, _, _, task in self.pending_asks:
+            logger.info("No reply needed any more: " + question)
+            task.cancel()
+        self.pending_asks = []
+
+    async def arun_actions(self, actions):
+        # run actions back to back, stop at the first one that leaves the terminal waiting on a question
+        results = []
+        for k, (action, action_input) in enumerate(actions):
+            if action == "ask":
+                obs = await self.aask(action_input)
+            else:
+                obs = await self.arun_action(action, action_input)
+            obs = self.note_spooled(action, self.compress_observation(obs, action, action_input))
+            self.note_terminal(action, action_input, obs)
+            self.trace.append((action, action_input, obs))
+            results.append(("ask reply" if action == "ask" else action, action_input, obs))
+            if k < len(actions) - 1 and observation_is_question(obs):
+                logger.info("Waiting for input, skipping {} remaining actions".format(len(actions) - k - 1))
+                break
+        return results
+
+    async def areplay(self, task_info):
+        """
+        Replay the playbook matching the task, if any, until an observation
+        differs from the recorded one. Returns (steps run, whether the playbook
+        completed); on divergence the LLM takes over from the scratchpad as is.
+        """
+        if self.playbooks is None:
+            return 0, False
+        playbook, params = self.playbooks.find(task_info)
+        if playbook is None:
+            return 0, False
+        logger.info("Replaying playbook '{}' with {}".format(playbook.task_template, params))
+        answers = {}
+        for k, step in enumerate(playbook.steps):
+            before = self._stats_snapshot()
+            try:
+                action_input = playbook.render(step.action_input, params, answers)
+            except (KeyError, IndexError):
+                logger.info("Playbook step {} cannot be rendered, handing over to the LLM".format(k))
+                return k, False
+            action_line = "E: {}[{}]".format(step.action, action_input)
+            self.begin_trace_step(k, "", "playbook", "", [(step.action, action_input)])
+            if step.action == "ask": # a later step may need the answer
+                obs = self.compress_observation(await self.aask(action_input, defer=False))
+            else:
+                obs = self.compress_observation(await self.arun_action(step.action, action_input), step.action, action_input)
+            self.note_terminal(step.action, action_input, obs)
+            self.trace.append((step.action, action_input, obs))
+            self.action_history.append(action_line)
+            if step.action == "ask":
+                answers["ask" + str(len(answers))] = obs.strip()
+            remaining = [s.action for s in playbook.steps[k + 1:]]
+            self.scratch_pad.set_response(
+                "A: Following the playbook recorded for this task (step {} of {}).".format(k + 1, len(playbook.steps)),
+                "P: " + " -> ".join(remaining + ["end"]),
+                action_line,
+            )
+            self.scratch_pad.add_observation("ask reply" if step.action == "ask" else step.action, obs)
+            self.record_step(k, before, obs, "playbook")
+            if not playbook.step_matches(step, obs, params, answers):
+                logger.info("Playbook diverged at step {}, handing over to the LLM".format(k + 1))
+                return k + 1, False
+        playbook.uses += 1
+        self.playbooks.save(playbook)
+        return len(playbook.steps), True
+
+    def save_playbook(self, task_info):
+        if self.playbooks is None or len(self.trace) == 0:
+            return
+        playbook = make_playbook(task_info, self.trace)
+        logger.info("Saved playbook '{}' to {}".format(playbook.task_template, self.playbooks.save(playbook)))
+
+    def select_examples(self, task_info, i):
+        if self.examples is None:
+            return EXAMPLE_TEMPLATE if i<2 else ""
+        if self.example_steps > 0 and i >= self.example_steps:
+            return ""
+        # the most relevant examples for the task and what is on the screen now
+        examples = self.examples.select(task_info + "\n" + self.scratch_pad.last_observation()[-1000:])
+        if examples == "" and i < 2: # nothing relevant, still show the format
+            return EXAMPLE_TEMPLATE
+        return examples
+
+    def save_example(self, task_info):
+        if self.examples is None or not self.learn_examples:
+            return
+        transcript = self.scratch_pad.transcript()
+        if not transcript:
+            return
+        self.examples.add("\nTask: " + task_info + "\n" + self.mask_secrets(transcript), source="run")
+
+    def render_template(self, task_info, i):
+        if self.max_actions_per_step > 1:
+            multi_action_guideline = MULTI_ACTION_GUIDELINE.format(max_actions=self.max_actions_per_step)
+        else:
+            multi_action_guideline = ""
+        extra_tools = []
+        if "probe" in self.action_mapping:
+            location = self.probe.location if self.probe is not None else "on the local machine"
+            extra_tools.append(PROBE_TOOL.format(location=location))
+        if "terminal_search" in self.action_mapping:
+            extra_tools.append(SEARCH_TOOL)
+        return PROMPT_TEMPLATE.format(
+            task_info=task_info,
+            agent_scratch_pad=self.scratch_pad.render(),
+            example=self.select_examples(task_info, i),
+            multi_action_guideline=multi_action_guideline,
+            extra_tools="\n".join("{}. {}".format(k + 4, tool) for k, tool in enumerate(extra_tools)),
+        )
 
     def run(self, task_info):
-        i = 0
-        self.agent_scratch_pad += f"M: terminal_run: " + self.action_mapping["terminal_read"]() + "\n"
-        while True:
-            self.shrink_scratchpad_rounds(self.agent_scratch_pad, self.max_scratch_pad_rounds)
-            if i<2:
-                template = PROMPT_TEMPLATE.format(task_info=task_info, agent_scratch_pad=self.agent_scratch_pad, example=EXAMPLE_TEMPLATE)
-            else:
-                template = PROMPT_TEMPLATE.format(task_info=task_info, agent_scratch_pad=self.agent_scratch_pad, example="")
+        return asyncio.run(self.arun(task_info))
+
+    async def arun(self, task_info):
+        self.run_id = None
+        self._task = asyncio.current_task()
+        try:
+            return await self._arun(task_info)
+        except BaseException as e:
+            if self.run_id is not None:
+                self.traces.finish_run(self.run_id, "interrupted" if isinstance(e, (KeyboardInterrupt, asyncio.CancelledError)) else "error")
+            raise
+        finally:
+            self._task = None
+            self.cancel_open_questions()
+
+    def cancel(self):
+        """
+        Cancel the running task from any thread. The command the agent is waiting
+        on is interrupted and arun raises CancelledError.
+        """
+        task = self._task
+        if task is not None:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+    async def _arun(self, task_info):
+        started_at = time.time()
+        start = time.perf_counter()
+        self.reset_stats()
+        if self.router is not None:
+            self.router.reset()
+        self.scratch_pad = self.new_scratchpad()
+        before = self._stats_snapshot() # the first step also accounts for the initial read
+        initial_observation = self.compress_observation(await self.arun_tool("terminal_read"))
+        self.note_terminal("terminal_read", "", initial_observation)
+        self.scratch_pad.add_observation("terminal_run", initial_observation)
+        if self.traces is not None:
+            self.run_id = self.traces.start_run(task_info, str(initial_observation))
+        i, replay_done = await self.areplay(task_info)
+        replayed_steps, is_done = i, replay_done
+        if i > 0:
+            before = self._stats_snapshot()
+        while not is_done:
+            render_start = time.perf_counter()
+            template = self.render_template(task_info, i)
+            render_elapsed = time.perf_counter() - render_start
+            self.timings["render"] += render_elapsed
+            REGISTRY.observe("step_render_seconds", render_elapsed, "Prompt render time per step.")
             logger.debug("="*10 + "template" + "="*10 + "\n" + template + "\n" + "="*10 + "\n")
-            output = self.llm.predict(template)
+            llm = self.llm
+            if self.router is not None:
+                decision = self.router.route(i, self.scratch_pad.last_observation(), self.action_history)
+                llm = self.router.llm(decision)
+                REGISTRY.inc("llm_routes", 1, "Steps routed to each model tier.", tier=decision.tier)
+            output = await self.apredict(template, llm)
             logger.debug("="*10 + "output" + "="*10 + "\n" + output + "\n" + "="*10 + "\n")
-            processed_output, action, action_input, is_done = processing_output(output)
-            if action in self.action_mapping:
-                logger.info("Running this in 3 seconds: Action: " + str(action) + "; Input: " + str(action_input))
-                time.sleep(3)
-                obs = self.action_mapping[action](action_input)
-                
-            else:
-                if action == "": # no op
-                    obs = ""
-                else:
-                    raise NotImplementedError("Unknown action: {}".format(action))
-            
-            self.agent_scratch_pad += processed_output
-            self.agent_scratch_pad += "\n"
-            if action == "ask":
-                scratch_pad_action = "ask reply"
-            else:
-                scratch_pad_action = action
-            self.agent_scratch_pad += "M: " + scratch_pad_action + ": " + obs + "\n"
+            _, actions, is_done = processing_output_multi(output, self.max_actions_per_step)
+            analysis, plan, _ = parse_output(output)
+            action_lines = parse_actions(output)[:self.max_actions_per_step]
+            self.action_history.append("\n".join(action_lines))
+            self.begin_trace_step(i, template, getattr(llm, "model_name", ""), output, actions)
+
+            results = await self.arun_actions(actions)
+            # replies to earlier questions; a step that did nothing waits for one
+            results += await self.collect_answers(wait=len(results) == 0 and not is_done)
+            if len(results) > 0:
+                scratch_pad_action, obs = combine_observations(results)
+            else: # no op
+                scratch_pad_action, obs = "", ""
+
+            self.scratch_pad.set_response(analysis, plan, "\n".join(action_lines))
+            self.scratch_pad.add_observation(scratch_pad_action, obs)
+            self.record_step(i, before, obs, getattr(llm, "model_name", ""))
+            before = self._stats_snapshot()
             if is_done or i >= self.max_steps:
                 if is_done:
                     logger.info("Done")
@@ -221,6 +729,41 @@ class DeploymentCmdAgent():
             logger.debug("Observation: ", obs, "\n")
             i += 1
 
+        if replay_done:
+            i = replayed_steps - 1 # the playbook ran to completion without the LLM
+        elif is_done:
+            self.save_playbook(task_info)
+            self.save_example(task_info)
+        result = AgentRunResult(
+            status="done" if is_done else "max_steps",
+            steps=i + 1,
+            last_observation=self.scratch_pad.last_observation(),
+            elapsed=time.perf_counter() - start,
+            started_at=started_at,
+            first_llm_latency=self.first_llm_at - start if self.first_llm_at is not None else 0.0,
+            timings=dict(self.timings),
+            llm_calls=self.llm_calls,
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            step_metrics=self.step_metrics,
+            routing=list(self.router.decisions) if self.router is not None else [],
+            replayed_steps=replayed_steps,
+            run_id=self.run_id or "",
+        )
+        if self.run_id is not None:
+            self.traces.finish_run(self.run_id, result.status, result)
+        REGISTRY.inc("agent_runs", 1, "Agent runs by final status.", status=result.status)
+        REGISTRY.observe("agent_run_seconds", result.elapsed, "Wall-clock time per agent run.")
+        logger.info("Run {}summary: ".format(result.run_id + " " if result.run_id else "") + result.summary())
+        return result
+
     def close(self):
+        if self._owns_ask_channel:
+            self.ask_channel.close()
         self.cmd.close()
+        self.llm_cache.close()
+        if self.examples is not None:
+            self.examples.close()
+        if self.traces is not None:
+            self.traces.close()
         
@@ -0,0 +1,231 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+from cmd_gpt.llm.tokens import count_tokens
+
+
+QUERY_TOKEN = re.compile(r"[a-z0-9_][a-z0-9_.-]*[a-z0-9_]")
+QUERY_STOPWORDS = {
+    "a", "an", "on", "in", "is", "to", "of", "at", "by", "it", "be", "as", "or", "if", "my", "me", "we", "do", "so", "no", "the", "and", "for", "with", "this", "that", "from", "into", "make", "sure", "you", "are", "was", "has", "have",
+    "not", "can", "will", "all", "any", "its", "use", "using", "need", "should", "then",
+}
+MAX_QUERY_TERMS = 48
+
+BUILTIN_EXAMPLES = [
+"""
+Task: Restart the nginx service on this machine and make sure it is running
+M: terminal_run: 
+    ubuntu@web-1:~$
+A: I'm on the machine already. I can restart nginx with systemctl.
+P: restart nginx -> check it is active -> end
+E: terminal_run[sudo systemctl restart nginx]
+
+M: terminal_run: 
+    Job for nginx.service failed because the control process exited with error code.
+    See "systemctl status nginx.service" and "journalctl -xeu nginx.service" for details.
+A: nginx failed to start. The journal will tell me why.
+P: read the error -> fix it -> restart nginx -> check it is active -> end
+E: terminal_run[sudo journalctl -u nginx --no-pager -n 20]
+
+M: terminal_run: 
+    nginx: [emerg] unknown directive "proxy_passs" in /etc/nginx/sites-enabled/default:12
+A: There is a typo on line 12 of the site config. I'll fix it and test the configuration.
+P: fix the typo -> test config -> restart nginx -> end
+E: terminal_run[sudo sed -i 's/proxy_passs/proxy_pass/' /etc/nginx/sites-enabled/default && sudo nginx -t]
+
+M: terminal_run: 
+    nginx: configuration file /etc/nginx/nginx.conf test is successful
+A: The configuration is valid now.
+P: restart nginx -> check it is active -> end
+E: terminal_run[sudo systemctl restart nginx && systemctl is-active nginx]
+
+M: terminal_run: 
+    active
+A: nginx is running.
+P: end
+E: end
+""",
+"""
+Task: Run redis in a docker container named cache on port 6379
+M: terminal_run: 
+    eric@laptop:~$
+A: I need to start a redis container. First I check whether a container called cache already exists.
+P: check existing container -> start redis -> verify -> end
+E: terminal_run[docker ps -a --filter name=cache]
+
+M: terminal_run: 
+    CONTAINER ID   IMAGE     COMMAND   CREATED   STATUS    PORTS     NAMES
+A: There is no container called cache, I can create it.
+P: start redis -> verify -> end
+E: terminal_run[docker run -d --name cache -p 6379:6379 redis:7]
+
+M: terminal_run: 
+    3f2c9a1d0b7e5c4a8e6f1b2d3c4e5f6a7b8c9d0e1f2a3b4c5d6e7f8a9b0c1d2e
+A: The container started. I should check that redis answers.
+P: verify -> end
+E: terminal_run[docker exec cache redis-cli ping]
+
+M: terminal_run: 
+    PONG
+A: redis is running in the cache container.
+P: end
+E: end
+""",
+"""
+Task: Roll out the new image registry.local/api:1.4 to the api deployment in the prod namespace
+M: terminal_run: 
+    eric@laptop:~$
+A: I'll update the image of the api deployment with kubectl and wait for the rollout.
+P: set image -> wait for rollout -> end
+E: terminal_run[kubectl -n prod set image deployment/api api=registry.local/api:1.4]
+
+M: terminal_run: 
+    deployment.apps/api image updated
+A: The image is updated, now I wait for the rollout to finish.
+P: wait for rollout -> end
+E: terminal_run[kubectl -n prod rollout status deployment/api --timeout=300s]
+
+M: terminal_run: 
+    Waiting for deployment "api" rollout to finish: 1 of 3 updated replicas are available...
+    deployment "api" successfully rolled out
+A: The rollout finished successfully.
+P: end
+E: end
+""",
+]
+
+
+def example_task(text):
+    for line in text.split("\n"):
+        if line.startswith("Task:"):
+            return line[len("Task:"):].strip()
+    return ""
+
+
+def build_query(text):
+    terms = []
+    for token in QUERY_TOKEN.findall((text or "").lower()):
+        if token in QUERY_STOPWORDS or token in terms:
+            continue
+        terms.append(token)
+        if len(terms) >= MAX_QUERY_TERMS:
+            break
+    return " OR ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+class ExampleStore:
+    """
+    Few-shot examples in SQLite with an FTS5 index (porter stemmed), ranked with
+    BM25 over the task line (weighted up) and the transcript. The index lives on disk with the
+    examples, so it is built incrementally as examples are added and queries stay
+    in the low milliseconds with thousands of them.
+    """
+    def __init__(self, path=":memory:", top_k=1, token_budget=600, builtin=None):
+        self.path = path
+        self.top_k = int(top_k)
+        self.token_budget = int(token_budget)
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS examples ("
+            "id TEXT PRIMARY KEY, task TEXT, body TEXT, source TEXT, tokens INTEGER, created REAL)"
+        )
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS example_index USING fts5(id UNINDEXED, task, body, tokenize='porter unicode61')")
+        for text in builtin if builtin is not None else BUILTIN_EXAMPLES:
+            self.add(text, source="builtin", replace=False)
+
+    @classmethod
+    def from_config(cls, config, builtin=None):
+        path = config.get("EXAMPLE_DB", ":memory:") # nothing is written to disk unless a path is configured
+        if str(path).lower() in ["off", "none", ""]:
+            return None
+        return cls(
+            path=os.path.expanduser(path),
+            top_k=config.get("EXAMPLE_TOP_K", 1),
+            token_budget=config.get("EXAMPLE_TOKEN_BUDGET", 600),
+            builtin=builtin,
+        )
+
+    def add(self, text, source="run", replace=True):
+        """Add an example transcript starting with a "Task:" line; one example is kept per task."""
+        task = example_task(text)
+        example_id = hashlib.sha1(" ".join(task.lower().split()).encode("utf-8")).hexdigest()[:16]
+        with self._lock:
+            exists = self._conn.execute("SELECT 1 FROM examples WHERE id = ?", (example_id,)).fetchone() is not None
+            if exists and not replace:
+                return example_id
+            self._conn.execute("BEGIN")
+            try:
+                if exists:
+                    self._conn.execute("DELETE FROM example_index WHERE id = ?", (example_id,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO examples (id, task, body, source, tokens, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (example_id, task, text, source, count_tokens(text), time.time()),
+                )
+                self._conn.execute("INSERT INTO example_index (id, task, body) VALUES (?, ?, ?)", (example_id, task, text))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return example_id
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM examples").fetchone()[0]
+
+    def search(self, text, limit=20):
+        """(task, body, tokens) of the best matches for text, best first."""
+        query = build_query(text)
+        if query == "":
+            return []
+        with self._lock:
+            return self._conn.execute(
+                "SELECT e.task, e.body, e.tokens FROM example_index JOIN examples e ON e.id = example_index.id "
+                "WHERE example_index MATCH ? ORDER BY bm25(example_index, 0.0, 4.0, 1.0) LIMIT ?",
+                (query, limit),
+            ).fetchall()
+
+    def select(self, text, top_k=None, token_budget=None):
+        """The top_k best matching examples that fit in token_budget together, joined for the prompt."""
+        top_k = self.top_k if top_k is None else top_k
+        token_budget = self.token_budget if token_budget is None else token_budget
+        chosen = []
+        used = 0
+        for task, body, tokens in self.search(text, limit=top_k * 5):
+            if used + tokens > token_budget:
+                continue
+            chosen.append(body)
+            used += tokens
+            if len(chosen) >= top_k:
+                break
+        logger.debug("Selected {} examples ({} tokens)".format(len(chosen), used))
+        return "\n".join(chosen)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
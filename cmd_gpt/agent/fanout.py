@@ -0,0 +1,116 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import time
+
+from loguru import logger
+from pydantic import BaseModel
+
+from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent, add_shared_models
+from cmd_gpt.tool.basic.ask import AskChannel
+from cmd_gpt.tool.terminal import async_setup_terminal_tool
+from cmd_gpt.tool.terminal.common import line_is_cmd_prompt
+
+
+class HostResult(BaseModel):
+    host: str
+    status: str # "done", "max_steps" or "error"
+    steps: int = 0
+    duration: float = 0.0
+    last_observation: str = ""
+    error: str = ""
+
+
+def load_hosts(hosts):
+    """Hosts as a list, a comma separated string, or a file with one host per line."""
+    if isinstance(hosts, (list, tuple)):
+        return [str(h).strip() for h in hosts if str(h).strip() != ""]
+    try:
+        with open(hosts, "r") as f:
+            lines = f.read().split("\n")
+    except OSError:
+        lines = hosts.split(",")
+    return [h.strip() for h in lines if h.strip() != "" and not h.strip().startswith("#")]
+
+
+async def arun_host(config, host, task_template, agent_kwargs):
+    start = time.monotonic()
+    agent = None
+    agent_kwargs = dict(agent_kwargs)
+    try:
+        cmd = await async_setup_terminal_tool(**agent_kwargs.pop("cmd_confg", {})) # its own terminal session
+        agent = DeploymentCmdAgent(config, cmd=cmd, **agent_kwargs)
+        result = await agent.arun(task_template.replace("{host}", host)) # other braces, e.g. awk '{print $1}', stay as they are
+        return HostResult(
+            host=host,
+            status=result.status,
+            steps=result.steps,
+            duration=time.monotonic() - start,
+            last_observation=result.last_observation,
+        )
+    except Exception as e:
+        logger.exception("Host {} failed".format(host))
+        return HostResult(host=host, status="error", duration=time.monotonic() - start, error=str(e))
+    finally:
+        if agent is not None:
+            agent.close()
+
+
+async def arun_fanout(config, hosts, task_template, concurrency=8, agent_kwargs=None):
+    """
+    Run task_template ({host} replaced by the host) on every host, each in its
+    own terminal session and agent loop, at most concurrency at a time. All
+    agents share the running event loop and the LLM clients.
+    """
+    hosts = load_hosts(hosts)
+    agent_kwargs = add_shared_models(config, dict(agent_kwargs or {}))
+    ask_channel = None
+    if "ask_channel" not in agent_kwargs: # one reader of stdin for every host's questions
+        ask_channel = agent_kwargs["ask_channel"] = AskChannel.from_config(config)
+    semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+
+    async def run_one(host):
+        async with semaphore:
+            return await arun_host(config, host, task_template, agent_kwargs)
+
+    try:
+        return await asyncio.gather(*[run_one(host) for host in hosts])
+    finally:
+        if ask_channel is not None:
+            ask_channel.close()
+
+
+def run_fanout(config, hosts, task_template, concurrency=8, agent_kwargs=None):
+    return asyncio.run(arun_fanout(config, hosts, task_template, concurrency, agent_kwargs))
+
+
+def _last_line(text):
+    lines = [line.strip() for line in text.split("\n") if line.strip() != "" and not line_is_cmd_prompt(line)]
+    return lines[-1] if len(lines) > 0 else ""
+
+
+def format_result_table(results, max_observation_width=60):
+    rows = [["HOST", "STATUS", "STEPS", "DURATION", "LAST OUTPUT"]]
+    for r in results:
+        rows.append([
+            r.host,
+            r.status,
+            str(r.steps),
+            "{:.1f}s".format(r.duration),
+            (r.error or _last_line(r.last_observation))[:max_observation_width],
+        ])
+    widths = [max(len(row[k]) for row in rows) for k in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(widths[k]) for k, cell in enumerate(row)).rstrip() for row in rows)
@@ -0,0 +1,116 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+
+from cmd_gpt.llm.tokens import count_tokens
+from cmd_gpt.tool.terminal.common import ANSI_ESCAPE
+
+DEFAULT_IMPORTANT_PATTERNS = [
+    r"error", r"fail", r"fatal", r"warn", r"denied", r"not found", r"cannot", r"can't", r"unable",
+    r"traceback", r"exception", r"^\s*E: ", r"exit (?:code|status)",
+]
+
+# lines that only differ in numbers (progress, counters, timestamps) count as near-identical
+DIGITS = re.compile(r"\d+")
+
+
+def clean_output(text):
+    """Strip ANSI codes and keep only the last redraw of carriage-return progress lines."""
+    text = ANSI_ESCAPE.sub("", text).replace("\r\n", "\n")
+    if "\r" not in text:
+        return text
+    return "\n".join(line.rstrip("\r").split("\r")[-1] for line in text.split("\n"))
+
+
+def collapse_repeats(lines):
+    """Collapse runs of identical or near-identical lines into the last one of the run plus a count."""
+    collapsed = []
+    prev_key = None
+    for line in lines:
+        key = DIGITS.sub("#", line.strip())
+        if key == prev_key:
+            collapsed[-1][0] = line
+            collapsed[-1][1] += 1
+        else:
+            collapsed.append([line, 1])
+            prev_key = key
+    return [line if count == 1 else "{} [x{} similar lines]".format(line, count) for line, count in collapsed]
+
+
+class ObservationCompressor:
+    """
+    Shrink command output to a per-observation token budget before it goes into
+    the scratchpad.
+
+    Output within budget is only cleaned (ANSI codes, progress redraws). Larger
+    output has repeated lines collapsed, then keeps head_lines from the start,
+    tail_lines from the end and up to max_important_lines in between that look
+    like errors or warnings; these are halved until the result fits. Every
+    stage is a single pass over the lines.
+    """
+    def __init__(self, token_budget=500, head_lines=10, tail_lines=20, max_important_lines=20, important_patterns=None, model_name="gpt-3.5-turbo"):
+        self.token_budget = token_budget
+        self.head_lines = head_lines
+        self.tail_lines = tail_lines
+        self.max_important_lines = max_important_lines
+        self.model_name = model_name
+        patterns = DEFAULT_IMPORTANT_PATTERNS + list(important_patterns or [])
+        self.important = re.compile("|".join("(?:" + p + ")" for p in patterns), re.IGNORECASE)
+
+    def fits(self, text):
+        # cheap upper bound first: a token is at least one character
+        return len(text) <= self.token_budget or count_tokens(text, self.model_name) <= self.token_budget
+
+    def select(self, lines, head, tail, max_important):
+        if len(lines) <= head + tail:
+            return lines
+        middle = range(head, len(lines) - tail)
+        important = [i for i in middle if self.important.search(lines[i])]
+        if len(important) > max_important: # keep the first and the last ones
+            important = important[:max_important // 2] + important[len(important) - (max_important - max_important // 2):]
+
+        selected = []
+        last = -1
+        for i in list(range(head)) + important + list(range(len(lines) - tail, len(lines))):
+            if i - last > 1:
+                selected.append("...({} lines omitted)".format(i - last - 1))
+            selected.append(lines[i])
+            last = i
+        return selected
+
+    def compress(self, text):
+        if not text:
+            return text
+        text = clean_output(text)
+        if self.fits(text):
+            return text
+
+        lines = collapse_repeats(text.split("\n"))
+        head, tail, max_important = self.head_lines, self.tail_lines, self.max_important_lines
+        while True:
+            compressed = "\n".join(self.select(lines, head, tail, max_important))
+            if self.fits(compressed) or (head <= 1 and tail <= 1 and max_important == 0):
+                break
+            head, tail, max_important = max(head // 2, 1), max(tail // 2, 1), max_important // 2
+
+        if not self.fits(compressed): # a few very long lines, cut characters from the middle until it fits
+            full, keep = compressed, self.token_budget * 2
+            while True:
+                compressed = full[:keep] + "\n...(truncated)...\n" + full[-keep:]
+                if self.fits(compressed) or keep <= 1:
+                    break
+                keep //= 2
+        return compressed
@@ -0,0 +1,249 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import re
+import time
+from typing import List
+
+from loguru import logger
+from pydantic import BaseModel
+
+from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent, add_shared_models
+from cmd_gpt.agent.fanout import _last_line
+from cmd_gpt.tool.basic.ask import AnswerCache, AskChannel
+from cmd_gpt.tool.terminal import async_setup_terminal_tool
+
+PLAN_TEMPLATE = """You are planning a deployment task for a team of engineers. Each engineer works on one subtask in their own terminal on the same machine, all at the same time.
+Split the task into subtasks that can each be finished on their own. A subtask lists the subtasks that must be finished before it can start; subtasks that do not need each other must not depend on each other, so they run in parallel. A task that is one piece of work stays one subtask.
+
+Answer with one line per subtask and nothing else:
+<id>: <subtask> (after: <ids>)
+
+Example:
+Task: Set up a postgres backed app behind nginx
+1: Install and start postgres
+2: Install and start nginx
+3: Create the app database and its user in postgres (after: 1)
+4: Configure nginx as a reverse proxy to the app on port 8000 (after: 2)
+
+Task: {task}
+"""
+
+PLAN_LINE = re.compile(r"^\s*[-*]?\s*([\w-]+)\s*[:.)]\s+(.+?)(?:\s*\((?:after|depends on)\s*:?\s*([^)]*)\))?\s*$", re.IGNORECASE)
+
+SUBTASK_CONTEXT = ("{subtask}\n(This is one part of: {task}. Other parts run at the same time in other terminals on this machine, "
+                   "so if a package manager lock is held, wait a little and retry.{done})")
+
+
+class Subtask(BaseModel):
+    id: str
+    task: str
+    after: List[str] = []
+
+
+class SubtaskResult(BaseModel):
+    id: str
+    task: str
+    after: List[str] = []
+    status: str # "done", "max_steps", "error" or "skipped" when a prerequisite did not finish
+    steps: int = 0
+    started: float = 0.0 # seconds after the plan started
+    duration: float = 0.0
+    last_observation: str = ""
+    error: str = ""
+
+
+class PlanResult(BaseModel):
+    task: str
+    status: str # "done" when every subtask is done
+    subtasks: List[SubtaskResult] = []
+    planning_seconds: float = 0.0
+    elapsed: float = 0.0
+
+    def critical_path(self):
+        """Seconds along the slowest chain of dependent subtasks."""
+        by_id = {r.id: r for r in self.subtasks}
+        finish = {}
+
+        def finish_time(r):
+            if r.id not in finish:
+                finish[r.id] = r.duration + max([finish_time(by_id[d]) for d in r.after if d in by_id] or [0.0])
+            return finish[r.id]
+        return max([finish_time(r) for r in self.subtasks] or [0.0])
+
+    def serial_seconds(self):
+        return sum(r.duration for r in self.subtasks)
+
+
+def parse_plan(output, task):
+    """
+    Subtasks from the planning response, in order. Dependencies on unknown ids
+    are dropped. A response without any subtask line plans the whole task as
+    one subtask; a dependency cycle raises ValueError.
+    """
+    subtasks, ids = [], set()
+    for line in output.split("\n"):
+        m = PLAN_LINE.match(line)
+        if m is None or m.group(1).lower() == "task" or m.group(1) in ids:
+            continue
+        after = [d.strip() for d in re.split(r"[,\s]+", m.group(3) or "") if d.strip() != ""]
+        subtasks.append(Subtask(id=m.group(1), task=m.group(2).strip(), after=after))
+        ids.add(m.group(1))
+    if len(subtasks) == 0:
+        return [Subtask(id="1", task=task)]
+    for subtask in subtasks:
+        unknown = [d for d in subtask.after if d not in ids or d == subtask.id]
+        if len(unknown) > 0:
+            logger.warning("Subtask {} depends on unknown subtasks {}, ignoring them".format(subtask.id, unknown))
+            subtask.after = [d for d in subtask.after if d not in unknown]
+    check_acyclic(subtasks)
+    return subtasks
+
+
+def check_acyclic(subtasks):
+    remaining = {s.id: set(s.after) for s in subtasks}
+    while len(remaining) > 0:
+        ready = [k for k, after in remaining.items() if len(after) == 0]
+        if len(ready) == 0:
+            raise ValueError("The plan has a dependency cycle between subtasks {}".format(", ".join(sorted(remaining))))
+        for k in ready:
+            del remaining[k]
+        for after in remaining.values():
+            after.difference_update(ready)
+
+
+def format_plan(subtasks):
+    return "\n".join("{}: {}{}".format(s.id, s.task, " (after: {})".format(", ".join(s.after)) if s.after else "") for s in subtasks)
+
+
+async def aplan(task, llm):
+    prompt = PLAN_TEMPLATE.format(task=task)
+    if hasattr(llm, "apredict"):
+        output = await llm.apredict(prompt)
+    else:
+        output = await asyncio.to_thread(llm.predict, prompt)
+    logger.debug("="*10 + "plan" + "="*10 + "\n" + output + "\n" + "="*10 + "\n")
+    try:
+        return parse_plan(output, task)
+    except ValueError as e:
+        logger.warning("{}, running the task as a whole".format(e))
+        return [Subtask(id="1", task=task)]
+
+
+async def make_subtask_agent(config, subtask, agent_kwargs):
+    # its own terminal session; the LLM clients, router tiers, ask channel and answers are shared
+    agent_kwargs = dict(agent_kwargs)
+    cmd = await async_setup_terminal_tool(**agent_kwargs.pop("cmd_confg", {}))
+    return DeploymentCmdAgent(config, cmd=cmd, **agent_kwargs)
+
+
+async def arun_subtask(config, task, subtask, finished, start, agent_kwargs, make_agent):
+    started = time.monotonic()
+    done = [finished[d].task for d in subtask.after]
+    task_info = SUBTASK_CONTEXT.format(subtask=subtask.task, task=task, done=" Already done: " + "; ".join(done) + "." if done else "")
+    agent = None
+    try:
+        agent = await make_agent(config, subtask, agent_kwargs)
+        result = await agent.arun(task_info)
+        return SubtaskResult(
+            id=subtask.id, task=subtask.task, after=subtask.after, status=result.status, steps=result.steps,
+            started=started - start, duration=time.monotonic() - started, last_observation=result.last_observation,
+        )
+    except Exception as e:
+        logger.exception("Subtask {} failed".format(subtask.id))
+        return SubtaskResult(id=subtask.id, task=subtask.task, after=subtask.after, status="error",
+                             started=started - start, duration=time.monotonic() - started, error=str(e))
+    finally:
+        if agent is not None:
+            agent.close()
+
+
+async def arun_plan(config, task, concurrency=4, agent_kwargs=None, subtasks=None, make_agent=make_subtask_agent):
+    """
+    Plan the task as a graph of subtasks with one LLM call, then run each
+    subtask as its own agent loop and terminal session as soon as everything
+    it depends on is done, at most concurrency at a time. Subtasks after one
+    that did not finish are skipped.
+    """
+    start = time.monotonic()
+    agent_kwargs = dict(agent_kwargs or {})
+    add_shared_models(config, agent_kwargs)
+    ask_channel = None
+    if "ask_channel" not in agent_kwargs: # one reader of stdin for every subtask's questions
+        ask_channel = agent_kwargs["ask_channel"] = AskChannel.from_config(config)
+    agent_kwargs.setdefault("answers", AnswerCache())
+
+    if subtasks is None:
+        subtasks = await aplan(task, agent_kwargs["llm"])
+    planning_seconds = time.monotonic() - start
+    logger.info("Plan:\n" + format_plan(subtasks))
+
+    semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+    finished, running = {}, {}
+
+    async def run_one(subtask):
+        async with semaphore:
+            return await arun_subtask(config, task, subtask, finished, start, agent_kwargs, make_agent)
+
+    try:
+        while len(finished) < len(subtasks):
+            for subtask in subtasks:
+                if subtask.id in finished or subtask.id in running or any(d not in finished for d in subtask.after):
+                    continue
+                failed = [d for d in subtask.after if finished[d].status != "done"]
+                if len(failed) > 0:
+                    logger.info("Skipping subtask {}: {} did not finish".format(subtask.id, ", ".join(failed)))
+                    finished[subtask.id] = SubtaskResult(id=subtask.id, task=subtask.task, after=subtask.after, status="skipped",
+                                                         started=time.monotonic() - start, error="after " + ", ".join(failed))
+                    continue
+                logger.info("Starting subtask {}: {}".format(subtask.id, subtask.task))
+                running[subtask.id] = asyncio.ensure_future(run_one(subtask))
+            if len(running) == 0: # skips may have unblocked other subtasks
+                continue
+            done, _ = await asyncio.wait(list(running.values()), return_when=asyncio.FIRST_COMPLETED)
+            for subtask_id in [k for k, t in running.items() if t in done]:
+                finished[subtask_id] = running.pop(subtask_id).result()
+                logger.info("Subtask {} {} in {:.1f}s".format(subtask_id, finished[subtask_id].status, finished[subtask_id].duration))
+    finally:
+        for t in running.values():
+            t.cancel()
+        if ask_channel is not None:
+            ask_channel.close()
+
+    results = [finished[s.id] for s in subtasks]
+    return PlanResult(
+        task=task,
+        status="done" if all(r.status == "done" for r in results) else "incomplete",
+        subtasks=results,
+        planning_seconds=planning_seconds,
+        elapsed=time.monotonic() - start,
+    )
+
+
+def run_plan(config, task, concurrency=4, agent_kwargs=None):
+    return asyncio.run(arun_plan(config, task, concurrency, agent_kwargs))
+
+
+def format_plan_report(result, max_observation_width=60):
+    rows = [["ID", "AFTER", "STATUS", "STEPS", "START", "DURATION", "SUBTASK / LAST OUTPUT"]]
+    for r in result.subtasks:
+        rows.append([r.id, ",".join(r.after) or "-", r.status, str(r.steps), "{:.1f}s".format(r.started), "{:.1f}s".format(r.duration), r.task[:max_observation_width]])
+        last = r.error or _last_line(r.last_observation)
+        if last:
+            rows.append(["", "", "", "", "", "", "  " + last[:max_observation_width]])
+    widths = [max(len(row[k]) for row in rows) for k in range(len(rows[0]))]
+    table = "\n".join("  ".join(cell.ljust(widths[k]) for k, cell in enumerate(row)).rstrip() for row in rows)
+    return table + "\n{}: {} subtasks in {:.1f}s (planning {:.1f}s, critical path {:.1f}s, {:.1f}s one after another)".format(
+        result.status, len(result.subtasks), result.elapsed, result.planning_seconds, result.critical_path(), result.serial_seconds())
@@ -0,0 +1,217 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from typing import List
+
+from loguru import logger
+from pydantic import BaseModel
+
+from cmd_gpt.compat import model_dump
+from cmd_gpt.llm.router import DEFAULT_ERROR_PATTERNS
+from cmd_gpt.tool.terminal.common import last_non_empty_line, line_is_cmd_prompt, line_is_question
+
+DEFAULT_PLAYBOOK_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cmd_gpt", "playbooks")
+
+# task words that are never parameters, even when they also appear in a command
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "on", "in", "at", "to", "for", "from", "with", "by", "as", "is", "are", "be",
+    "it", "its", "this", "that", "these", "those", "my", "our", "your", "all", "if", "not", "no", "then", "there",
+    "make", "sure", "check", "ensure", "verify", "install", "installed", "remove", "uninstall", "update", "upgrade",
+    "start", "stop", "restart", "enable", "disable", "run", "create", "delete", "set", "get", "show", "list", "find",
+    "machine", "host", "server", "service", "package", "file", "user", "username", "password", "using", "via", "into",
+}
+
+TASK_TOKEN = re.compile(r"[\w.@:/~+-]+")
+ERROR_REGEX = re.compile("|".join("(?:{})".format(p) for p in DEFAULT_ERROR_PATTERNS), re.IGNORECASE | re.MULTILINE)
+
+
+def _escape_braces(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def _loose(line):
+    # compare lines modulo numbers (pids, sizes, counters)
+    return re.sub(r"\d+", "#", line.strip())
+
+
+def observation_kind(obs):
+    line = last_non_empty_line((obs or "").split("\n")).strip()
+    if line_is_question(line):
+        return "question", line
+    if line_is_cmd_prompt(line):
+        return "prompt", line
+    return "output", line
+
+
+class PlaybookStep(BaseModel):
+    action: str
+    action_input: str = "" # a format string over the playbook params and earlier ask answers (ask0, ask1, ...)
+    expect_kind: str = "any" # "prompt", "question", "output" or "any"
+    expect_line: str = "" # the question expected after the step, a format string like action_input
+    expect_error: bool = False
+
+
+class Playbook(BaseModel):
+    """
+    A successful run, parameterized by the task words that also appear in its
+    commands, that can be replayed against the terminal without the LLM.
+    """
+    task_template: str
+    params: List[str] = []
+    steps: List[PlaybookStep] = []
+    uses: int = 0
+    created: float = 0.0
+
+    @property
+    def key(self):
+        return hashlib.sha1(self.task_template.lower().encode("utf-8")).hexdigest()[:16]
+
+    def literal_length(self):
+        return len(re.sub(r"\{p\d+\}", "", self.task_template))
+
+    def match(self, task):
+        """The params for task, or None if it does not fit the template."""
+        # doubled braces are literal ones, split off first so "{{p0}}" is not a param
+        parts = re.split(r"(\{\{|\}\}|\{p\d+\})", self.task_template)
+        pattern = ""
+        for part in parts:
+            m = re.fullmatch(r"\{(p\d+)\}", part)
+            if m:
+                pattern += r"(?P<{}>\S+?)".format(m.group(1))
+            else:
+                part = part.replace("{{", "{").replace("}}", "}")
+                pattern += r"\s+".join(re.escape(w) for w in part.split(" "))
+        m = re.fullmatch(pattern, " ".join(task.split()), re.IGNORECASE)
+        if m is None:
+            return None
+        return m.groupdict()
+
+    def render(self, template, params, answers):
+        return template.format(**params, **answers)
+
+    def step_matches(self, step, obs, params, answers):
+        if step.expect_kind == "any":
+            return True
+        kind, line = observation_kind(obs)
+        if kind != step.expect_kind:
+            return False
+        if (ERROR_REGEX.search(obs or "") is not None) != step.expect_error:
+            return False
+        if kind == "question":
+            return _loose(line) == _loose(self.render(step.expect_line, params, answers))
+        return True
+
+
+def make_playbook(task, trace):
+    """
+    Build a playbook from the (action, action_input, observation) trace of a
+    successful run. Task words that also appear in an action input become the
+    params p0, p1, ...; answers to ask are referenced as ask0, ask1, ... and
+    never stored.
+    """
+    task = " ".join(task.split())
+    inputs = " ".join(action_input for _, action_input, _ in trace)
+    values = []
+    for token in TASK_TOKEN.findall(task):
+        token = token.rstrip(".:,")
+        if len(token) < 2 or token.lower() in STOPWORDS or token in values:
+            continue
+        if re.search(r"(?<![\w-])" + re.escape(token) + r"(?![\w-])", inputs):
+            values.append(token)
+    # longer values first so "10.0.0.1" does not eat part of "10.0.0.12"
+    substitutions = sorted([(v, "{p" + str(k) + "}") for k, v in enumerate(values)], key=lambda s: -len(s[0]))
+
+    def parameterize(text, answers=()):
+        text = _escape_braces(text)
+        for answer, placeholder in answers:
+            if text == _escape_braces(answer) or (len(answer) >= 4 and _escape_braces(answer) in text):
+                text = text.replace(_escape_braces(answer), placeholder)
+        for value, placeholder in substitutions:
+            text = re.sub(r"(?<![\w-])" + re.escape(_escape_braces(value)) + r"(?![\w-])", placeholder, text)
+        return text
+
+    steps = []
+    answers = []
+    for action, action_input, obs in trace:
+        step = PlaybookStep(action=action, action_input=parameterize(action_input, answers))
+        if action == "ask":
+            if obs.strip() != "":
+                answers.append((obs.strip(), "{ask" + str(len(answers)) + "}"))
+        else:
+            step.expect_kind, line = observation_kind(obs)
+            step.expect_error = ERROR_REGEX.search(obs or "") is not None
+            if step.expect_kind == "question":
+                step.expect_line = parameterize(line, answers)
+        steps.append(step)
+
+    return Playbook(
+        task_template=parameterize(task),
+        params=["p" + str(k) for k in range(len(values))],
+        steps=steps,
+        created=time.time(),
+    )
+
+
+class PlaybookStore:
+    """One JSON file per playbook, keyed by the task template."""
+    def __init__(self, path=DEFAULT_PLAYBOOK_DIR, min_literal_words=2):
+        self.path = path
+        self.min_literal_words = min_literal_words
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        # replay is opt-in: it runs recorded commands without asking the LLM
+        path = config.get("PLAYBOOK_DIR")
+        if not path:
+            return None
+        return cls(os.path.expanduser(path))
+
+    def load(self):
+        playbooks = []
+        for path in sorted(glob.glob(os.path.join(self.path, "*.json"))):
+            try:
+                with open(path, "r") as f:
+                    playbooks.append(Playbook(**json.load(f)))
+            except (OSError, ValueError) as e:
+                logger.warning("Skipping playbook {}: {}".format(path, e))
+        return playbooks
+
+    def find(self, task):
+        """The most specific playbook matching task and its params, or (None, None)."""
+        best, best_params = None, None
+        for playbook in self.load():
+            if len(re.sub(r"\{p\d+\}", " ", playbook.task_template).split()) < self.min_literal_words:
+                continue
+            params = playbook.match(task)
+            if params is None:
+                continue
+            if best is None or (playbook.literal_length(), playbook.created) > (best.literal_length(), best.created):
+                best, best_params = playbook, params
+        return best, best_params
+
+    def save(self, playbook):
+        path = os.path.join(self.path, playbook.key + ".json")
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(model_dump(playbook), f, indent=2)
+        os.replace(tmp, path)
+        return path
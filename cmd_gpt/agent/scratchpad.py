@@ -0,0 +1,129 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from collections import deque
+
+from pydantic import BaseModel
+
+from cmd_gpt.llm.tokens import count_tokens
+
+
+class ScratchpadRound(BaseModel):
+    observation_action: str
+    observation: str
+    analysis: str = ""
+    plan: str = ""
+    action: str = ""
+
+    @property
+    def has_response(self):
+        return self.analysis != "" or self.plan != "" or self.action != ""
+
+    @property
+    def action_summary(self):
+        # one or more "E: ..." lines as a single line
+        return ", ".join(line[2:].strip() for line in self.action.split("\n"))
+
+    def render(self):
+        text = "M: " + self.observation_action + ": " + self.observation + "\n"
+        if self.has_response:
+            text += self.analysis + "\n" + self.plan + "\n" + self.action + "\n\n"
+        return text
+
+
+class Scratchpad:
+    """
+    Bounded MAPE history.
+
+    Rounds (observation, then the analysis/plan/action taken on it) are kept in a
+    ring buffer of max_rounds records. Rendering shows the newest rounds verbatim,
+    at most max_verbatim_rounds of them and within token_budget tokens; everything
+    older is compacted into a one-line summary of the actions taken. Each finished
+    round is rendered and measured once.
+    """
+    def __init__(self, max_verbatim_rounds=3, token_budget=1500, max_rounds=20, max_summary_actions=10, model_name="gpt-3.5-turbo"):
+        self.max_verbatim_rounds = max_verbatim_rounds
+        self.token_budget = token_budget
+        self.model_name = model_name
+        self.rounds = deque(maxlen=max_rounds)
+        self._evicted_count = 0
+        self._evicted_actions = deque(maxlen=max_summary_actions)
+        self.max_summary_actions = max_summary_actions
+
+    def __len__(self):
+        return self._evicted_count + len(self.rounds)
+
+    def last_observation(self):
+        # the last non-empty observation, the no-op round after "E: end" has none
+        for entry in reversed(self.rounds):
+            if entry[0].observation.strip() != "":
+                return entry[0].observation
+        return ""
+
+    def add_observation(self, observation_action, observation):
+        if len(self.rounds) == self.rounds.maxlen:
+            evicted = self.rounds[0][0]
+            self._evicted_count += 1
+            if evicted.action:
+                self._evicted_actions.append(evicted.action_summary)
+        record = ScratchpadRound(observation_action=observation_action, observation=observation)
+        self.rounds.append([record, None, 0])
+
+    def set_response(self, analysis, plan, action):
+        entry = self.rounds[-1]
+        record = entry[0]
+        record.analysis = analysis
+        record.plan = plan
+        record.action = action
+        entry[1] = record.render()
+        entry[2] = count_tokens(entry[1], self.model_name)
+
+    def _rendered(self, entry):
+        if entry[1] is None: # the newest round may still be waiting for its response
+            text = entry[0].render()
+            return text, count_tokens(text, self.model_name)
+        return entry[1], entry[2]
+
+    def transcript(self):
+        """The full history with responses, or None once rounds have been evicted."""
+        if self._evicted_count > 0:
+            return None
+        return "".join(entry[0].render() for entry in self.rounds if entry[0].has_response)
+
+    def summary(self, hidden_rounds):
+        count = self._evicted_count + len(hidden_rounds)
+        if count == 0:
+            return ""
+        actions = list(self._evicted_actions) + [r.action_summary for r in hidden_rounds if r.action]
+        actions = actions[-self.max_summary_actions:]
+        summary = "(Earlier: {} rounds compacted".format(count)
+        if len(actions) > 0:
+            summary += "; last actions: " + " -> ".join(actions)
+        return summary + ")\n"
+
+    def render(self):
+        texts = []
+        used_tokens = 0
+        shown = 0
+        for entry in reversed(self.rounds):
+            text, tokens = self._rendered(entry)
+            if shown > 0 and (shown >= self.max_verbatim_rounds or used_tokens + tokens > self.token_budget):
+                break
+            texts.append(text)
+            used_tokens += tokens
+            shown += 1
+
+        hidden_rounds = [entry[0] for entry in list(self.rounds)[:len(self.rounds) - shown]]
+        return self.summary(hidden_rounds) + "".join(reversed(texts))
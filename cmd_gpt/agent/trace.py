@@ -0,0 +1,362 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+from loguru import logger
+
+
+DEFAULT_TRACE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "cmd_gpt", "traces.sqlite")
+
+STEP_TIMINGS = ["render_seconds", "llm_seconds", "tool_seconds", "sleep_seconds", "terminal_wait_seconds"]
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def fts_phrases(text):
+    # "a b|c d" matches either phrase
+    phrases = ['"' + p.strip().replace('"', '""') + '"' for p in text.split("|") if p.strip() != ""]
+    return " OR ".join(phrases)
+
+
+class TraceStore:
+    """
+    Every agent run recorded step by step in SQLite: the task, each step's prompt
+    hash, LLM output, actions with their inputs and observations, and timings.
+
+    Steps are written as the run goes, so a run that hangs or is interrupted is
+    still there, with its last action lacking an observation. Tasks, action
+    inputs and observations are full-text indexed (FTS5), so finding every run
+    where a command printed some error takes milliseconds over months of runs.
+    """
+    def __init__(self, path=DEFAULT_TRACE_PATH, retention_days=0):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "id TEXT PRIMARY KEY, task TEXT, status TEXT, started REAL, elapsed REAL, steps INTEGER, "
+            "llm_calls INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, initial_observation TEXT);"
+            "CREATE INDEX IF NOT EXISTS runs_started ON runs(started);"
+            "CREATE INDEX IF NOT EXISTS runs_elapsed ON runs(elapsed);"
+            "CREATE TABLE IF NOT EXISTS steps ("
+            "run_id TEXT, step INTEGER, prompt_hash TEXT, model TEXT, output TEXT, render_seconds REAL, llm_seconds REAL, "
+            "tool_seconds REAL, sleep_seconds REAL, terminal_wait_seconds REAL, prompt_tokens INTEGER, completion_tokens INTEGER, "
+            "PRIMARY KEY (run_id, step));"
+            "CREATE TABLE IF NOT EXISTS actions ("
+            "id INTEGER PRIMARY KEY, run_id TEXT, step INTEGER, k INTEGER, action TEXT, input TEXT, observation TEXT);"
+            "CREATE INDEX IF NOT EXISTS actions_step ON actions(run_id, step);"
+            "CREATE INDEX IF NOT EXISTS actions_action ON actions(action, run_id);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS run_index USING fts5(task);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS action_index USING fts5(input, observation);"
+        )
+        if retention_days and float(retention_days) > 0:
+            self.prune(float(retention_days))
+
+    @classmethod
+    def from_config(cls, config):
+        path = config.get("TRACE_DB") # tracing is opt-in: transcripts hold whatever the terminal printed
+        if path is None or str(path).lower() in ["off", "none", ""]:
+            return None
+        return cls(os.path.expanduser(path), retention_days=config.get("TRACE_RETENTION_DAYS", 90))
+
+    @contextlib.contextmanager
+    def _write(self):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def start_run(self, task, initial_observation="", run_id=None):
+        run_id = run_id or time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6] # sorts by start time
+        with self._write():
+            cursor = self._conn.execute(
+                "INSERT INTO runs (id, task, status, started, elapsed, steps, initial_observation) VALUES (?, ?, 'running', ?, 0, 0, ?)",
+                (run_id, task, time.time(), initial_observation),
+            )
+            self._conn.execute("INSERT INTO run_index (rowid, task) VALUES (?, ?)", (cursor.lastrowid, task))
+        return run_id
+
+    def add_step(self, run_id, step, prompt_hash, model, output, actions):
+        # actions are (action, input); their observations come with finish_step
+        with self._write():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps (run_id, step, prompt_hash, model, output) VALUES (?, ?, ?, ?, ?)",
+                (run_id, step, prompt_hash, model, output),
+            )
+            for k, (action, action_input) in enumerate(actions):
+                cursor = self._conn.execute(
+                    "INSERT INTO actions (run_id, step, k, action, input) VALUES (?, ?, ?, ?, ?)",
+                    (run_id, step, k, action, action_input),
+                )
+                self._conn.execute("INSERT INTO action_index (rowid, input) VALUES (?, ?)", (cursor.lastrowid, action_input))
+            self._conn.execute("UPDATE runs SET steps = ? WHERE id = ?", (step + 1, run_id))
+
+    def finish_step(self, run_id, step, observations, metrics):
+        with self._write():
+            self._conn.execute(
+                "UPDATE steps SET {}, prompt_tokens = ?, completion_tokens = ? WHERE run_id = ? AND step = ?".format(
+                    ", ".join(t + " = ?" for t in STEP_TIMINGS)),
+                [getattr(metrics, t) for t in STEP_TIMINGS] + [metrics.prompt_tokens, metrics.completion_tokens, run_id, step],
+            )
+            rows = self._conn.execute("SELECT id, input FROM actions WHERE run_id = ? AND step = ? ORDER BY k", (run_id, step)).fetchall()
+            for row, obs in zip(rows, observations):
+                self._conn.execute("UPDATE actions SET observation = ? WHERE id = ?", (obs, row["id"]))
+                self._conn.execute("UPDATE action_index SET observation = ? WHERE rowid = ?", (obs, row["id"]))
+
+    def finish_run(self, run_id, status, result=None):
+        with self._write():
+            if result is None:
+                self._conn.execute("UPDATE runs SET status = ?, elapsed = ? - started WHERE id = ?", (status, time.time(), run_id))
+            else:
+                self._conn.execute(
+                    "UPDATE runs SET status = ?, elapsed = ?, steps = ?, llm_calls = ?, prompt_tokens = ?, completion_tokens = ? WHERE id = ?",
+                    (status, result.elapsed, result.steps, result.llm_calls, result.prompt_tokens, result.completion_tokens, run_id),
+                )
+
+    def query(self, task=None, action=None, command=None, output=None, min_seconds=None, max_seconds=None, slow_step=None, status=None, days=None, limit=20):
+        """
+        Runs matching every given filter, newest first. task, command (an action
+        input) and output (an observation) are phrases, "a|b" for either one;
+        action, command, output and slow_step (seconds in tools) must all hold
+        for the same action.
+        """
+        clauses, params = [], []
+        if task:
+            clauses.append("r.rowid IN (SELECT rowid FROM run_index WHERE run_index MATCH ?)")
+            params.append(fts_phrases(task))
+        if status:
+            clauses.append("r.status = ?")
+            params.append(status)
+        if min_seconds is not None:
+            clauses.append("r.elapsed >= ?")
+            params.append(float(min_seconds))
+        if max_seconds is not None:
+            clauses.append("r.elapsed <= ?")
+            params.append(float(max_seconds))
+        if days is not None:
+            clauses.append("r.started >= ?")
+            params.append(time.time() - float(days) * 86400)
+        matches = ["{} : ({})".format(column, fts_phrases(text)) for column, text in [("input", command), ("observation", output)] if text]
+        step_clauses, step_params = [], []
+        if action:
+            step_clauses.append("a.action = ?")
+            step_params.append(action)
+        if slow_step is not None:
+            step_clauses.append("EXISTS (SELECT 1 FROM steps s WHERE s.run_id = a.run_id AND s.step = a.step AND s.tool_seconds >= ?)")
+            step_params.append(float(slow_step))
+        if matches: # start from the few actions the full-text index finds
+            clauses.append("r.id IN (SELECT a.run_id FROM action_index f CROSS JOIN actions a ON a.id = f.rowid WHERE action_index MATCH ?{})".format(
+                "".join(" AND " + c for c in step_clauses)))
+            params += [" AND ".join(matches)] + step_params
+        elif step_clauses:
+            clauses.append("EXISTS (SELECT 1 FROM actions a WHERE a.run_id = r.id AND {})".format(" AND ".join(step_clauses)))
+            params += step_params
+        sql = "SELECT * FROM runs r"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY r.started DESC LIMIT ?"
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params + [int(limit)])]
+
+    def get_run(self, run_id):
+        # a unique prefix of the id is enough
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM runs WHERE id >= ? AND id < ? LIMIT 2", (run_id, run_id + "\uffff")).fetchall()
+            if len(rows) != 1:
+                return None
+            run = dict(rows[0])
+            run["steps"] = [dict(row) for row in self._conn.execute("SELECT * FROM steps WHERE run_id = ? ORDER BY step", (run["id"],))]
+            actions = self._conn.execute("SELECT step, action, input, observation FROM actions WHERE run_id = ? ORDER BY step, k", (run["id"],)).fetchall()
+        for step in run["steps"]:
+            step["actions"] = [dict(a) for a in actions if a["step"] == step["step"]]
+        return run
+
+    def prune(self, days):
+        cutoff = time.time() - days * 86400
+        with self._write():
+            old = "SELECT id FROM runs WHERE started < ?"
+            self._conn.execute("DELETE FROM action_index WHERE rowid IN (SELECT id FROM actions WHERE run_id IN ({}))".format(old), (cutoff,))
+            self._conn.execute("DELETE FROM actions WHERE run_id IN ({})".format(old), (cutoff,))
+            self._conn.execute("DELETE FROM steps WHERE run_id IN ({})".format(old), (cutoff,))
+            self._conn.execute("DELETE FROM run_index WHERE rowid IN (SELECT rowid FROM runs WHERE started < ?)", (cutoff,))
+            deleted = self._conn.execute("DELETE FROM runs WHERE started < ?", (cutoff,)).rowcount
+        if deleted > 0:
+            logger.info("Pruned {} traces older than {} days".format(deleted, days))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def format_runs(runs, max_task_width=60):
+    rows = [["RUN", "STARTED", "STATUS", "STEPS", "DURATION", "TASK"]]
+    for r in runs:
+        rows.append([
+            r["id"],
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(r["started"])),
+            r["status"],
+            str(r["steps"]),
+            "{:.1f}s".format(r["elapsed"] or 0.0),
+            r["task"][:max_task_width],
+        ])
+    widths = [max(len(row[k]) for row in rows) for k in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(widths[k]) for k, cell in enumerate(row)).rstrip() for row in rows)
+
+
+def _indent(text, prefix="    "):
+    return "\n".join(prefix + line for line in (text or "").strip("\n").split("\n"))
+
+
+def format_run(run):
+    lines = ["Run {} ({}, {} steps, {:.1f}s)".format(run["id"], run["status"], len(run["steps"]), run["elapsed"] or 0.0), "Task: " + run["task"]]
+    for step in run["steps"]:
+        lines.append("")
+        lines.append("Step {} [{}] prompt {} llm {:.2f}s tool {:.2f}s".format(
+            step["step"], step["model"], step["prompt_hash"] or "-", step["llm_seconds"] or 0.0, step["tool_seconds"] or 0.0))
+        if step["output"]:
+            lines.append(_indent(step["output"]))
+        for a in step["actions"]:
+            lines.append("  > {}[{}]".format(a["action"], a["input"]))
+            lines.append(_indent(a["observation"]) if a["observation"] is not None else "    (no observation)")
+    return "\n".join(lines)
+
+
+def _terminal_rule(action_input, observation):
+    # the recorded observation ends with the prompt (or question) the terminal showed
+    lines = [line[1:] if line.startswith("\t") else line for line in (observation or "").split("\n")]
+    while len(lines) > 0 and lines[0].strip() == "":
+        lines.pop(0)
+    rule = {"match": "^" + re.escape(action_input) + "$", "times": 1, "latency": 0.0}
+    if len(lines) > 0:
+        rule["output"] = "\n".join(lines[:-1])
+        rule["prompt"] = lines[-1]
+    return rule
+
+
+def trace_to_scenario(run):
+    """
+    A scenario for the simulated terminal and the scripted LLM that plays the run
+    back: the recorded LLM outputs in order, every terminal command answering
+    with its recorded observation, and the recorded replies of other tools.
+    """
+    responses, commands, replies = [], [], {}
+    for step in run["steps"]:
+        output = step["output"] or "\n".join("E: {}[{}]".format(a["action"], a["input"]) for a in step["actions"]) # playbook steps
+        responses.append(output)
+        for a in step["actions"]:
+            if a["observation"] is None:
+                continue
+            if a["action"] == "terminal_run":
+                commands.append(_terminal_rule(a["input"], a["observation"]))
+            elif a["action"] != "terminal_read":
+                replies.setdefault(a["action"], []).append(a["observation"])
+    initial = [line for line in (run["initial_observation"] or "").split("\n") if line.strip() != ""]
+    return {
+        "name": run["id"],
+        "task": run["task"],
+        "responses": responses,
+        "replies": replies,
+        "terminal": {"commands": commands, "prompt": initial[-1].lstrip("\t") if initial else "user@sim:~$ ", "default_latency": 0.0},
+        "max_steps": max(len(responses), 1),
+        "max_actions_per_step": max([len(s["actions"]) for s in run["steps"]] + [1]),
+    }
+
+
+def _recorded_reply(replies):
+    replies = list(replies)
+
+    async def reply(action_input):
+        return replies.pop(0) if len(replies) > 0 else ""
+    return reply
+
+
+def replay_run(run):
+    """
+    Feed a recorded run back through the agent (processing_output_multi and
+    the tool layer) against a simulated terminal, and compare the actions it
+    takes with the recorded ones. Returns (result, rows) with one (step, recorded, replayed)
+    row per action.
+    """
+    from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent
+    from cmd_gpt.llm.scripted import ScriptedLLM
+    from cmd_gpt.tool.terminal.simulated import SimulatedTerminal
+    from cmd_gpt.tool.terminal.spool import SpoolTools
+
+    scenario = trace_to_scenario(run)
+    terminal = SimulatedTerminal(**scenario["terminal"])
+    action_mapping = {
+        "terminal_run": terminal.async_run_command_and_get_reply,
+        "terminal_read": SpoolTools(terminal).read,
+    }
+    for action, replies in scenario["replies"].items():
+        action_mapping[action] = _recorded_reply(replies)
+    if "ask" not in action_mapping:
+        action_mapping["ask"] = _recorded_reply([])
+    agent = DeploymentCmdAgent(
+        {"EXAMPLE_DB": ":memory:", "TRACE_DB": "off"},
+        llm=ScriptedLLM(scenario["responses"]),
+        cmd=terminal,
+        max_steps=scenario["max_steps"],
+        max_actions_per_step=scenario["max_actions_per_step"],
+        action_mapping=action_mapping,
+        action_delay=0,
+    )
+    try:
+        result = agent.run(run["task"])
+    finally:
+        agent.close()
+
+    recorded = [(s["step"], a["action"], a["input"]) for s in run["steps"] for a in s["actions"] if a["observation"] is not None]
+    replayed = [(action, action_input) for action, action_input, _ in agent.trace]
+    rows = []
+    for k in range(max(len(recorded), len(replayed))):
+        step, action, action_input = recorded[k] if k < len(recorded) else (None, None, None)
+        rows.append((step, (action, action_input) if action is not None else None, replayed[k] if k < len(replayed) else None))
+    return result, rows
+
+
+def format_replay(result, rows):
+    lines = []
+    for step, recorded, replayed in rows:
+        mark = "ok  " if recorded == replayed else "DIFF"
+        if recorded == replayed:
+            lines.append("{} step {}: {}[{}]".format(mark, step, *recorded))
+        else:
+            lines.append("{} step {}: recorded {} replayed {}".format(
+                mark, step if step is not None else "-",
+                "{}[{}]".format(*recorded) if recorded else "nothing",
+                "{}[{}]".format(*replayed) if replayed else "nothing"))
+    diffs = sum(1 for _, recorded, replayed in rows if recorded != replayed)
+    lines.append("Replay {} after {} steps, {} of {} actions differ".format(result.status, result.steps, diffs, len(rows)))
+    return "\n".join(lines)
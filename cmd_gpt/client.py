@@ -0,0 +1,124 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Thin client for the agent daemon (python run.py daemon).
+
+    python -m cmd_gpt.client "install htop"
+
+Only the standard library is imported here so the client starts in a few
+milliseconds; the agent, the LLM client and the terminal stay warm in the
+daemon. Logs are streamed back, questions from the ask tool are answered
+on this terminal.
+
+    python -m cmd_gpt.client --answer
+
+answers the questions of an agent run with ASK_SOURCES including socket.
+"""
+
+import time
+
+CLIENT_START = time.time()
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".cache", "cmd_gpt", "daemon.sock")
+DEFAULT_ASK_SOCKET = os.path.join(os.path.expanduser("~"), ".cache", "cmd_gpt", "ask.sock")
+
+
+def send(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def run_task(task, socket_path=DEFAULT_SOCKET, options=None, quiet=False):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as e:
+        print("Cannot reach the agent daemon at {} ({}). Start it with: python run.py daemon".format(socket_path, e), file=sys.stderr)
+        return None
+    connected = time.time()
+
+    with sock, sock.makefile("r", encoding="utf-8") as replies:
+        send(sock, {"type": "run", "task": task, "options": options or {}})
+        for line in replies:
+            message = json.loads(line)
+            if message["type"] == "log":
+                if not quiet:
+                    sys.stderr.write(message["text"])
+            elif message["type"] == "ask":
+                print(message["question"])
+                send(sock, {"type": "answer", "text": input()})
+            elif message["type"] == "error":
+                print("Daemon error: " + message["error"], file=sys.stderr)
+                return None
+            elif message["type"] == "result":
+                result = message["result"]
+                first_llm = result["started_at"] + result["first_llm_latency"] if result["llm_calls"] > 0 else None
+                print("Startup: connected after {:.1f} ms{}".format(
+                    (connected - CLIENT_START) * 1000,
+                    ", first LLM call after {:.1f} ms".format((first_llm - CLIENT_START) * 1000) if first_llm else ""), file=sys.stderr)
+                return result
+    print("The agent daemon closed the connection.", file=sys.stderr)
+    return None
+
+
+def answer_questions(socket_path=DEFAULT_ASK_SOCKET):
+    """Answer an agent's questions (ASK_SOURCES with socket) from another terminal, until the agent goes away."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as e:
+        print("No agent is asking at {} ({}).".format(socket_path, e), file=sys.stderr)
+        return 1
+    with sock, sock.makefile("r", encoding="utf-8") as questions:
+        for line in questions:
+            message = json.loads(line)
+            if message["type"] == "ask":
+                print(message["question"])
+                send(sock, {"type": "answer", "id": message["id"], "text": input()})
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a task on the warm cmd_gpt agent daemon.")
+    parser.add_argument("task", nargs="?")
+    parser.add_argument("--socket", default=os.environ.get("CMD_GPT_SOCKET", DEFAULT_SOCKET))
+    parser.add_argument("--max_actions_per_step", type=int, default=None)
+    parser.add_argument("--quiet", action="store_true", help="do not print the agent's log")
+    parser.add_argument("--answer", action="store_true", help="answer the questions of a running agent instead of running a task")
+    parser.add_argument("--ask_socket", default=DEFAULT_ASK_SOCKET)
+    args = parser.parse_args(argv)
+    if args.answer:
+        return answer_questions(args.ask_socket)
+    if args.task is None:
+        parser.error("a task is required")
+
+    options = {}
+    if args.max_actions_per_step is not None:
+        options["max_actions_per_step"] = args.max_actions_per_step
+    result = run_task(args.task, args.socket, options, args.quiet)
+    if result is None:
+        return 1
+    print("{} in {} steps ({:.2f}s)".format(result["status"], result["steps"], result["elapsed"]))
+    return 0 if result["status"] == "done" else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# pydantic 2 renamed dict() and json() and warns on the old names; langchain
+# releases before 0.0.267 still pin pydantic 1, so both are supported
+
+
+def model_dump(model):
+    if hasattr(model, "model_dump"):
+        return model.model_dump()
+    return model.dict()
+
+
+def model_dump_json(model):
+    if hasattr(model, "model_dump_json"):
+        return model.model_dump_json()
+    return model.json()
@@ -0,0 +1,127 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import json
+import os
+import time
+
+from loguru import logger
+
+from cmd_gpt.client import DEFAULT_SOCKET
+from cmd_gpt.compat import model_dump_json
+
+
+class AgentDaemon:
+    """
+    Keeps one agent, its LLM client and its terminal warm behind a Unix socket.
+    Tasks from cmd_gpt.client are run one at a time on the shared terminal.
+
+    The protocol is one JSON object per line. The client sends
+    {"type": "run", "task": ..., "options": {...}} and the daemon streams
+    {"type": "log"}, {"type": "ask"} (answered with {"type": "answer"}) and a
+    final {"type": "result"} or {"type": "error"}.
+    """
+    def __init__(self, config, socket_path=DEFAULT_SOCKET, agent_kwargs=None, logger_level="INFO"):
+        self.config = config
+        self.socket_path = socket_path
+        self.agent_kwargs = dict(agent_kwargs or {})
+        self.logger_level = logger_level
+        self.agent = None
+        self.ask_channel = None
+        self.lock = asyncio.Lock()
+        self.server = None
+
+    async def start(self):
+        start = time.perf_counter()
+        from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent
+        from cmd_gpt.llm.tokens import count_tokens
+        from cmd_gpt.tool.basic.ask import AskChannel
+        from cmd_gpt.tool.terminal import async_setup_terminal_tool
+
+        imported = time.perf_counter()
+        cmd = await async_setup_terminal_tool(**self.agent_kwargs.get("cmd_confg", {}))
+        agent_kwargs = {k: v for k, v in self.agent_kwargs.items() if k != "cmd_confg"}
+        if "ask_channel" not in agent_kwargs:
+            # questions go to the connected client; an ask socket, if configured, sits next to this daemon's socket
+            if self.ask_channel is None:
+                self.ask_channel = AskChannel.from_config(self.config, socket_path=self.socket_path + ".ask")
+            agent_kwargs["ask_channel"] = self.ask_channel
+        self.agent = DeploymentCmdAgent(self.config, cmd=cmd, **agent_kwargs)
+        await self.agent.arun_tool("terminal_read") # waits through the terminal's initialization
+        count_tokens("warm up", getattr(self.agent.llm, "model_name", "gpt-3.5-turbo"))
+        ready = time.perf_counter()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        logger.info("Agent daemon listening on {} (imports {:.0f} ms, agent and terminal {:.0f} ms)".format(
+            self.socket_path, (imported - start) * 1000, (ready - imported) * 1000))
+
+    async def handle(self, reader, writer):
+        def send(message):
+            writer.write((json.dumps(message) + "\n").encode("utf-8"))
+
+        ask_lock = asyncio.Lock() # questions left open by the agent are put to the client one at a time
+
+        async def ask(question):
+            async with ask_lock:
+                send({"type": "ask", "question": question})
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("client went away")
+                return json.loads(line).get("text", "")
+
+        try:
+            request = json.loads(await reader.readline())
+            async with self.lock:
+                sink = logger.add(lambda m: send({"type": "log", "text": str(m)}), level=self.logger_level)
+                tools = self.agent.action_mapping
+                saved = (tools.get("ask"), self.agent.max_actions_per_step)
+                tools["ask"] = ask
+                self.agent.max_actions_per_step = request.get("options", {}).get("max_actions_per_step", self.agent.max_actions_per_step)
+                try:
+                    result = await self.agent.arun(request["task"])
+                finally:
+                    tools["ask"], self.agent.max_actions_per_step = saved
+                    logger.remove(sink)
+            send({"type": "result", "result": json.loads(model_dump_json(result))})
+        except Exception as e:
+            logger.exception("Task failed")
+            send({"type": "error", "error": repr(e)})
+        try:
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.agent.close()
+            if self.ask_channel is not None:
+                self.ask_channel.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def run_daemon(config, socket_path=DEFAULT_SOCKET, agent_kwargs=None, logger_level="INFO"):
+    asyncio.run(AgentDaemon(config, socket_path, agent_kwargs, logger_level).serve_forever())
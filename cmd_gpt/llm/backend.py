@@ -0,0 +1,83 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import threading
+
+LLM_BACKENDS = ["langchain", "http"]
+
+_SYNC_LOCK = threading.Lock()
+_sync_loop = None
+
+
+def sync_loop():
+    """
+    The event loop sync callers' coroutines run on, in a thread of its own. One
+    for the process, so clients kept per event loop are reused from call to
+    call instead of being left behind with a new loop each time.
+    """
+    global _sync_loop
+    with _SYNC_LOCK:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name="llm-sync-loop", daemon=True).start()
+        return _sync_loop
+
+
+def run_sync(coro):
+    return asyncio.run_coroutine_threadsafe(coro, sync_loop()).result()
+
+
+class LLMBackend:
+    """
+    What the agent needs from a model: model_name, temperature and
+    apredict(prompt) returning the completion text. astream(prompt), yielding
+    the text as it is generated, is optional. predict runs apredict on the
+    shared sync_loop for callers without an event loop. langchain's LLMs have the same
+    shape without subclassing this.
+    """
+    model_name = ""
+    temperature = 0
+
+    async def apredict(self, prompt):
+        raise NotImplementedError
+
+    def predict(self, prompt):
+        return run_sync(self.apredict(prompt))
+
+    def close(self):
+        pass
+
+
+def make_openai_llm(model_name, temperature=0):
+    # langchain takes seconds to import, only pay for it when a model is built
+    from langchain.llms import OpenAI
+    return OpenAI(temperature=temperature, model_name=model_name)
+
+
+def make_llm(config, model_name=None, temperature=0):
+    """
+    The model for model_name (default OPENAI_API_MODEL) on the backend chosen
+    by LLM_BACKEND: "langchain" (default) or "http", the pooled client in
+    cmd_gpt/llm/http.py.
+    """
+    model_name = model_name or config["OPENAI_API_MODEL"]
+    backend = str(config.get("LLM_BACKEND", "langchain")).lower()
+    if backend == "langchain":
+        return make_openai_llm(model_name, temperature)
+    if backend == "http":
+        from cmd_gpt.llm.http import OpenAIHTTPLLM
+        return OpenAIHTTPLLM.from_config(config, model_name, temperature)
+    raise ValueError("Unknown LLM backend: {} (one of {})".format(backend, ", ".join(LLM_BACKENDS)))
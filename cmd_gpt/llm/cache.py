@@ -0,0 +1,138 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from enum import Enum
+
+from loguru import logger
+
+from cmd_gpt.metrics import REGISTRY
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "cmd_gpt", "llm_cache.sqlite")
+
+
+class CacheMode(str, Enum):
+    OFF = "off"
+    READ_WRITE = "read-write"
+    READ_ONLY = "read-only"
+    RECORD_ONLY = "record-only" # always call the LLM, but store the responses
+
+
+def make_cache_key(model_name, temperature, prompt, **params):
+    # params: other settings that change the response, such as max_tokens
+    payload = json.dumps([model_name, temperature, prompt] + ([sorted(params.items())] if params else []), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Content-addressed LLM response cache stored in SQLite.
+
+    The database runs in WAL mode so several processes can read and write it at
+    the same time. Entries are evicted least-recently-used first once there are
+    more than max_entries of them.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, mode=CacheMode.OFF, max_entries=10000):
+        self.mode = CacheMode(mode)
+        self.path = path
+        self.max_entries = int(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if self.mode != CacheMode.OFF:
+            self._connect()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            path=config.get("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+            mode=config.get("LLM_CACHE_MODE", CacheMode.OFF),
+            max_entries=config.get("LLM_CACHE_MAX_ENTRIES", 10000),
+        )
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+
+    @property
+    def readable(self):
+        return self.mode in (CacheMode.READ_WRITE, CacheMode.READ_ONLY)
+
+    @property
+    def writable(self):
+        return self.mode in (CacheMode.READ_WRITE, CacheMode.RECORD_ONLY)
+
+    def get(self, key):
+        if not self.readable:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                REGISTRY.inc("llm_cache_misses", 1, "LLM cache lookups without a stored response.")
+                return None
+            self.hits += 1
+            REGISTRY.inc("llm_cache_hits", 1, "LLM calls answered from the cache.")
+            if self.writable:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, response, model_name=""):
+        if not self.writable:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, response, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.writes += 1
+        REGISTRY.inc("llm_cache_writes", 1, "LLM responses stored in the cache.")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode.value,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        if self._conn is not None:
+            logger.info("LLM cache stats: {}".format(self.stats()))
+            self._conn.close()
+            self._conn = None
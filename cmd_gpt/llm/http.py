@@ -0,0 +1,430 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import json
+import math
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from urllib.parse import urlsplit
+
+import httpx
+from loguru import logger
+
+from cmd_gpt.llm.backend import LLMBackend
+from cmd_gpt.llm.tokens import count_tokens
+from cmd_gpt.metrics import REGISTRY
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+
+LLM_APIS = {"chat": "/chat/completions", "completions": "/completions"}
+
+_SHARED_LOCK = threading.Lock()
+_SHARED_POOLS = {}
+_SHARED_LIMITERS = {}
+
+
+class LLMHTTPError(Exception):
+    """A failed call. status is None when no response came back (timeout, connection error)."""
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class ClientPool:
+    """
+    httpx clients for one server, one per event loop (an httpx client is tied
+    to the loop it was first used on), each keeping at most max_connections
+    keep-alive connections. opened counts the connections made by all of them.
+    """
+    def __init__(self, base_url, max_connections=8, connect_timeout=10):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ["http", "https"] or not parts.hostname:
+            raise ValueError("Not an http(s) URL: {}".format(base_url))
+        self.base_url = base_url
+        self.host = parts.netloc.rsplit("@", 1)[-1]
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = httpx.Timeout(60, connect=connect_timeout)
+        self.opened = 0
+        self._clients = weakref.WeakKeyDictionary() # event loop -> client
+        self._lock = threading.Lock()
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None or client.is_closed:
+                client = self._clients[loop] = httpx.AsyncClient(base_url=self.base_url, limits=self.limits, timeout=self.timeout)
+            return client
+
+    async def _trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            self.opened += 1
+            REGISTRY.inc("llm_connections_opened", 1, "HTTP connections opened to the LLM API.", host=self.host)
+
+    async def send(self, path, body, headers, timeout, stream=False):
+        client = self.client()
+        request = client.build_request("POST", path, content=body, headers=headers, timeout=timeout, extensions={"trace": self._trace})
+        return await client.send(request, stream=stream)
+
+    def close(self):
+        """
+        Close the clients, those of loops running in other threads (such as the
+        sync loop) on their loop. The client of the caller's own running loop
+        cannot be waited for and is left to it. A client is created again on
+        next use.
+        """
+        try:
+            own_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            own_loop = None
+        with self._lock:
+            clients = [(loop, self._clients.pop(loop)) for loop in list(self._clients) if loop is not own_loop]
+        for loop, client in clients:
+            if loop.is_closed():
+                continue
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop).result()
+            else:
+                loop.run_until_complete(client.aclose())
+
+
+class _Bucket:
+    def __init__(self, per_minute, burst_seconds):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait(self, amount):
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute (0 for no limit), as token buckets holding
+    up to burst_seconds of budget. Waiting callers reserve their budget up
+    front, so they go in order and none starves. Not tied to an event loop or
+    thread, so one limiter can be shared by every agent calling the same API
+    (see shared_rate_limiter).
+    """
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, burst_seconds=10):
+        self.requests = _Bucket(requests_per_minute, burst_seconds) if requests_per_minute > 0 else None
+        self.tokens = _Bucket(tokens_per_minute, burst_seconds) if tokens_per_minute > 0 else None
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=0, wait=True):
+        """Seconds to wait before the call may go out; None, reserving nothing, if that is not 0 and not wait."""
+        needs = [(b, n) for b, n in [(self.requests, 1), (self.tokens, tokens)] if b is not None]
+        with self._lock:
+            now = time.monotonic()
+            delay = 0.0
+            for bucket, amount in needs:
+                bucket.refill(now)
+                delay = max(delay, bucket.wait(amount))
+            if delay > 0 and not wait:
+                return None
+            for bucket, amount in needs:
+                bucket.level -= amount
+        return delay
+
+    async def acquire(self, tokens=0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            REGISTRY.observe("llm_rate_limit_wait_seconds", delay, "Time LLM calls waited for the shared rate limit.")
+            await asyncio.sleep(delay)
+
+    def try_acquire(self, tokens=0):
+        return self.reserve(tokens, wait=False) is not None
+
+
+def shared_pool(base_url, max_connections=8):
+    with _SHARED_LOCK:
+        if base_url not in _SHARED_POOLS:
+            _SHARED_POOLS[base_url] = ClientPool(base_url, max_connections)
+        return _SHARED_POOLS[base_url]
+
+
+def shared_rate_limiter(key, requests_per_minute=0, tokens_per_minute=0):
+    """One limiter per key (the API and account), created with the limits of its first caller."""
+    if requests_per_minute <= 0 and tokens_per_minute <= 0:
+        return None
+    with _SHARED_LOCK:
+        if key not in _SHARED_LIMITERS:
+            _SHARED_LIMITERS[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return _SHARED_LIMITERS[key]
+
+
+class LatencyTracker:
+    """Latencies of the last window successful calls."""
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if len(self.samples) == 0:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1))]
+
+
+def retry_after(headers):
+    try:
+        return float(headers.get("retry-after", ""))
+    except ValueError: # missing, or an HTTP date
+        return None
+
+
+class OpenAIHTTPLLM(LLMBackend):
+    """
+    A model behind an OpenAI-compatible HTTP API (api "chat" for
+    /chat/completions, "completions" for /completions), called through httpx
+    clients shared by every model on the same base_url (see ClientPool).
+
+    - Each attempt gets timeout seconds for its response.
+    - 429s, 5xx, timeouts and connection errors are retried up to max_retries
+      times after a full-jitter exponential backoff (at least Retry-After).
+    - With hedge_percentile set, an attempt still running after that
+      percentile of recent latencies (and hedge_min_delay) gets a duplicate
+      request, and the first response wins. There is no hedging until
+      hedge_min_samples calls have finished, or when the rate limiter has no
+      budget to spare.
+    - rate_limiter is waited on before every attempt.
+    """
+    def __init__(self, model_name, api_key=None, base_url=DEFAULT_API_BASE, temperature=0, max_tokens=256, api="chat", timeout=60,
+                 max_retries=3, backoff=0.5, max_backoff=20, hedge_percentile=0, hedge_min_samples=20, hedge_min_delay=0.0,
+                 pool=None, rate_limiter=None):
+        if api not in LLM_APIS:
+            raise ValueError("Unknown LLM API: {} (one of {})".format(api, ", ".join(LLM_APIS)))
+        self.model_name = model_name
+        self.api_key = api_key
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.api = api
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.pool = pool if pool is not None else shared_pool(base_url)
+        self.rate_limiter = rate_limiter
+        self.latencies = LatencyTracker()
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_config(cls, config, model_name=None, temperature=0):
+        base_url = config.get("LLM_API_BASE", DEFAULT_API_BASE)
+        api_key = config.get("OPENAI_API_KEY") or os.environ.get("OPENAI_API_KEY")
+        return cls(
+            model_name or config["OPENAI_API_MODEL"],
+            api_key=api_key,
+            base_url=base_url,
+            temperature=temperature,
+            max_tokens=int(config.get("LLM_MAX_TOKENS", 256)),
+            api=str(config.get("LLM_API", "chat")).lower(),
+            timeout=float(config.get("LLM_TIMEOUT", 60)),
+            max_retries=int(config.get("LLM_MAX_RETRIES", 3)),
+            hedge_percentile=float(config.get("LLM_HEDGE_PERCENTILE", 0)),
+            hedge_min_samples=int(config.get("LLM_HEDGE_MIN_SAMPLES", 20)),
+            hedge_min_delay=float(config.get("LLM_HEDGE_MIN_DELAY", 0)),
+            pool=shared_pool(base_url, int(config.get("LLM_MAX_CONNECTIONS", 8))),
+            rate_limiter=shared_rate_limiter((base_url, api_key), int(config.get("LLM_RATE_LIMIT_RPM", 0)), int(config.get("LLM_RATE_LIMIT_TPM", 0))),
+        )
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = "Bearer " + self.api_key
+        return headers
+
+    def _payload(self, prompt, stream=False):
+        payload = {"model": self.model_name, "temperature": self.temperature, "max_tokens": self.max_tokens}
+        if self.api == "chat":
+            payload["messages"] = [{"role": "user", "content": prompt}]
+        else:
+            payload["prompt"] = prompt
+        if stream:
+            payload["stream"] = True
+        return json.dumps(payload).encode("utf-8")
+
+    def _text(self, data, delta=False):
+        choice = (data.get("choices") or [{}])[0]
+        if self.api == "completions":
+            return choice.get("text") or ""
+        return (choice.get("delta" if delta else "message") or {}).get("content") or ""
+
+    def retry_delay(self, attempt, error):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return max(delay, error.retry_after or 0.0)
+
+    def hedge_delay(self):
+        if self.hedge_percentile <= 0 or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return max(self.latencies.percentile(self.hedge_percentile), self.hedge_min_delay)
+
+    async def _attempt(self, body, tokens, reserved=False):
+        if self.rate_limiter is not None and not reserved:
+            await self.rate_limiter.acquire(tokens)
+        start = time.monotonic()
+        try:
+            response = await asyncio.wait_for(self.pool.send(LLM_APIS[self.api], body, self._headers(), self.timeout), self.timeout)
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            raise LLMHTTPError("no response within {:g} seconds".format(self.timeout))
+        except httpx.TransportError as e:
+            raise LLMHTTPError("connection failed: {}".format(str(e) or type(e).__name__))
+        if response.status_code != 200:
+            raise LLMHTTPError("{} {}: {}".format(response.status_code, response.reason_phrase, response.text[:200]), response.status_code, retry_after(response.headers))
+        try:
+            text = self._text(response.json())
+        except (ValueError, TypeError, AttributeError, IndexError) as e:
+            raise LLMHTTPError("invalid response: {}".format(e))
+        self.latencies.add(time.monotonic() - start)
+        return text
+
+    async def _hedged(self, body, tokens):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._attempt(body, tokens)
+        first = asyncio.ensure_future(self._attempt(body, tokens))
+        attempts = [first]
+        try:
+            await asyncio.wait(attempts, timeout=delay)
+            if not first.done() and (self.rate_limiter is None or self.rate_limiter.try_acquire(tokens)):
+                logger.debug("No response from {} after {:.2f}s, sending a hedged request".format(self.model_name, delay))
+                self.hedges += 1
+                REGISTRY.inc("llm_hedges", 1, "Duplicate LLM requests sent after the hedging threshold.", model=self.model_name)
+                attempts.append(asyncio.ensure_future(self._attempt(body, tokens, reserved=True)))
+            pending, error = set(attempts), None
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not first:
+                            self.hedge_wins += 1
+                            REGISTRY.inc("llm_hedge_wins", 1, "Hedged LLM requests that answered first.", model=self.model_name)
+                        return attempt.result()
+                    error = attempt.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def apredict(self, prompt):
+        self.calls += 1
+        body = self._payload(prompt)
+        tokens = count_tokens(prompt) + self.max_tokens
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._hedged(body, tokens)
+            except LLMHTTPError as e:
+                if not e.retryable or attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt, e)
+                logger.warning("LLM call to {} failed ({}), retry {} of {} in {:.1f}s".format(self.model_name, e, attempt + 1, self.max_retries, delay))
+                self.retries += 1
+                REGISTRY.inc("llm_retries", 1, "LLM calls retried after a 429, 5xx, timeout or connection error.", model=self.model_name)
+                await asyncio.sleep(delay)
+
+    async def _open_stream(self, body, tokens):
+        # the response of a streamed call with its body still unread, retried like apredict
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire(tokens)
+            response = None
+            try:
+                try:
+                    response = await asyncio.wait_for(self.pool.send(LLM_APIS[self.api], body, dict(self._headers(), Accept="text/event-stream"), self.timeout, stream=True), self.timeout)
+                except (asyncio.TimeoutError, httpx.TimeoutException):
+                    raise LLMHTTPError("no response within {:g} seconds".format(self.timeout))
+                except httpx.TransportError as e:
+                    raise LLMHTTPError("connection failed: {}".format(str(e) or type(e).__name__))
+                if response.status_code != 200:
+                    await response.aread()
+                    raise LLMHTTPError("{} {}: {}".format(response.status_code, response.reason_phrase, response.text[:200]), response.status_code, retry_after(response.headers))
+                return response
+            except LLMHTTPError as e:
+                if response is not None:
+                    await response.aclose()
+                if not e.retryable or attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt, e)
+                logger.warning("LLM stream from {} failed ({}), retry {} of {} in {:.1f}s".format(self.model_name, e, attempt + 1, self.max_retries, delay))
+                self.retries += 1
+                REGISTRY.inc("llm_retries", 1, "LLM calls retried after a 429, 5xx, timeout or connection error.", model=self.model_name)
+                await asyncio.sleep(delay)
+            except BaseException:
+                if response is not None:
+                    await response.aclose()
+                raise
+
+    async def astream(self, prompt):
+        """
+        The completion as it is generated (server-sent events). Failures before
+        the response starts are retried; there is no hedging, and the timeout
+        covers the wait for the response to start and for each later chunk.
+        Events that are not JSON are skipped.
+        """
+        self.calls += 1
+        response = await self._open_stream(self._payload(prompt, stream=True), count_tokens(prompt) + self.max_tokens)
+        done = False
+        try:
+            # read on past [DONE] to the end of the body, so the connection is reused
+            async for line in response.aiter_lines():
+                line = line.strip()
+                if done or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    done = True
+                    continue
+                try:
+                    text = self._text(json.loads(data), delta=True)
+                except (ValueError, TypeError, AttributeError, IndexError) as e:
+                    logger.debug("Skipping a malformed event from {} ({}): {!r}".format(self.model_name, e, data[:200]))
+                    continue
+                if text:
+                    yield text
+        except httpx.TimeoutException:
+            raise LLMHTTPError("the stream stalled for {:g} seconds".format(self.timeout))
+        except httpx.TransportError as e:
+            raise LLMHTTPError("the stream broke off: {}".format(str(e) or type(e).__name__))
+        finally:
+            await response.aclose()
+
+    def close(self):
+        self.pool.close()
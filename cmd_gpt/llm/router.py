@@ -0,0 +1,119 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import copy
+import re
+from typing import List
+
+from loguru import logger
+from pydantic import BaseModel
+
+from cmd_gpt.llm.tokens import count_tokens
+
+FAST = "fast"
+STRONG = "strong"
+
+DEFAULT_ERROR_PATTERNS = [
+    r"error", r"fail", r"fatal", r"denied", r"not found", r"no such file", r"cannot", r"can't", r"unable",
+    r"traceback", r"exception", r"^\s*E: ", r"try again",
+]
+
+
+class RoutingDecision(BaseModel):
+    step: int
+    tier: str
+    model_name: str = ""
+    reasons: List[str] = []
+
+
+class ModelRouter:
+    """
+    Pick a model tier for each step. The fast tier handles routine steps; the
+    strong tier is used for the first steps (initial planning), after an
+    observation that looks like an error, for large observations and when the
+    agent repeats an action. Once escalated, the strong tier is kept for
+    sticky_steps further steps so a recovery is planned by the same model.
+    """
+    def __init__(self, llms, strong_first_steps=1, large_observation_tokens=400, repeat_window=4, sticky_steps=1, error_patterns=None):
+        self.llms = llms # tier name -> llm
+        self.strong_first_steps = strong_first_steps
+        self.large_observation_tokens = large_observation_tokens
+        self.repeat_window = repeat_window
+        self.sticky_steps = sticky_steps
+        self.error_regex = re.compile("|".join("(?:{})".format(p) for p in (error_patterns or DEFAULT_ERROR_PATTERNS)), re.IGNORECASE | re.MULTILINE)
+        self.decisions: List[RoutingDecision] = []
+        self._sticky = 0
+
+    @classmethod
+    def from_config(cls, config, make_llm):
+        """
+        None unless ROUTER_FAST_MODEL is set. The strong tier defaults to
+        OPENAI_API_MODEL. make_llm(model_name) builds an llm for a tier.
+        """
+        fast_model = config.get("ROUTER_FAST_MODEL")
+        if not fast_model:
+            return None
+        strong_model = config.get("ROUTER_STRONG_MODEL", config.get("OPENAI_API_MODEL"))
+        return cls(
+            {FAST: make_llm(fast_model), STRONG: make_llm(strong_model)},
+            strong_first_steps=int(config.get("ROUTER_STRONG_FIRST_STEPS", 1)),
+            large_observation_tokens=int(config.get("ROUTER_LARGE_OBSERVATION_TOKENS", 400)),
+            sticky_steps=int(config.get("ROUTER_STICKY_STEPS", 1)),
+        )
+
+    def reset(self):
+        self.decisions = []
+        self._sticky = 0
+
+    def fork(self):
+        """The same tiers and settings with routing state of its own, for another agent sharing the models."""
+        router = copy.copy(self)
+        router.reset()
+        return router
+
+    def looks_like_error(self, observation):
+        return self.error_regex.search(observation or "") is not None
+
+    def signals(self, step, last_observation, recent_actions):
+        reasons = []
+        if step < self.strong_first_steps:
+            reasons.append("first_steps")
+        if self.looks_like_error(last_observation):
+            reasons.append("error")
+        if count_tokens(last_observation or "") > self.large_observation_tokens:
+            reasons.append("large_observation")
+        window = [a.strip() for a in recent_actions[-self.repeat_window:] if a.strip() != ""]
+        if len(window) != len(set(window)):
+            reasons.append("repeated_action")
+        return reasons
+
+    def route(self, step, last_observation="", recent_actions=()):
+        reasons = self.signals(step, last_observation, list(recent_actions))
+        if len(reasons) > 0:
+            self._sticky = self.sticky_steps
+            tier = STRONG
+        elif self._sticky > 0:
+            self._sticky -= 1
+            reasons = ["sticky"]
+            tier = STRONG
+        else:
+            tier = FAST
+        decision = RoutingDecision(step=step, tier=tier, model_name=getattr(self.llms[tier], "model_name", ""), reasons=reasons)
+        self.decisions.append(decision)
+        logger.debug("Routing step {} to {} ({})".format(step, tier, ", ".join(reasons) or "routine"))
+        return decision
+
+    def llm(self, decision):
+        return self.llms[decision.tier]
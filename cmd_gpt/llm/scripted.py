@@ -0,0 +1,59 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import time
+
+from loguru import logger
+
+from cmd_gpt.llm.backend import LLMBackend
+
+END_RESPONSE = "A: No scripted response left.\nP: end\nE: end\n"
+
+
+class ScriptedLLM(LLMBackend):
+    """
+    Deterministic stand-in for the LLM: returns the scripted responses in order,
+    after an optional fixed latency, and records the prompts it was given. Once
+    the script runs out it answers with END_RESPONSE so a run always finishes.
+    """
+    def __init__(self, responses, latency=0.0, model_name="scripted", temperature=0):
+        self.responses = list(responses)
+        self.latency = latency
+        self.model_name = model_name
+        self.temperature = temperature
+        self.prompts = []
+
+    def fork(self, model_name, latency=None):
+        """Another model (e.g. a routing tier) that shares this script and its position in it."""
+        llm = ScriptedLLM([], self.latency if latency is None else latency, model_name, self.temperature)
+        llm.responses = self.responses
+        llm.prompts = self.prompts
+        return llm
+
+    def _next(self, prompt):
+        self.prompts.append(prompt)
+        if len(self.prompts) > len(self.responses):
+            logger.warning("Scripted LLM ran out of responses")
+            return END_RESPONSE
+        return self.responses[len(self.prompts) - 1]
+
+    def predict(self, prompt):
+        time.sleep(self.latency)
+        return self._next(prompt)
+
+    async def apredict(self, prompt):
+        await asyncio.sleep(self.latency)
+        return self._next(prompt)
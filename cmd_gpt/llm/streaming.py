@@ -0,0 +1,102 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+from loguru import logger
+
+
+class ActionStreamParser:
+    """
+    Incremental parser for streamed MAPE output.
+
+    Chunks are fed as they arrive; feed() returns True once a complete (newline
+    terminated) "E:" line has been seen. text then holds the output up to and
+    including that line, which processing_output_multi handles like a full completion.
+    With multi_action the parser waits for the end of the block of E: lines
+    instead (the first line after it that is not an E: line).
+    """
+    def __init__(self, multi_action=False):
+        self.text = ""
+        self._pending = ""
+        self.complete = False
+        self.multi_action = multi_action
+        self._seen_action = False
+
+    def feed(self, chunk):
+        if self.complete:
+            return True
+        self._pending += chunk
+        while "\n" in self._pending:
+            line, self._pending = self._pending.split("\n", 1)
+            is_action = line.strip()[:2] == "E:"
+            if self.multi_action and self._seen_action and not is_action:
+                self.complete = True
+                return True
+            self.text += line + "\n"
+            if is_action:
+                self._seen_action = True
+                if not self.multi_action:
+                    self.complete = True
+                    return True
+        return False
+
+    def finish(self):
+        if not self.complete:
+            self.text += self._pending
+            self._pending = ""
+        return self.text
+
+
+def _chunk_text(chunk):
+    # LLMs stream str chunks, chat models stream message chunks
+    return chunk if isinstance(chunk, str) else getattr(chunk, "content", str(chunk))
+
+
+def stream_until_action(llm, prompt, multi_action=False):
+    if not hasattr(llm, "stream"):
+        return llm.predict(prompt)
+
+    parser = ActionStreamParser(multi_action)
+    stream = llm.stream(prompt)
+    try:
+        for chunk in stream:
+            if parser.feed(_chunk_text(chunk)):
+                logger.debug("E: lines complete, stopping generation")
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close() # closes the underlying HTTP stream, cancelling the rest of the generation
+    return parser.finish()
+
+
+
+async def astream_until_action(llm, prompt, multi_action=False):
+    if not hasattr(llm, "astream"):
+        return await asyncio.to_thread(stream_until_action, llm, prompt, multi_action)
+
+    parser = ActionStreamParser(multi_action)
+    stream = llm.astream(prompt)
+    try:
+        async for chunk in stream:
+            if parser.feed(_chunk_text(chunk)):
+                logger.debug("E: lines complete, stopping generation")
+                break
+    finally:
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    return parser.finish()
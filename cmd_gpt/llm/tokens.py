@@ -0,0 +1,45 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# tiktoken is imported lazily and is optional: without it token counts are
+# estimated at ~4 characters per token, which is good enough for budgeting.
+
+DEFAULT_ENCODING = "cl100k_base"
+
+_encodings = {}
+
+
+def _get_encoding(model_name):
+    if model_name in _encodings:
+        return _encodings[model_name]
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+    except ImportError:
+        encoding = None
+    _encodings[model_name] = encoding
+    return encoding
+
+
+def count_tokens(text, model_name="gpt-3.5-turbo"):
+    if not text:
+        return 0
+    encoding = _get_encoding(model_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
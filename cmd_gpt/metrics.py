@@ -0,0 +1,188 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = _labels_key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name + "_total" + _format_labels(key), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help="", buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.values = {} # label key -> [bucket counts..., sum]
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        if key not in self.values:
+            self.values[key] = [0] * len(self.buckets) + [0.0]
+        counts = self.values[key]
+        for k, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[k] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for key, counts in self.values.items():
+            for bound, count in zip(self.buckets, counts):
+                yield self.name + "_bucket" + _format_labels(key, [("le", _format_value(float(bound)))]), count
+            yield self.name + "_count" + _format_labels(key), counts[-2]
+            yield self.name + "_sum" + _format_labels(key), counts[-1]
+
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms rendered in the OpenMetrics text format,
+    either written to a file or served over HTTP for a Prometheus scraper.
+    """
+    def __init__(self, prefix="cmdgpt_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        name = self.prefix + name
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help=""):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help="", buckets=SECONDS_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def inc(self, name, value=1, help="", **labels):
+        counter = self.counter(name, help)
+        with self._lock:
+            counter.inc(value, **labels)
+
+    def observe(self, name, value, help="", buckets=SECONDS_BUCKETS, **labels):
+        histogram = self.histogram(name, help, buckets)
+        with self._lock:
+            histogram.observe(value, **labels)
+
+    @contextmanager
+    def span(self, name, help="", **labels):
+        # times the block into the histogram <name>_seconds
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name + "_seconds", time.perf_counter() - start, help, **labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self.metrics):
+                metric = self.metrics[name]
+                if metric.help:
+                    lines.append("# HELP {} {}".format(name, metric.help))
+                lines.append("# TYPE {} {}".format(name, metric.type))
+                for sample, value in metric.samples():
+                    lines.append("{} {}".format(sample, _format_value(value)))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # written to a temporary file first so a scraper never sees half a file
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port, addr="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info("Serving metrics on http://{}:{}/metrics".format(addr, port))
+        return server
+
+
+REGISTRY = MetricsRegistry()
+
+
+def record_terminal_wait(backend, timings, seconds, quiet_seconds):
+    """
+    Account one wait for a command to finish. quiet_seconds is the part spent
+    idle after the last output, confirming that the prompt stays put.
+    """
+    timings["wait"] = timings.get("wait", 0.0) + seconds
+    timings["quiet"] = timings.get("quiet", 0.0) + quiet_seconds
+    REGISTRY.observe("terminal_wait_seconds", seconds, "Time spent waiting for a command to finish.", backend=backend)
+    REGISTRY.inc("terminal_quiet_seconds", quiet_seconds, "Time spent idle after the last output before accepting a prompt.", backend=backend)
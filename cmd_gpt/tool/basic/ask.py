@@ -12,8 +12,332 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import errno
+import json
+import os
+import re
+import sys
+import uuid
+
+from loguru import logger
+
+from cmd_gpt.client import DEFAULT_ASK_SOCKET
+
+DEFAULT_DROP_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cmd_gpt", "ask")
+
+ASK_SOURCES = ["terminal", "socket", "file"]
+
+# (class, pattern); the first group, if any, names whose secret it is
+QUESTION_CLASSES = [
+    ("sudo password", re.compile(r"\[sudo\] password for ([^:\s]+)", re.IGNORECASE)),
+    ("ssh password", re.compile(r"([\w.-]+@[\w.-]+)'s password", re.IGNORECASE)),
+    ("key passphrase", re.compile(r"passphrase for (?:key )?'?([^':\s]+)", re.IGNORECASE)),
+    ("su password", re.compile(r"^Password:\s*$")),
+    ("sudo password", re.compile(r"\bsudo\b.*\bpassword\b|\bpassword\b.*\bsudo\b", re.IGNORECASE)),
+]
+
+# secrets that differ from host to host
+HOST_SCOPED_CLASSES = ["sudo password", "su password"]
+
+# the last cached answer was wrong, it is asked for again
+ANSWER_REJECTED = re.compile(r"Sorry, try again|Permission denied, please try again|incorrect password|Authentication failure|bad passphrase", re.IGNORECASE)
+
+# user@host at the start of a prompt, with or without a command typed after it
+HOST_PROMPT = re.compile(r"^\[?([\w.-]+)@([\w.-]+)[:\s\]]")
+
+
 def ask(question):
     print(question)
     #get input
     answer = input()
-    return answer
\ No newline at end of file
+    return answer
+
+
+async def async_ask(question):
+    # input() blocks, keep it off the event loop
+    return await asyncio.to_thread(ask, question)
+
+
+def prompt_host(lines):
+    """host of the last user@host prompt in the lines, "" if there is none"""
+    for line in reversed(lines):
+        m = HOST_PROMPT.search(line.strip())
+        if m is not None:
+            return m.group(2)
+    return ""
+
+
+def question_class(question, context="", host=""):
+    """
+    What the question is after, e.g. "sudo password for ubuntu@web1", so the
+    same question can be answered again without a human. The terminal line
+    waiting for input (context) is looked at before the model's wording.
+    None for anything that is not a known kind of secret.
+    """
+    for text in [context.strip(), question.strip()]:
+        for name, pattern in QUESTION_CLASSES:
+            m = pattern.search(text)
+            if m is None:
+                continue
+            owner = m.group(1) if m.groups() else ""
+            if name in HOST_SCOPED_CLASSES and host:
+                owner = owner + "@" + host if owner else host
+            return name + (" for " + owner if owner else "")
+    return None
+
+
+class AnswerCache:
+    """
+    Answers for this session, by question class. Nothing is written to disk,
+    and every cached answer can be masked out of text with redact().
+    """
+    def __init__(self):
+        self.answers = {}
+
+    def get(self, key):
+        return self.answers.get(key)
+
+    def put(self, key, answer):
+        self.answers[key] = answer
+
+    def forget(self, key=None):
+        if key is None:
+            self.answers.clear()
+        else:
+            self.answers.pop(key, None)
+
+    def redact(self, text, mask="******"):
+        for answer in self.answers.values():
+            if len(answer) >= 3: # do not mask every "y" or "1"
+                text = text.replace(answer, mask)
+        return text
+
+
+class _StdinReader:
+    """
+    The one reader of stdin in the process. Terminal questions of every
+    channel wait here in the order they were asked, and a line answers the
+    oldest, so channels never take stdin from each other.
+    """
+    def __init__(self):
+        self.waiting = [] # (channel, question id), oldest first
+        self._loop = None
+        self._thread_read = None
+        self._partial = ""
+
+    def wait(self, channel, question_id):
+        self.waiting.append((channel, question_id))
+        self._start()
+
+    def done(self, channel, question_id):
+        if (channel, question_id) in self.waiting:
+            self.waiting.remove((channel, question_id))
+        if len(self.waiting) == 0:
+            self._stop()
+
+    def _start(self):
+        if self._loop is not None or (self._thread_read is not None and not self._thread_read.done()):
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_reader(sys.stdin.fileno(), self._on_readable)
+            self._loop = loop
+        except (NotImplementedError, ValueError, OSError):
+            # no selectable stdin (Windows, a closed or redirected stream): one blocking read in a thread
+            self._thread_read = asyncio.ensure_future(asyncio.to_thread(sys.stdin.readline))
+            self._thread_read.add_done_callback(self._on_thread_line)
+
+    def _on_readable(self):
+        # read the fd itself, a line buffered in sys.stdin would not wake the loop again
+        data = os.read(sys.stdin.fileno(), 4096)
+        if data == b"": # end of input
+            self._stop()
+            return
+        self._partial += data.decode("utf-8", errors="replace")
+        while "\n" in self._partial:
+            line, self._partial = self._partial.split("\n", 1)
+            self._dispatch(line)
+
+    def _on_thread_line(self, task):
+        if task.cancelled() or task.exception() is not None or task.result() == "":
+            return
+        self._dispatch(task.result())
+        if len(self.waiting) > 0:
+            self._start()
+
+    def _dispatch(self, line):
+        if len(self.waiting) > 0:
+            channel, question_id = self.waiting.pop(0)
+            channel.answer(question_id, line.rstrip("\n"))
+
+    def _stop(self):
+        if self._loop is not None:
+            try:
+                self._loop.remove_reader(sys.stdin.fileno())
+            except (RuntimeError, ValueError, OSError):
+                pass
+            self._loop = None
+
+
+_STDIN = _StdinReader()
+
+
+class AskChannel:
+    """
+    Put questions to a human on several sources at once and take the first
+    answer from any of them:
+
+    - terminal: printed here and answered on stdin.
+    - socket: sent to every client of a Unix socket (python -m cmd_gpt.client
+      --answer), which replies with {"type": "answer", "id": ..., "text": ...}.
+    - file: written to <drop_dir>/<id>.question and answered by creating
+      <drop_dir>/<id>.answer.
+
+    Waiting never blocks the event loop, and several questions can be open at
+    the same time, also across channels; a terminal answer goes to the oldest
+    one. Agents working side by side should still share one channel, as only
+    one channel can serve a socket path.
+    """
+    def __init__(self, sources=("terminal",), socket_path=DEFAULT_ASK_SOCKET, drop_dir=DEFAULT_DROP_DIR, poll_interval=0.5):
+        for source in sources:
+            if source not in ASK_SOURCES:
+                raise ValueError("Unknown ask source: {} (one of {})".format(source, ", ".join(ASK_SOURCES)))
+        self.sources = list(sources)
+        self.socket_path = socket_path
+        self.drop_dir = drop_dir
+        self.poll_interval = poll_interval
+        self.pending = {} # id -> (question, future), oldest first
+        self.server = None
+        self._server_start = None
+        self.clients = set()
+        self._poller = None
+
+    @classmethod
+    def from_config(cls, config, socket_path=None):
+        """socket_path, when given, takes the place of ASK_SOCKET."""
+        sources = [s.strip() for s in str(config.get("ASK_SOURCES", "terminal")).split(",") if s.strip() != ""]
+        return cls(
+            sources=sources,
+            socket_path=socket_path or os.path.expanduser(config.get("ASK_SOCKET", DEFAULT_ASK_SOCKET)),
+            drop_dir=os.path.expanduser(config.get("ASK_DROP_DIR", DEFAULT_DROP_DIR)),
+        )
+
+    async def ask(self, question):
+        question_id = uuid.uuid4().hex[:8]
+        future = asyncio.get_running_loop().create_future()
+        self.pending[question_id] = (question, future)
+        try:
+            if "socket" in self.sources:
+                await self._start_server()
+                self._broadcast({"type": "ask", "id": question_id, "question": question})
+            if "file" in self.sources:
+                self._drop_question(question_id, question)
+            if "terminal" in self.sources:
+                print(question if len(_STDIN.waiting) == 0 else "[{}] {}".format(question_id, question), flush=True)
+                _STDIN.wait(self, question_id)
+            return await future
+        finally:
+            self.pending.pop(question_id, None)
+            if "file" in self.sources:
+                self._remove_drop(question_id)
+            if "terminal" in self.sources:
+                _STDIN.done(self, question_id)
+
+    def answer(self, question_id, text):
+        if question_id is None and len(self.pending) > 0:
+            question_id = next(iter(self.pending))
+        if question_id not in self.pending:
+            return False
+        _, future = self.pending[question_id]
+        if not future.done():
+            future.set_result(text)
+        return True
+
+    async def _start_server(self):
+        # questions asked at the same time share one server
+        if self._server_start is None:
+            self._server_start = asyncio.ensure_future(self._create_server())
+        await self._server_start
+
+    async def _create_server(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.socket_path), 1)
+            except (OSError, asyncio.TimeoutError):
+                os.unlink(self.socket_path) # left behind by a process that is gone
+            else:
+                writer.close()
+                raise OSError(errno.EADDRINUSE, "{} is served by another ask channel, set ASK_SOCKET to another path".format(self.socket_path))
+        self.server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        logger.info("Answer questions with: python -m cmd_gpt.client --answer --ask_socket={}".format(self.socket_path))
+
+    def _broadcast(self, message):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        for writer in list(self.clients):
+            try:
+                writer.write(data)
+            except (ConnectionError, RuntimeError):
+                self.clients.discard(writer)
+
+    async def _handle_client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            for question_id, (question, _) in list(self.pending.items()):
+                writer.write((json.dumps({"type": "ask", "id": question_id, "question": question}) + "\n").encode("utf-8"))
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if message.get("type") == "answer":
+                    self.answer(message.get("id"), str(message.get("text", "")))
+        except (ConnectionError, asyncio.CancelledError): # the client or the event loop went away
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def _drop_question(self, question_id, question):
+        os.makedirs(self.drop_dir, exist_ok=True)
+        path = os.path.join(self.drop_dir, question_id + ".question")
+        with open(path, "w") as f:
+            f.write(question + "\n")
+        logger.info("Question written to {}, answer in {}".format(path, path[:-len(".question")] + ".answer"))
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll_drops())
+
+    async def _poll_drops(self):
+        while len(self.pending) > 0:
+            for question_id in list(self.pending):
+                path = os.path.join(self.drop_dir, question_id + ".answer")
+                if os.path.exists(path):
+                    with open(path, "r") as f:
+                        self.answer(question_id, f.read().rstrip("\n"))
+            await asyncio.sleep(self.poll_interval)
+
+    def _remove_drop(self, question_id):
+        for suffix in [".question", ".answer"]:
+            try:
+                os.unlink(os.path.join(self.drop_dir, question_id + suffix))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        for _, future in self.pending.values():
+            future.cancel()
+        if self._poller is not None:
+            self._poller.cancel()
+        if self.server is not None:
+            try:
+                self.server.close()
+            except RuntimeError: # its event loop is already closed
+                pass
+            self.server, self._server_start = None, None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
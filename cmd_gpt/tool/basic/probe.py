@@ -0,0 +1,237 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import functools
+import os
+import re
+import shlex
+import signal
+import time
+
+from loguru import logger
+
+from cmd_gpt.metrics import REGISTRY
+
+# program -> allowed first argument ("" for none at all), None allows any arguments
+DEFAULT_ALLOWLIST = {
+    "uname": None, "hostname": ["", "-f", "-s", "-d", "-i", "-I", "--fqdn"], "hostnamectl": ["", "status"], "whoami": None, "id": None, "groups": None,
+    "uptime": None, "date": None, "arch": None, "nproc": None, "lscpu": None, "lsblk": None, "lsb_release": None,
+    "df": None, "du": None, "free": None, "ps": None, "pgrep": None, "ulimit": None,
+    "cat": None, "head": None, "tail": None, "ls": None, "stat": None, "file": None, "wc": None, "readlink": None,
+    "grep": None, "egrep": None, "sort": None, "cut": None, "tr": None, "find": None, "test": None,
+    "which": None, "whereis": None, "type": None, "command": ["-v", "-V"],
+    "ip": ["addr", "a", "route", "r", "link", "neigh"], "ss": None, "netstat": None, "getent": None,
+    "systemctl": ["", "status", "is-active", "is-enabled", "is-failed", "list-units", "list-unit-files", "show", "cat"],
+    "journalctl": None,
+    "dpkg": ["-l", "-s", "-L", "--list", "--status", "--listfiles", "--get-selections", "--print-architecture"],
+    "dpkg-query": None, "apt": ["list", "show", "policy", "search"], "apt-cache": None,
+    "rpm": ["-q", "-qa", "-qi", "-ql", "-qf"], "yum": ["list", "info"], "dnf": ["list", "info"],
+    "brew": ["list", "info", "--version", "--prefix"], "snap": ["list", "info", "version"],
+    "pip": ["list", "show", "freeze", "--version"], "pip3": ["list", "show", "freeze", "--version"],
+    "python": ["--version", "-V"], "python3": ["--version", "-V"], "node": ["--version", "-v"], "npm": ["--version", "-v", "ls", "list"],
+    "java": ["-version", "--version"], "go": ["version", "env"], "nginx": ["-v", "-V", "-t"],
+    "docker": ["ps", "images", "version", "info", "inspect", "--version"],
+    "kubectl": ["get", "describe", "version", "cluster-info", "api-resources"],
+    "git": ["status", "log", "rev-parse", "describe", "show", "diff", "--version"],
+}
+
+# arguments that write, delete or never return even though the program is allowed
+FORBIDDEN_ARGUMENTS = {
+    "find": ["-exec", "-execdir", "-ok", "-okdir", "-delete", "-fprint", "-fprint0", "-fprintf", "-fls"],
+    "journalctl": ["-f", "--follow", "--vacuum", "--rotate", "--flush", "--sync", "--relinquish-var", "--setup-keys"],
+    "tail": ["-f", "-F", "--follow"],
+    "sort": ["-o", "--output", "--compress-program", "-T", "--temporary-directory"], # a compress program runs anything
+    "date": ["-s", "--set"],
+    "ip": ["add", "del", "delete", "set", "change", "replace", "flush", "append"],
+    "ss": ["-K", "--kill"],
+    "file": ["-C", "--compile"],
+    "go": ["-w", "-u"],
+    "git": ["--output"],
+    "docker": ["--format"], # go templates can call functions
+}
+
+SHELL_OPERATORS = ["|", "&&", "||"]
+HARMLESS_REDIRECTS = re.compile(r"\s*2>\s*(/dev/null|&1)(?=\s|$|[;&|])")
+
+
+def split_probe_input(text):
+    # commands are separated by ; or new lines outside of quotes
+    commands, current, quote = [], "", None
+    for c in text or "":
+        if quote is None and c in ";\n":
+            commands.append(current)
+            current = ""
+            continue
+        if c in "'\"":
+            if quote is None:
+                quote = c
+            elif quote == c:
+                quote = None
+        current += c
+    commands.append(current)
+    return [c.strip() for c in commands if c.strip() != ""]
+
+
+def check_probe_command(command, allowlist=DEFAULT_ALLOWLIST):
+    """
+    Return why the command is refused, or None if every program in it is on the
+    allowlist. Pipes and && / || chains are allowed between allowed programs;
+    redirections (other than discarding stderr), substitutions and background
+    jobs are not. Programs are named bare, so PATH picks the system binary.
+    """
+    if "\n" in command or "\r" in command:
+        return "line breaks are not allowed, one command per line"
+    if "`" in command or "$(" in command or "<(" in command:
+        return "command substitution is not allowed"
+    lexer = shlex.shlex(HARMLESS_REDIRECTS.sub(" ", command), posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        tokens = list(lexer)
+    except ValueError as e:
+        return str(e)
+    segments = [[]]
+    for token in tokens:
+        if token in SHELL_OPERATORS:
+            segments.append([])
+        elif len(token) > 0 and all(c in "();<>|&" for c in token):
+            return "'{}' is not allowed".format(token)
+        else:
+            segments[-1].append(token)
+    for segment in segments:
+        if len(segment) == 0:
+            return "empty command"
+        program = segment[0]
+        if "/" in program:
+            return "{} is a path, name the program without one".format(program)
+        if program not in allowlist:
+            return "{} is not an allowed read-only command".format(program)
+        allowed = allowlist[program]
+        if allowed is not None and (segment[1] if len(segment) > 1 else "") not in allowed:
+            return "{} only allows: {}".format(program, ", ".join(a for a in allowed if a != ""))
+        for arg in segment[1:]:
+            if any(argument_matches(arg, flag) for flag in FORBIDDEN_ARGUMENTS.get(program, [])):
+                return "{} {} is not allowed".format(program, arg)
+    return None
+
+
+def argument_matches(arg, flag):
+    if arg == flag or arg.startswith(flag + "="):
+        return True
+    if flag.startswith("--"):
+        name = arg.split("=", 1)[0]
+        # --vacuum-size, --vacuum-time; long options may also be abbreviated, e.g. --compress=
+        return arg.startswith(flag) or (name.startswith("--") and len(name) > 2 and flag.startswith(name))
+    if len(flag) == 2 and re.match(r"^-[A-Za-z]", arg) and not arg.startswith("--"):
+        # combined short flags (tail -qf) or a flag with its value attached (sort -T/tmp, sort -ofile)
+        return flag[1] in re.match(r"^-([A-Za-z]*)", arg).group(1)
+    return False
+
+
+async def run_local_probe(command, timeout=10, ssh=None):
+    """
+    Run a command in its own process, locally or over ssh. Nothing is read from
+    stdin and ssh never prompts, so a probe cannot get stuck on a question.
+    """
+    if ssh is None:
+        argv = ["/bin/sh", "-c", command]
+    else:
+        argv = ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout={}".format(int(timeout)), ssh, command]
+    env = dict(os.environ, LC_ALL="C", PAGER="cat", SYSTEMD_PAGER="cat")
+    proc = await asyncio.create_subprocess_exec(*argv, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.STDOUT, env=env, start_new_session=True)
+    try:
+        output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        return "(timed out after {} seconds)".format(timeout)
+    text = output.decode("utf-8", errors="replace").rstrip("\n")
+    if proc.returncode != 0:
+        text += "\n(exit status {})".format(proc.returncode)
+    return text
+
+
+class ProbeTool:
+    """
+    Run several read-only discovery commands at once and return all their outputs
+    in one observation. Every command is checked against the allowlist and runs in
+    a separate short-lived session, so the main terminal (working directory,
+    environment, a pending question) is never touched.
+    """
+    def __init__(self, runner=None, allowlist=None, timeout=10, max_parallel=8, max_commands=8, max_lines=30, location="on the local machine (not inside ssh)"):
+        self.runner = runner if runner is not None else run_local_probe
+        self.allowlist = allowlist if allowlist is not None else DEFAULT_ALLOWLIST
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_parallel)
+        self.max_commands = max_commands
+        self.max_lines = max_lines
+        self.location = location
+
+    @classmethod
+    def from_config(cls, config, runner=None):
+        if str(config.get("PROBE", "true")).lower() not in ["1", "true", "yes"]:
+            return None
+        allowlist = dict(DEFAULT_ALLOWLIST)
+        for program in str(config.get("PROBE_ALLOW", "")).split(","):
+            if program.strip() != "":
+                allowlist[program.strip()] = None
+        kwargs = {}
+        ssh = config.get("PROBE_SSH")
+        if runner is None and ssh:
+            runner = functools.partial(run_local_probe, ssh=ssh)
+            kwargs["location"] = "on " + ssh
+        return cls(
+            runner=runner,
+            allowlist=allowlist,
+            timeout=float(config.get("PROBE_TIMEOUT", 10)),
+            max_parallel=int(config.get("PROBE_MAX_PARALLEL", 8)),
+            **kwargs,
+        )
+
+    async def _run_one(self, command):
+        reason = check_probe_command(command, self.allowlist)
+        if reason is not None:
+            logger.info("Probe refused: {} ({})".format(command, reason))
+            REGISTRY.inc("probe_refused", 1, "Probe commands refused by the allowlist.")
+            return "refused: " + reason
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                return await self.runner(command, self.timeout)
+            except OSError as e:
+                return "error: {}".format(e)
+            finally:
+                REGISTRY.observe("probe_seconds", time.perf_counter() - start, "Run time of each probe command.")
+
+    def _format(self, command, output):
+        lines = output.split("\n") if output else []
+        if self.max_lines > 0 and len(lines) > self.max_lines:
+            lines = lines[:self.max_lines] + ["...({} line omited)".format(len(lines) - self.max_lines)]
+        return "\n".join(["$ " + command] + ["\t" + line for line in lines])
+
+    async def arun(self, action_input):
+        commands = split_probe_input(action_input)
+        if len(commands) == 0:
+            return "\nNo command to probe. Usage: probe[command1; command2]"
+        skipped = commands[self.max_commands:]
+        commands = commands[:self.max_commands]
+        outputs = await asyncio.gather(*[self._run_one(c) for c in commands])
+        text = "\n".join(self._format(c, o) for c, o in zip(commands, outputs))
+        if len(skipped) > 0:
+            text += "\n(skipped {} commands, at most {} per probe)".format(len(skipped), self.max_commands)
+        return "\n" + text
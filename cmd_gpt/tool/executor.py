@@ -0,0 +1,143 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import re
+
+from loguru import logger
+
+from cmd_gpt.metrics import REGISTRY
+from cmd_gpt.tool.basic.probe import DEFAULT_ALLOWLIST, check_probe_command
+
+# actions waiting on the terminal, stopped with a key press when they run too long
+TERMINAL_ACTIONS = ["terminal_run", "terminal_read"]
+
+# seconds, 0 for no deadline; other actions use ACTION_TIMEOUT
+DEFAULT_TIMEOUTS = {"terminal_search": 30, "probe": 60, "ask": 0}
+
+# shell builtins that change nothing, on top of the probe allowlist
+CONFIRM_BUILTINS = {"cd": None, "pwd": None, "echo": None, "clear": None}
+
+CONFIRM_POLICIES = ["auto", "allowlist", "always"]
+
+
+class ConfirmationPolicy:
+    """
+    Decide which actions need a go-ahead before they run. Only terminal_run
+    changes anything; with "allowlist" a command runs straight away when every
+    program in it is on the probe allowlist (or matches one of the extra
+    patterns), "always" confirms every command and "auto" none.
+    """
+    def __init__(self, mode="allowlist", allowlist=None, patterns=()):
+        if mode not in CONFIRM_POLICIES:
+            raise ValueError("Unknown confirmation policy: {} (one of {})".format(mode, ", ".join(CONFIRM_POLICIES)))
+        self.mode = mode
+        self.allowlist = allowlist if allowlist is not None else dict(DEFAULT_ALLOWLIST, **CONFIRM_BUILTINS)
+        self.patterns = [re.compile(p) for p in patterns]
+
+    def needs_confirmation(self, action, action_input):
+        if self.mode == "auto" or action != "terminal_run":
+            return False
+        if self.mode == "always":
+            return True
+        command = str(action_input).strip()
+        if any(p.search(command) for p in self.patterns):
+            return False
+        return check_probe_command(command, self.allowlist) is not None
+
+
+class ToolExecutor:
+    """
+    Run actions under a deadline each. A terminal action that runs past its
+    deadline is interrupted with Ctrl-C (q for a pager), and what it printed so
+    far comes back as the observation, tagged as timed out. When the run itself
+    is cancelled, the command being waited on is interrupted the same way.
+
+    Commands the confirmation policy does not approve either wait confirm_delay
+    seconds, a window to stop the run, or are put to the operator through ask
+    with confirm="ask".
+    """
+    def __init__(self, run_tool, cmd=None, policy=None, timeouts=None, default_timeout=600, confirm="delay", confirm_delay=3, ask=None, interrupt_timeout=5):
+        self.run_tool = run_tool
+        self.cmd = cmd
+        self.policy = policy if policy is not None else ConfirmationPolicy()
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.default_timeout = default_timeout
+        self.confirm_mode = confirm
+        self.confirm_delay = confirm_delay
+        self.ask = ask
+        self.interrupt_timeout = interrupt_timeout
+
+    @classmethod
+    def from_config(cls, config, run_tool, cmd=None, confirm_delay=3, ask=None):
+        timeouts = {}
+        for key, value in dict(config).items():
+            if key.startswith("ACTION_TIMEOUT_"):
+                timeouts[key[len("ACTION_TIMEOUT_"):].lower()] = float(value)
+        patterns = [p.strip() for p in str(config.get("CONFIRM_ALLOW", "")).split(",") if p.strip() != ""]
+        return cls(
+            run_tool,
+            cmd=cmd,
+            policy=ConfirmationPolicy(str(config.get("CONFIRM_POLICY", "allowlist")).lower(), patterns=patterns),
+            timeouts=timeouts,
+            default_timeout=float(config.get("ACTION_TIMEOUT", 600)),
+            confirm=str(config.get("CONFIRM_MODE", "delay")).lower(),
+            confirm_delay=float(config.get("CONFIRM_DELAY", confirm_delay)),
+            ask=ask,
+        )
+
+    def timeout(self, action):
+        timeout = self.timeouts.get(action, self.default_timeout)
+        return timeout if timeout > 0 else None
+
+    async def confirm(self, action, action_input):
+        """True if the action may run."""
+        if not self.policy.needs_confirmation(action, action_input):
+            logger.info("Action: " + str(action) + "; Input: " + str(action_input))
+            return True
+        if self.confirm_mode == "ask" and self.ask is not None:
+            answer = await self.ask("Run {}[{}]? [Y/n]".format(action, action_input))
+            if str(answer).strip().lower() in ["", "y", "yes"]:
+                return True
+            logger.info("Not approved: Action: " + str(action) + "; Input: " + str(action_input))
+            REGISTRY.inc("actions_declined", 1, "Actions the operator did not approve.")
+            return False
+        logger.info("Running this in {} seconds: Action: ".format(self.confirm_delay) + str(action) + "; Input: " + str(action_input))
+        await asyncio.sleep(self.confirm_delay)
+        return True
+
+    async def run(self, action, action_input):
+        timeout = self.timeout(action)
+        try:
+            return await asyncio.wait_for(self.run_tool(action, action_input), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("{}[{}] did not finish within {:g} seconds".format(action, action_input, timeout))
+            REGISTRY.inc("action_timeouts", 1, "Actions stopped at their deadline.", action=action)
+            return await self.stop(action, timeout)
+        except asyncio.CancelledError:
+            if action in TERMINAL_ACTIONS and hasattr(self.cmd, "async_interrupt"):
+                # leave the shell at a prompt, not running the command of a cancelled run
+                await self.cmd.async_interrupt()
+            raise
+
+    async def stop(self, action, timeout):
+        note = "(timed out after {:g} seconds".format(timeout)
+        if action not in TERMINAL_ACTIONS or not hasattr(self.cmd, "async_interrupt"):
+            return "\n" + note + ")"
+        key = await self.cmd.async_interrupt()
+        try:
+            partial = await asyncio.wait_for(self.cmd.async_read_output(), self.interrupt_timeout)
+        except asyncio.TimeoutError:
+            return "\n{}, sent {}, still running)".format(note, key)
+        return "{}\n{}, sent {})".format(partial, note, key)
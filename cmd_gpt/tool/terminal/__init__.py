@@ -10,4 +10,45 @@
 # distributed under the License is distributed on an "AS IS" BASIS,
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
-# limitations under the License.
\ No newline at end of file
+# limitations under the License.
+
+import sys
+
+
+def default_backend():
+    return "iterm2" if sys.platform == "darwin" else "pty"
+
+
+def setup_terminal_tool(backend=None, **kwargs):
+    # backends are imported lazily so a missing iterm2 package does not break Linux hosts
+    if backend is None:
+        backend = default_backend()
+    if backend == "iterm2":
+        from cmd_gpt.tool.terminal.iterm2 import setup_iterm2_tool
+        return setup_iterm2_tool(**kwargs)
+    elif backend == "pty":
+        from cmd_gpt.tool.terminal.pty_terminal import setup_pty_tool
+        return setup_pty_tool(**kwargs)
+    elif backend == "simulated":
+        from cmd_gpt.tool.terminal.simulated import setup_simulated_tool
+        return setup_simulated_tool(**kwargs)
+    else:
+        raise NotImplementedError("Unknown terminal backend: {}".format(backend))
+
+
+
+async def async_setup_terminal_tool(backend=None, **kwargs):
+    # like setup_terminal_tool, but the tool lives on the running event loop
+    if backend is None:
+        backend = default_backend()
+    if backend == "iterm2":
+        from cmd_gpt.tool.terminal.iterm2 import async_setup_iterm2_tool
+        return await async_setup_iterm2_tool(**kwargs)
+    elif backend == "pty":
+        from cmd_gpt.tool.terminal.pty_terminal import async_setup_pty_tool
+        return await async_setup_pty_tool(**kwargs)
+    elif backend == "simulated":
+        from cmd_gpt.tool.terminal.simulated import async_setup_simulated_tool
+        return await async_setup_simulated_tool(**kwargs)
+    else:
+        raise NotImplementedError("Unknown terminal backend: {}".format(backend))
@@ -0,0 +1,82 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+from cmd_gpt.tool.terminal.prompt_detector import DEFAULT_PROMPT_DETECTOR
+
+ANSI_ESCAPE = re.compile(r"\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[@-Z\\-_])")
+
+# less and more wait for a key instead of a signal, they are left with q
+PAGER_LINE = re.compile(r"(?:^:|\(END\)|--More--(?:\(\d+%\))?|^lines \d+-\d+.*)$")
+INTERRUPT_KEYS = {"Ctrl-C": "\x03", "q": "q"}
+
+def remove_excessive_whitespace(s):
+    return re.sub(r'\s+', ' ', s.strip())
+
+
+# check if the input line is a command prompt
+def line_is_cmd_prompt(line):
+    return DEFAULT_PROMPT_DETECTOR.is_prompt(line)
+
+
+def line_is_question(line):
+    return DEFAULT_PROMPT_DETECTOR.is_question(line)
+
+
+def line_is_cmd_prompt_or_question(line):
+    return DEFAULT_PROMPT_DETECTOR.is_prompt_or_question(line)
+
+
+def interrupt_key(last_line):
+    """Name of the key that stops what is on the last line: q for a pager, Ctrl-C otherwise."""
+    return "q" if PAGER_LINE.search(last_line.strip()) else "Ctrl-C"
+
+
+def observation_is_question(obs):
+    lines = [line for line in (obs or "").split("\n") if line.strip() != ""]
+    return len(lines) > 0 and line_is_question(lines[-1])
+
+
+def format_output(text_list, length=0):
+    if length > 0 and len(text_list) > length:
+        text_list = [f"...({len(text_list) - length} line omited)"] + text_list[-length:]
+    
+    if len(text_list) > 1:
+        text_list = ["\t" + r for r in text_list]
+
+    return "\n" + "\n".join(text_list)
+
+
+# walk back from the bottom of the screen and collect lines up to (not including) the second to last prompt
+def lines_since_last_prompt(lines, is_prompt=line_is_cmd_prompt):
+    text_list = []
+    prompt_count = 0
+    for line in reversed(lines):
+        if remove_excessive_whitespace(line) == "":
+            continue
+        if is_prompt(line):
+            prompt_count += 1
+            if prompt_count == 2:
+                break
+        text_list.append(line)
+    return list(reversed(text_list))
+
+
+
+def last_non_empty_line(lines):
+    for line in reversed(lines):
+        if line.strip() != "":
+            return line
+    return ""
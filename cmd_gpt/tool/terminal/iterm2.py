@@ -13,16 +13,24 @@
 # limitations under the License.
 
 import asyncio
-import re
+import threading
 from enum import IntEnum
 
 import iterm2
 from loguru import logger
 from pydantic import BaseModel
 
+from cmd_gpt.metrics import record_terminal_wait
+from cmd_gpt.tool.terminal.common import (
+    INTERRUPT_KEYS,
+    format_output,
+    interrupt_key,
+    last_non_empty_line,
+    lines_since_last_prompt,
+)
+from cmd_gpt.tool.terminal.prompt_detector import PromptDetector
+from cmd_gpt.tool.terminal.spool import OutputSpool
 
-def remove_excessive_whitespace(s):
-    return re.sub(r'\s+', ' ', s.strip())
 
 class iTerm2MessageType(IntEnum):
     RUN = 1
@@ -36,15 +44,32 @@ class iTerm2Message(BaseModel):
     
 
 class iTerm2Interaction:
-    def __init__(self, queue=None, read_max_length=10):
+    def __init__(self, queue=None, read_max_length=10, quiet_period=0.3, command_timeout=600, connection=None,
+                 prompt_patterns=None, question_patterns=None, prompt_learn_period=2.0, spool=True, spool_dir=None):
         self.initialized = False
-        self.connection = iterm2.Connection()
+        self._initialized_event = threading.Event()
+        self._listening = False
+        self.loop = None
+        if connection is None:
+            self.connection = iterm2.Connection()
+        else:
+            self.connection = connection
         if queue is None:
             self.queue = asyncio.Queue()
         else:
             self.queue = queue
         self.last_output = None
+        self.timings = {"wait": 0.0, "quiet": 0.0}
         self.read_max_length = read_max_length
+        self.quiet_period = quiet_period
+        self.command_timeout = command_timeout
+        self.prompt_detector = PromptDetector(prompt_patterns, question_patterns)
+        self.prompt_learn_period = prompt_learn_period
+        self.cursor = None
+        self._window = []
+        self._window_hashes = []
+        self.spool = OutputSpool(spool_dir) if spool else None
+        self._spooled = 0 # lines of the current window already in the spool
         # iterm2.run_until_complete(self._initialize)
 
     def run(self, loop, retry=True):
@@ -85,6 +110,8 @@ class iTerm2Interaction:
         else:
             logger.error("No open window. Exiting.")
             self.session = None
+        self.initialized = True
+        self._initialized_event.set()
 
     
     async def _async_run_command(self, command):
@@ -114,116 +141,171 @@ class iTerm2Interaction:
     def send_message(self, message: iTerm2Message):
         asyncio.run_coroutine_threadsafe(self._async_send_message(message), self.loop)
 
-    def _wait_for_initialization(self):
-        count = 0
-        MAX_WAIT = 5
-        while not self.initialized:
-            time.sleep(1)
-            count += 1
-            if count >= MAX_WAIT:
-                logger.error("Waited for too long. Exiting.")
-                return False
+    def _wait_for_initialization(self, timeout=5):
+        if not self._initialized_event.wait(timeout):
+            logger.error("Waited for too long. Exiting.")
+            return False
         return True
 
+    async def _async_wait_for_initialization(self, timeout=5):
+        if self.initialized:
+            return True
+        return await asyncio.to_thread(self._wait_for_initialization, timeout)
+
+    async def _await_on_loop(self, coro):
+        # iTerm2 calls must run on the loop that owns the connection
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def _run_sync(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
     def run_command(self, command):
         self.send_message(iTerm2Message(type=iTerm2MessageType.RUN, text=command))
 
+    async def async_run_command_and_get_reply(self, command):
+        success = await self._async_wait_for_initialization()
+        if not success:
+            return None
+
+        try:
+            text_list = await self._await_on_loop(self._async_wait_for_completion(command=command))
+        except iterm2.rpc.RPCException:
+            logger.debug("RPCException. Exiting.")
+            return "E: exit"
+        return format_output(text_list, self.read_max_length)
+
     def run_command_and_get_reply(self, command):
-        self.run_command(command)
-        time.sleep(2)
-        output = self.read_output(length=self.read_max_length)
-        return output
+        return self._run_sync(self.async_run_command_and_get_reply(command))
 
 
     # check if the input line is a command prompt
     def line_is_cmd_prompt(self, line):
-        if re.match(r"^[^@]*@[^$@]*\$", line.strip()): #bash
-            return True
-        elif re.match(r"^[^@]*@[^$@]*\%", line.strip()): #zsh
-            return True
-        else:
-            return False
+        return self.prompt_detector.is_prompt(line)
 
     def line_is_cmd_prompt_or_question(self, line):
-        if re.match(r"^[^@]*@[^$@]*\$$", line.strip()): # empty bash prompt
-            return True
-        elif re.match(r"^[^@]*@[^$@]*\%$", line.strip()): #empty zsh prompt
-            return True
-        elif re.match(r"^[^?]*? [Y/n]$", line.strip()): # for apt-get
-            return True
-        elif re.match(r"^Password:", line.strip()): #sudo
-            return True
-        elif re.match(r"[sudo] password for .*:", line.strip()): #sudo
-            return True
-        elif re.match(r".* password:", line.strip()): # SSH password
+        return self.prompt_detector.is_prompt_or_question(line)
+
+    def _learn_prompt(self, line):
+        if self.prompt_detector.learn(line):
+            logger.info("Learned shell prompt: {}".format(line.strip()))
             return True
-        else:
-            return False
-    
-    def is_command_line_output_the_same(self, output1, output2):
-        if output1.number_of_lines != output2.number_of_lines:
-            return False
-        
-        for i in range(output1.number_of_lines):
-            if output1.line(i).string != output2.line(i).string:
-                return False
-            
-        return True
+        return False
 
-    def get_from_last_prompt(self):
-        
-        future = asyncio.run_coroutine_threadsafe(self._async_read_output(), self.loop)
-        result_1 = future.result()
-        time.sleep(1)
-
-        while True: # make sure no change in the output 
-            future = asyncio.run_coroutine_threadsafe(self._async_read_output(), self.loop)
-            result_2 = future.result()
-
-            if not self.is_command_line_output_the_same(result_1, result_2):
-                logger.trace("command line still changing, waiting for 3 seconds")
-                time.sleep(3)
-                result_1 = result_2
-                continue
-
-            text_list = []
-            prompt_count = 0
-            logger.trace("number of lines: ", result_2.number_of_lines)
-            for i in range(result_2.number_of_lines-1, -1, -1):
-                if remove_excessive_whitespace(result_2.line(i).string) in ["", " ", "\n", "\t"]:
-                    continue
-                if result_2.line(i).string.strip() != "":
-                    if self.line_is_cmd_prompt(result_2.line(i).string):
-                        prompt_count += 1
-                        if prompt_count == 2:
-                            break
-                    logger.trace("appending: ", result_2.line(i).string)
-                    text_list.append(result_2.line(i).string)
-
-            last_line = text_list[0]
-
-            logger.trace("checking last line is prompt: ", last_line)
-            if not self.line_is_cmd_prompt_or_question(last_line):
-                logger.trace("last line is not a command prompt, waiting for 3 seconds")
-                time.sleep(3)
-                result_1 = result_2
-                continue
-
-            
-            out = list(reversed(text_list))
-            return out
-            
+    async def _async_cursor_line(self, contents):
+        # absolute line number (counting scrollback and lines lost to overflow) of the cursor row
+        info = await self.session.async_get_line_info()
+        return info, info.overflow + info.scrollback_buffer_height + contents.cursor_coord.y
 
+    async def _async_mark_cursor(self, contents):
+        _, self.cursor = await self._async_cursor_line(contents)
+        self._window = []
+        self._window_hashes = []
 
-    def read_output(self, length=0, store_history=False):
+    async def _async_fetch_window(self, contents):
+        """
+        Lines from the session cursor (the line the last command was typed on) to
+        the screen cursor, including lines that scrolled off the screen.
+
+        Only the tail of the window is fetched again: the last cached line may still
+        be changing, and the line before it is checked against its hash to detect a
+        redraw, in which case the window is fetched from the start.
+        """
+        info, end = await self._async_cursor_line(contents)
+        if self.cursor is None: # nothing run yet, start from the top of the screen
+            self.cursor = info.overflow + info.scrollback_buffer_height
+        if self.cursor < info.overflow:
+            logger.warning("{} lines of output dropped out of the scrollback".format(info.overflow - self.cursor))
+            self.cursor = info.overflow
+            self._window = []
+            self._window_hashes = []
+
+        start = self.cursor + max(len(self._window) - 1, 0)
+        if end < start: # the screen was cleared or redrawn above the last line we had
+            start = self.cursor
+        elif len(self._window) > 1:
+            previous = await self.session.async_get_contents(start - 1, 1)
+            if len(previous) == 0 or hash(previous[0].string) != self._window_hashes[-2]:
+                start = self.cursor
+
+        del self._window[start - self.cursor:]
+        del self._window_hashes[start - self.cursor:]
+        if end >= start:
+            for line in await self.session.async_get_contents(start, end - start + 1):
+                self._window.append(line.string)
+                self._window_hashes.append(hash(line.string))
+        return self._window
+
+    async def _async_wait_for_completion(self, command=None):
+        """
+        Wait on iTerm2 screen-update notifications until the last line is a prompt
+        or a question and the screen has been quiet for quiet_period seconds.
+
+        When a command is given it is sent after subscribing, and the old prompt
+        is not accepted until the screen has changed at least once.
+        """
+        if not self.session:
+            logger.error("Session is not available.")
+            return []
+        loop = asyncio.get_running_loop()
+        start = last_output = loop.time()
+        deadline = start + self.command_timeout
+        async with self.session.get_screen_streamer() as streamer:
+            if command is not None:
+                await self._async_mark_cursor(await self.session.async_get_screen_contents())
+                await self.session.async_send_text(command + '\n')
+            window = await self._async_fetch_window(await self.session.async_get_screen_contents())
+            changed = command is None
+            while True:
+                done = changed and self.line_is_cmd_prompt_or_question(last_non_empty_line(window))
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    logger.warning("Command did not finish within {} seconds".format(self.command_timeout))
+                    break
+                # a plain read on a quiet screen with an unknown last line takes that line as the prompt
+                learn = (not done and command is None and self.prompt_detector.learn_prompts
+                         and len(self.prompt_detector.learned_prompts) == 0)
+                try:
+                    if done:
+                        wait = min(self.quiet_period, remaining)
+                    elif learn:
+                        wait = min(self.prompt_learn_period, remaining)
+                    else:
+                        wait = remaining
+                    window = await self._async_fetch_window(await asyncio.wait_for(streamer.async_get(), wait))
+                    changed = True
+                    last_output = loop.time()
+                except asyncio.TimeoutError:
+                    if done or (learn and self._learn_prompt(last_non_empty_line(window))):
+                        break
+        now = loop.time()
+        record_terminal_wait("iterm2", self.timings, now - start, now - last_output if done else 0.0)
+        self._spool_window(command, window)
+        return lines_since_last_prompt(window, self.line_is_cmd_prompt)
+
+    def _spool_window(self, command, window):
+        # the screen only shows the window, so spool it as waits end; its last line may still change
+        if self.spool is None:
+            return
+        if command is not None:
+            self.spool.begin_command(command)
+            self._spooled = 0
+        self.spool.write_lines(window[self._spooled:-1])
+        self._spooled = max(self._spooled, len(window) - 1)
+
+    def get_from_last_prompt(self):
+        return self._run_sync(self._async_wait_for_completion())
+
+    async def async_read_output(self, length=0, store_history=False):
         length = int(length)
 
-        success = self._wait_for_initialization()
+        success = await self._async_wait_for_initialization()
         if not success:
             return None
         
         try:
-            text_list = self.get_from_last_prompt()
+            text_list = await self._await_on_loop(self._async_wait_for_completion())
         except iterm2.rpc.RPCException:
             logger.debug("RPCException. Exiting.")
             return "E: exit"
@@ -232,20 +314,28 @@ class iTerm2Interaction:
         if store_history:
             self.last_output = text_list
 
-        if length > 0 and len(text_list) > length:
-            text_list = [f"...({len(text_list) - length} line omited)"] + text_list[-length:]
-        
-        if len(text_list) > 1:
-            for i, r in enumerate(text_list):
-                text_list[i] = "\t" + r
+        return format_output(text_list, length)
 
-        ret = "\n" + "\n".join(text_list)
+    def read_output(self, length=0, store_history=False):
+        return self._run_sync(self.async_read_output(length, store_history))
+
+    async def _async_interrupt(self, key):
+        if not self.session:
+            logger.error("Session is not available.")
+            return ""
+        if key is None:
+            contents = await self.session.async_get_screen_contents()
+            key = interrupt_key(contents.line(contents.cursor_coord.y).string) # a pager's prompt is on the cursor line
+        await self.session.async_send_text(INTERRUPT_KEYS[key])
+        return key
 
-        return ret
+    async def async_interrupt(self, key=None):
+        """Send Ctrl-C, or q when a pager is waiting, and return the name of the key sent."""
+        return await self._await_on_loop(self._async_interrupt(key))
 
     async def listen(self) -> None:
+        self._listening = True
         await self.initialize()
-        self.initialized = True
         while True:
             message = await self.queue.get()
             if type(message) != iTerm2Message:
@@ -261,23 +351,42 @@ class iTerm2Interaction:
                 return
     
     def close(self) -> None:
-        self.send_message(iTerm2Message(type=iTerm2MessageType.END, text=""))
+        if self._listening:
+            self.send_message(iTerm2Message(type=iTerm2MessageType.END, text=""))
+        if self.spool is not None:
+            self.spool.close()
 
 
-import threading
-import time
+# each tool gets its own event loop and thread (and so its own connection and tab),
+# which lets several agents drive iTerm2 concurrently
+def setup_iterm2_tool(**kwargs):
+    loop = asyncio.new_event_loop()
 
+    async def make_queue():
+        return asyncio.Queue()
 
-# TODO: this doesn't work in jupyter notebook, need to get iterm2 to run in a new event loop
-def setup_iterm2_tool(**kwargs):
-    loop = asyncio.get_event_loop()
-    queue = asyncio.Queue()
+    queue = loop.run_until_complete(make_queue())
     term = iTerm2Interaction(queue, **kwargs)
+    term.loop = loop
 
     def start_loop(term, loop):
+        asyncio.set_event_loop(loop)
         loop.run_until_complete(term.run(loop))
 
-    t = threading.Thread(target=start_loop, args=(term, loop))
+    t = threading.Thread(target=start_loop, args=(term, loop), daemon=True)
     t.start()
 
-    return term
\ No newline at end of file
+    return term
+
+
+async def async_setup_iterm2_tool(connection=None, **kwargs):
+    """
+    Set up the tool on the running event loop, no background thread. Several
+    tools can share one connection; each one works in its own new tab.
+    """
+    if connection is None:
+        connection = await iterm2.Connection.async_create()
+    term = iTerm2Interaction(asyncio.Queue(), connection=connection, **kwargs)
+    term.loop = asyncio.get_running_loop()
+    await term.initialize()
+    return term
@@ -0,0 +1,123 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+
+# A prompt pattern matches the prompt itself; it may be followed by a typed command.
+DEFAULT_PROMPT_PATTERNS = [
+    r"[^@\s]+@[^\s$#%@]+(?:[ :][^$#%@]*)?[$#%]", # bash/zsh: user@host:~$, root@host:/#, user@host ~ %
+    r"\[[^\]@]+@[^\]]+\][$#%]", # [user@host dir]$ (RHEL/CentOS)
+    r"[^@\s]+@[^\s>]+ [^>]*>", # fish: user@host ~>
+    r"(?:ba|z|da)?sh-[\d.]+[$#]", # sh-4.2$
+    r">>>", # python REPL
+    r"In \[\d+\]:", # ipython
+    r"\(Pdb\)",
+    r"(?:mysql|mariadb|sqlite)>", # SQL shells
+    r"[\w-]+=[#>]", # psql: postgres=#
+    r"PS [A-Za-z]:\\[^>]*>", # PowerShell
+]
+
+# A question pattern matches at the end of the line.
+DEFAULT_QUESTION_PATTERNS = [
+    r"\[[Yy]/[Nn]\]\??", # apt-get: Do you want to continue? [Y/n]
+    r"\([Yy]es/[Nn]o(?:/\[fingerprint\])?\)\??", # ssh host key confirmation
+    r"\[sudo\] password for [^:]*:",
+    r"[Pp]assword(?: for [^:]*)?:", # sudo, su
+    r" password:", # ssh: user@host's password:
+    r"[Pp]assphrase[^:]*:", # ssh keys
+    r"Press (?:any key|\[?ENTER\]?|RETURN)[^.]*\.*",
+    r"^:", # less
+    r"\(END\)", # less at the end of the file
+    r"--More--(?:\(\d+%\))?", # more
+]
+
+# path-like parts of a learned prompt (the working directory) may change between commands
+PROMPT_PATH_TOKEN = re.compile(r"(?:~|/)[^\s$#%>]*")
+
+# questions and empty prompts end the line, so only the tail of very long lines is inspected
+MAX_TAIL_LENGTH = 200
+
+# lines waiting for an answer rather than a command: "Enter name:", "Continue?", "(y/N)"
+NOT_A_PROMPT = re.compile(r"(?:[:?]|\([^()]*/[^()]*\))\s*$")
+
+MAX_LEARNED_PROMPTS = 4
+
+
+def prompt_to_pattern(prompt):
+    parts = []
+    pos = 0
+    for m in PROMPT_PATH_TOKEN.finditer(prompt):
+        parts.append(re.escape(prompt[pos:m.start()]))
+        parts.append(r"[^\s$#%>]*")
+        pos = m.end()
+    parts.append(re.escape(prompt[pos:]))
+    return "".join(parts)
+
+
+class PromptDetector:
+    """
+    Decide whether a terminal line is a shell prompt, or a question waiting for input.
+
+    All patterns are compiled into one alternation per check. Extra patterns can be
+    given through the terminal config (prompt_patterns/question_patterns), and the
+    exact prompt of a session is learned with learn() and matched from then on, with
+    any working directory in it generalized.
+    """
+    def __init__(self, prompt_patterns=None, question_patterns=None, learn_prompts=True):
+        self.prompt_patterns = DEFAULT_PROMPT_PATTERNS + list(prompt_patterns or [])
+        self.question_patterns = DEFAULT_QUESTION_PATTERNS + list(question_patterns or [])
+        self.learn_prompts = learn_prompts
+        self.learned_prompts = []
+        self._compile()
+
+    def _compile(self):
+        prompts = "|".join("(?:" + p + ")" for p in self.prompt_patterns + self.learned_prompts)
+        questions = "|".join("(?:" + p + ")" for p in self.question_patterns)
+        self._prompt = re.compile(r"^\s*(?:" + prompts + ")")
+        self._question = re.compile(r"(?:" + questions + r")\s*$")
+        self._prompt_or_question = re.compile(r"^\s*(?:" + prompts + r")\s*$|(?:" + questions + r")\s*$")
+
+    def is_prompt(self, line):
+        return self._prompt.match(line) is not None
+
+    def is_question(self, line):
+        line = line.strip()
+        return self._question.search(line[-MAX_TAIL_LENGTH:]) is not None
+
+    def is_prompt_or_question(self, line):
+        # an empty prompt (nothing typed after it) or a question
+        line = line.strip()
+        return self._prompt_or_question.search(line[-MAX_TAIL_LENGTH:]) is not None
+
+    def learn(self, line):
+        """
+        Remember line as this session's prompt, unless it is already known, looks
+        like a question (ends in ":", "?" or a choice such as "(y/N)"), or
+        MAX_LEARNED_PROMPTS have been learned already.
+        """
+        line = line.strip()
+        if not self.learn_prompts or line == "" or len(line) > MAX_TAIL_LENGTH or len(self.learned_prompts) >= MAX_LEARNED_PROMPTS:
+            return False
+        if self.is_prompt(line) or self.is_question(line) or NOT_A_PROMPT.search(line) is not None:
+            return False
+        pattern = prompt_to_pattern(line)
+        if pattern in self.learned_prompts:
+            return False
+        self.learned_prompts.append(pattern)
+        self._compile()
+        return True
+
+
+DEFAULT_PROMPT_DETECTOR = PromptDetector(learn_prompts=False)
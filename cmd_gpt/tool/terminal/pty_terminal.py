@@ -0,0 +1,347 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import codecs
+import fcntl
+import os
+import pty
+import select
+import signal
+import struct
+import termios
+import time
+
+from loguru import logger
+
+from cmd_gpt.metrics import record_terminal_wait
+from cmd_gpt.tool.terminal.common import (
+    ANSI_ESCAPE,
+    INTERRUPT_KEYS,
+    format_output,
+    interrupt_key,
+    last_non_empty_line,
+    lines_since_last_prompt,
+)
+from cmd_gpt.tool.terminal.prompt_detector import PromptDetector
+from cmd_gpt.tool.terminal.spool import OutputSpool
+
+# a literal "$" even for root, so the prompt looks the same for every user
+DEFAULT_PS1 = r"\u@\h:\w$ "
+
+
+class PtyInteraction:
+    """
+    Drive a local shell over a pseudo-terminal.
+
+    Same surface as iTerm2Interaction (run_command_and_get_reply, read_output,
+    close), but output is read from the pty as a non-blocking stream into a
+    local line buffer instead of fetching the screen over RPC, so it works on
+    any POSIX host.
+    """
+    def __init__(self, shell=None, read_max_length=10, quiet_period=0.3, command_timeout=600, rows=40, cols=200, max_history_lines=10000, env=None,
+                 prompt_patterns=None, question_patterns=None, prompt_learn_period=2.0, spool=True, spool_dir=None):
+        if shell is None:
+            shell = ["/bin/bash", "--noprofile", "--norc", "-i"]
+        elif isinstance(shell, str):
+            shell = [shell]
+        self.shell = shell
+        self.read_max_length = read_max_length
+        self.quiet_period = quiet_period
+        self.command_timeout = command_timeout
+        self.prompt_detector = PromptDetector(prompt_patterns, question_patterns)
+        self.prompt_learn_period = prompt_learn_period
+        self.max_history_lines = max_history_lines
+        self.last_output = None
+        self.timings = {"wait": 0.0, "quiet": 0.0}
+        self.spool = OutputSpool(spool_dir) if spool else None # every line, also those dropped from self.lines
+
+        self.lines = []
+        self.partial = ""
+        self._line_base = 0 # absolute line number of self.lines[0]
+        self.cursor = 0 # absolute line number the last command was typed on
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.alive = True
+        self._settled = False # the last wait ended on a prompt that stayed quiet
+
+        child_env = dict(os.environ)
+        child_env["PS1"] = DEFAULT_PS1
+        child_env["TERM"] = "dumb"
+        if env is not None:
+            child_env.update(env)
+
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0: # child
+            try:
+                os.execvpe(self.shell[0], self.shell, child_env)
+            finally:
+                os._exit(1)
+
+        fcntl.ioctl(self.fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+        os.set_blocking(self.fd, False)
+        self.initialized = True
+
+    def _feed(self, text):
+        text = ANSI_ESCAPE.sub("", text).replace("\r\n", "\n")
+        parts = text.split("\n")
+        parts[0] = self.partial + parts[0]
+        new_lines = [self._apply_carriage_return(line) for line in parts[:-1]]
+        self.lines.extend(new_lines)
+        if self.spool is not None:
+            self.spool.write_lines(new_lines)
+        self.partial = self._apply_carriage_return(parts[-1])
+
+        if len(self.lines) > self.max_history_lines:
+            dropped = len(self.lines) - self.max_history_lines
+            del self.lines[:dropped]
+            self._line_base += dropped
+
+    def _apply_carriage_return(self, line):
+        # a bare \r redraws the line (progress bars), keep the last version
+        if "\r" in line:
+            line = line.rstrip("\r").split("\r")[-1]
+        return line
+
+    def _read_available(self):
+        """Drain whatever the shell has written so far, return True if anything was read."""
+        got_data = False
+        while self.alive:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            except OSError: # EIO: the shell has exited
+                self.alive = False
+                break
+            if not data:
+                self.alive = False
+                break
+            self._feed(self._decoder.decode(data))
+            got_data = True
+            self._settled = False
+        return got_data
+
+    def run_command(self, command):
+        if not self.alive:
+            logger.error("Shell is not available.")
+            return
+        self._read_available()
+        self.cursor = self._line_base + len(self.lines) # the partial line holding the prompt
+        self._settled = False
+        if self.spool is not None:
+            self.spool.begin_command(command)
+        os.write(self.fd, (command + "\n").encode())
+
+    def _reply(self, text_list, length):
+        if not self.alive and len(text_list) == 0:
+            logger.debug("Shell exited. Exiting.")
+            return "E: exit"
+        return format_output(text_list, length)
+
+    def run_command_and_get_reply(self, command):
+        self.run_command(command)
+        text_list = self.wait_for_completion(require_change=True)
+        return self._reply(text_list, self.read_max_length)
+
+    async def async_run_command_and_get_reply(self, command):
+        self.run_command(command)
+        text_list = await self.async_wait_for_completion(require_change=True)
+        return self._reply(text_list, self.read_max_length)
+
+    def line_is_cmd_prompt(self, line):
+        return self.prompt_detector.is_prompt(line)
+
+    def line_is_cmd_prompt_or_question(self, line):
+        return self.prompt_detector.is_prompt_or_question(line)
+
+    def window(self):
+        """Lines since the line the last command was typed on."""
+        start = self.cursor - self._line_base
+        if start < 0:
+            logger.warning("{} lines of output dropped out of the history".format(-start))
+            start = 0
+        return self.lines[start:] + [self.partial]
+
+    def _last_line(self):
+        if self.partial.strip() != "":
+            return self.partial
+        return last_non_empty_line(self.lines[max(self.cursor - self._line_base, 0):])
+
+    def _completion_state(self, changed, deadline, may_learn):
+        """
+        Returns (done, seconds to wait for more output or None to stop waiting, learn).
+        learn is True when a quiet unknown last line should be taken as the prompt.
+        """
+        if not self.alive:
+            return True, None, False
+        # only the last line is looked at while waiting, the window is collected once at the end
+        done = changed and self.line_is_cmd_prompt_or_question(self._last_line())
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning("Command did not finish within {} seconds".format(self.command_timeout))
+            return done, None, False
+        if done:
+            return done, min(self.quiet_period, remaining), False
+        learn = may_learn and self.prompt_detector.learn_prompts and len(self.prompt_detector.learned_prompts) == 0
+        return done, min(self.prompt_learn_period, remaining) if learn else remaining, learn
+
+    def _learn_idle_prompt(self):
+        line = self._last_line()
+        if self.prompt_detector.learn(line):
+            logger.info("Learned shell prompt: {}".format(line.strip()))
+            return True
+        return False
+
+    def _text_since_command(self):
+        return lines_since_last_prompt(self.window(), self.line_is_cmd_prompt)
+
+    def _record_wait(self, start, last_output, done):
+        now = time.monotonic()
+        record_terminal_wait("pty", self.timings, now - start, now - last_output if done else 0.0)
+
+    def wait_for_completion(self, require_change=False):
+        """
+        select() on the pty until the last line is a prompt or a question and no
+        output arrived for quiet_period seconds, or command_timeout expires.
+        """
+        new_output = self._read_available()
+        if self._settled and not new_output and not require_change:
+            return self._text_since_command() # nothing arrived since the prompt was confirmed quiet
+        start = last_output = time.monotonic()
+        deadline = start + self.command_timeout
+        changed = new_output or not require_change
+        while True:
+            done, wait, learn = self._completion_state(changed, deadline, not require_change)
+            if wait is None:
+                break
+            readable, _, _ = select.select([self.fd], [], [], wait)
+            if readable:
+                if self._read_available():
+                    changed = True
+                    last_output = time.monotonic()
+            elif done or (learn and self._learn_idle_prompt()):
+                break
+        self._settled = done
+        self._record_wait(start, last_output, done)
+        return self._text_since_command()
+
+    async def _async_wait_readable(self, timeout):
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(self.fd, readable.set)
+        try:
+            await asyncio.wait_for(readable.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(self.fd)
+
+    async def async_wait_for_completion(self, require_change=False):
+        # same as wait_for_completion, but waits on the event loop instead of select()
+        new_output = self._read_available()
+        if self._settled and not new_output and not require_change:
+            return self._text_since_command() # nothing arrived since the prompt was confirmed quiet
+        start = last_output = time.monotonic()
+        deadline = start + self.command_timeout
+        changed = new_output or not require_change
+        while True:
+            done, wait, learn = self._completion_state(changed, deadline, not require_change)
+            if wait is None:
+                break
+            if await self._async_wait_readable(wait):
+                if self._read_available():
+                    changed = True
+                    last_output = time.monotonic()
+            elif done or (learn and self._learn_idle_prompt()):
+                break
+        self._settled = done
+        self._record_wait(start, last_output, done)
+        return self._text_since_command()
+
+    def get_from_last_prompt(self):
+        return self.wait_for_completion()
+
+    def read_output(self, length=0, store_history=False):
+        text_list = self.wait_for_completion()
+        if store_history:
+            self.last_output = text_list
+        return self._reply(text_list, int(length))
+
+    async def async_read_output(self, length=0, store_history=False):
+        text_list = await self.async_wait_for_completion()
+        if store_history:
+            self.last_output = text_list
+        return self._reply(text_list, int(length))
+
+    async def async_interrupt(self, key=None):
+        """Send Ctrl-C, or q when a pager is waiting, and return the name of the key sent."""
+        if not self.alive:
+            return ""
+        self._read_available()
+        key = key or interrupt_key(self._last_line())
+        os.write(self.fd, INTERRUPT_KEYS[key].encode())
+        self._settled = False
+        return key
+
+    def _reap(self, timeout):
+        """Wait up to timeout seconds for the shell to exit, then kill it."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                pid, _ = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError: # already reaped
+                return
+            if pid != 0:
+                return
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.02)
+        logger.debug("Shell {} did not exit, killing it".format(self.pid))
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        try:
+            os.waitpid(self.pid, 0)
+        except ChildProcessError:
+            pass
+
+    def close(self, timeout=1.0) -> None:
+        if self.fd is None:
+            return
+        if self.alive:
+            try:
+                os.write(self.fd, b"exit\n")
+            except OSError:
+                pass
+        try:
+            os.kill(self.pid, signal.SIGHUP)
+        except ProcessLookupError:
+            pass
+        self._reap(timeout)
+        os.close(self.fd)
+        self.fd = None
+        self.alive = False
+        if self.spool is not None:
+            self.spool.close()
+
+
+def setup_pty_tool(**kwargs):
+    return PtyInteraction(**kwargs)
+
+
+async def async_setup_pty_tool(**kwargs):
+    return PtyInteraction(**kwargs)
@@ -0,0 +1,188 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import re
+import time
+from typing import List
+
+from loguru import logger
+from pydantic import BaseModel
+
+from cmd_gpt.metrics import record_terminal_wait
+from cmd_gpt.tool.terminal.common import format_output, interrupt_key
+from cmd_gpt.tool.terminal.spool import OutputSpool
+
+
+class SimulatedQuestion(BaseModel):
+    question: str
+    answer: str = "" # regex the answer must match, empty accepts anything
+    output: str = "" # printed after a correct answer
+    latency: float = 0.0
+    wrong_answer_output: str = "Sorry, try again."
+
+
+class SimulatedCommand(BaseModel):
+    """
+    One scripted reaction of the simulated terminal. The first rule whose match
+    regex is found in a command runs. Questions are asked one after another
+    instead of the prompt, each treating the next command as its answer; a wrong
+    answer aborts the command.
+    """
+    match: str
+    output: str = ""
+    latency: float = 0.0
+    questions: List[SimulatedQuestion] = []
+    prompt: str = "" # new prompt once the command finishes, e.g. after an ssh hop
+    times: int = 0 # stop matching after this many uses, 0 for no limit
+    partial: str = "" # on the screen while the command runs, all that is left if it is interrupted
+
+
+class SimulatedTerminal:
+    """
+    Stand-in for a real terminal with scripted outputs, prompts and latencies, used
+    to exercise the agent offline. It has the same tool interface as the real
+    backends.
+    """
+    def __init__(self, commands=None, prompt="user@sim:~$ ", default_latency=0.05, read_max_length=0, not_found_output="{command}: command not found", spool=True, spool_dir=None):
+        self.commands = [c if isinstance(c, SimulatedCommand) else SimulatedCommand(**c) for c in (commands or [])]
+        self.prompt = prompt
+        self.default_latency = default_latency
+        self.read_max_length = read_max_length
+        self.not_found_output = not_found_output
+        self.history: List[str] = []
+        self.probe_history: List[str] = []
+        self.uses = [0] * len(self.commands)
+        self.pending = None # (rule, index of the question waiting for an answer)
+        self.running = None # (command, partial output, prompt before it) of the command being waited on
+        self.last_rule = None
+        self.interrupts: List[str] = []
+        self.last_lines = [prompt]
+        self.timings = {"wait": 0.0, "quiet": 0.0}
+        self.spool = OutputSpool(spool_dir) if spool else None
+
+    def match(self, command, use=True):
+        for k, rule in enumerate(self.commands):
+            if rule.times and self.uses[k] >= rule.times:
+                continue
+            if re.search(rule.match, command):
+                if use:
+                    self.uses[k] += 1
+                return rule
+        return None
+
+    def _execute(self, command):
+        latency, lines = self._respond(command)
+        self._spool(command, lines)
+        return latency, lines
+
+    def _spool(self, command, lines):
+        if self.spool is not None:
+            self.spool.begin_command(command)
+            self.spool.write_lines([self.last_lines[-1] + command] + lines[:-1])
+
+    def _respond(self, command):
+        # returns (latency, output lines ending with the prompt or question)
+        self.history.append(command)
+        self.last_rule = None
+        if self.pending is not None:
+            rule, k = self.pending
+            question = rule.questions[k]
+            self.pending = None
+            if question.answer and not re.search(question.answer, command):
+                return question.latency, self._lines(question.wrong_answer_output)
+            return question.latency, self._continue(rule, k + 1, question.output)
+
+        rule = self.match(command)
+        if rule is None:
+            logger.debug("No simulated command matches: " + command)
+            return self.default_latency, self._lines(self.not_found_output.format(command=command.split(" ")[0]))
+        self.last_rule = rule
+        return rule.latency, self._continue(rule, 0, rule.output)
+
+    def _continue(self, rule, k, output):
+        if k < len(rule.questions):
+            self.pending = (rule, k)
+            return self._lines(output, end=rule.questions[k].question)
+        if rule.prompt:
+            self.prompt = rule.prompt
+        return self._lines(output)
+
+    def _lines(self, output, end=None):
+        lines = output.split("\n") if output else []
+        return lines + [self.prompt if end is None else end]
+
+    def run_command_and_get_reply(self, command):
+        latency, self.last_lines = self._execute(command)
+        record_terminal_wait("simulated", self.timings, latency, 0.0)
+        time.sleep(latency)
+        return format_output(self.last_lines, self.read_max_length)
+
+    async def async_run_command_and_get_reply(self, command):
+        prompt = self.prompt
+        latency, lines = self._respond(command)
+        rule = self.last_rule
+        self.running = (command, rule.partial.split("\n") if rule is not None and rule.partial else [], prompt)
+        start = time.monotonic()
+        try:
+            await asyncio.sleep(latency) # cancelled here when the command is interrupted
+        finally:
+            record_terminal_wait("simulated", self.timings, time.monotonic() - start, 0.0)
+        self.running = None
+        self._spool(command, lines)
+        self.last_lines = lines
+        return format_output(self.last_lines, self.read_max_length)
+
+    async def async_probe(self, command, timeout=10):
+        # a side session: the rule's output without using it up, changing the prompt or asking its questions
+        self.probe_history.append(command)
+        rule = self.match(command, use=False)
+        if rule is None:
+            await asyncio.sleep(self.default_latency)
+            return self.not_found_output.format(command=command.split(" ")[0])
+        await asyncio.sleep(min(rule.latency, timeout))
+        return rule.output
+
+    def read_output(self, length=0, store_history=False):
+        return format_output(self.last_lines, int(length))
+
+    async def async_read_output(self, length=0, store_history=False):
+        return self.read_output(length, store_history)
+
+    async def async_interrupt(self, key=None):
+        key = key or interrupt_key(self.last_lines[-1] if self.running is None else "")
+        self.interrupts.append(key)
+        if self.running is not None:
+            # the command never got to its questions or new prompt
+            command, partial, self.prompt = self.running
+            self.running, self.pending = None, None
+            self._spool(command, partial + ["^C", self.prompt])
+            self.last_lines = partial + ["^C", self.prompt]
+        elif self.pending is not None:
+            self.pending = None
+            self.last_lines = self.last_lines[:-1] + [self.last_lines[-1] + "^C", self.prompt]
+        return key
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+
+
+def setup_simulated_tool(**kwargs):
+    return SimulatedTerminal(**kwargs)
+
+
+async def async_setup_simulated_tool(**kwargs):
+    return SimulatedTerminal(**kwargs)
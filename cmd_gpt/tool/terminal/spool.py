@@ -0,0 +1,212 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import os
+import re
+import sys
+import tempfile
+from array import array
+from bisect import bisect_right
+
+LINE_RANGE = re.compile(r"^\s*(\d+)\s*(?:-|:|\.\.)\s*(\d+)?\s*$")
+
+
+class OutputSpool:
+    """
+    The complete output of a terminal session in an append-only file, so output
+    that scrolled away or was cut from an observation can still be searched or
+    read by line number.
+
+    Only the start offset of every line is kept in memory (8 bytes per line);
+    reads and regex searches go through an mmap of the file. The file is
+    removed when the spool is closed.
+    """
+    def __init__(self, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix="cmd_gpt-", suffix=".spool", dir=directory)
+        self._file = os.fdopen(fd, "w+b")
+        self.offsets = array("Q")
+        self.size = 0
+        self.commands = [] # (first line of the command's output, command)
+        self._mmap = None
+        self._mapped_size = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def begin_command(self, command):
+        self.commands.append((len(self.offsets), command))
+
+    def write_lines(self, lines):
+        for line in lines:
+            data = (line + "\n").encode("utf-8", errors="replace")
+            self.offsets.append(self.size)
+            self.size += len(data)
+            self._file.write(data)
+
+    def _map(self):
+        if self.size == 0:
+            return None
+        if self._mapped_size != self.size:
+            self._file.flush()
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._mapped_size = self.size
+        return self._mmap
+
+    def _offset(self, line):
+        return self.offsets[line] if line < len(self.offsets) else self.size
+
+    def command_lines(self, k=-1):
+        """(start, end) line numbers, end exclusive, of the output of the k-th command."""
+        if len(self.commands) == 0:
+            return 0, len(self.offsets)
+        start, _ = self.commands[k]
+        end = self.commands[k + 1][0] if k != -1 and k + 1 < len(self.commands) else len(self.offsets)
+        return start, end
+
+    def last_command(self):
+        return self.commands[-1][1] if len(self.commands) > 0 else ""
+
+    def read(self, start, end):
+        """Lines start to end, end exclusive, 0-based."""
+        start, end = max(start, 0), min(end, len(self.offsets))
+        mm = self._map()
+        if mm is None or start >= end:
+            return []
+        return mm[self.offsets[start]:self._offset(end)].decode("utf-8", errors="replace").split("\n")[:end - start]
+
+    def search(self, pattern, start=0, end=None, max_matches=20):
+        """
+        Line numbers (0-based) of the first max_matches lines between start and end
+        matching the regex, and the number of matching lines in total.
+        """
+        end = len(self.offsets) if end is None else min(end, len(self.offsets))
+        mm = self._map()
+        if mm is None or start >= end:
+            return [], 0
+        regex = compile_pattern(pattern)
+        matches, total = [], 0
+        pos, endpos = self.offsets[start], self._offset(end)
+        while pos < endpos:
+            m = regex.search(mm, pos, endpos)
+            if m is None:
+                break
+            line = bisect_right(self.offsets, m.start()) - 1
+            total += 1
+            if len(matches) < max_matches:
+                matches.append(line)
+            pos = self._offset(line + 1) # one hit per line
+        return matches, total
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def compile_pattern(pattern):
+    try:
+        return re.compile(pattern.encode("utf-8"), re.IGNORECASE | re.MULTILINE)
+    except re.error: # not a valid regex, search for the text itself
+        return re.compile(re.escape(pattern.encode("utf-8")), re.IGNORECASE)
+
+
+def parse_line_range(text):
+    """"120-160" (also "120:160" or "120..160", "120-" to the end) to 1-based (start, end); None if it is not a range."""
+    m = LINE_RANGE.match(str(text))
+    if m is None:
+        return None
+    start = int(m.group(1))
+    end = int(m.group(2)) if m.group(2) is not None else sys.maxsize
+    return start, end
+
+
+class SpoolTools:
+    """
+    terminal_search and line range terminal_read on top of a terminal tool that
+    spools its output. A plain terminal_read[lines] still reads the screen.
+    """
+    def __init__(self, cmd, context_lines=2, max_matches=20, max_read_lines=200):
+        self.cmd = cmd
+        self.context_lines = context_lines
+        self.max_matches = max_matches
+        self.max_read_lines = max_read_lines
+
+    @property
+    def spool(self):
+        return self.cmd.spool
+
+    def _numbered(self, lines, start, marks=()):
+        return ["{}{} {}".format(start + k + 1, ":" if start + k in marks else "-" if marks else ":", line) for k, line in enumerate(lines)]
+
+    def read_range(self, start, end):
+        total = len(self.spool)
+        if total == 0:
+            return "\nNothing has been spooled yet."
+        start, end = max(start, 1), min(end, total)
+        if end < start:
+            return "\nThe output has {} lines.".format(total)
+        end = min(end, start + self.max_read_lines - 1)
+        lines = self.spool.read(start - 1, end)
+        return "\n" + "\n".join(["Lines {}-{} of {}:".format(start, end, total)] + self._numbered(lines, start - 1))
+
+    async def read(self, action_input=""):
+        line_range = parse_line_range(action_input)
+        if line_range is not None:
+            return self.read_range(*line_range)
+        return await self.cmd.async_read_output(action_input or 0)
+
+    def search_text(self, pattern):
+        pattern = str(pattern).strip()
+        if pattern == "":
+            return "\nNo pattern. Usage: terminal_search[pattern]"
+        # the last command's output (without the line it was typed on) first, the whole session if it has no match
+        start, end = self.spool.command_lines()
+        scope = "the session"
+        if len(self.spool.commands) > 0:
+            command = self.spool.last_command()
+            scope = "the output of `{}`".format(command if len(command) <= 60 else command[:57] + "...")
+            start = min(start + 1, end)
+        matches, total = self.spool.search(pattern, start, end, self.max_matches)
+        if total == 0 and start > 0:
+            start, end, scope = 0, len(self.spool), "the session"
+            matches, total = self.spool.search(pattern, start, end, self.max_matches)
+        if total == 0:
+            return "\nNo line matches '{}' in {} ({} lines).".format(pattern, scope, end - start)
+
+        header = "{} {} '{}' in {} (lines {}-{})".format(total, "line matches" if total == 1 else "lines match", pattern, scope, start + 1, end)
+        if total > len(matches):
+            header += ", showing the first {}".format(len(matches))
+        text = [header + ":"]
+        marks = set(matches)
+        last = None
+        for line in matches:
+            lo, hi = max(line - self.context_lines, start, last + 1 if last is not None else 0), min(line + self.context_lines + 1, end)
+            if last is not None and lo > last + 1:
+                text.append("--")
+            if hi > lo:
+                text += self._numbered(self.spool.read(lo, hi), lo, marks)
+                last = hi - 1
+        return "\n" + "\n".join(text)
+
+    async def search(self, action_input):
+        return self.search_text(action_input)
@@ -14,6 +14,7 @@
 
 import os
 import sys
+import time
 
 import fire
 import yaml
@@ -44,14 +45,156 @@ def load_config():
     config_path = os.path.join(os.path.dirname(__file__), "config/key.yaml")
     return source_env(config_path)
 
-def run(prompt: str, logger_level:str="INFO"):
+def setup_metrics(config):
+    from cmd_gpt.metrics import REGISTRY
+    if config.get("METRICS_PORT"):
+        REGISTRY.serve(config["METRICS_PORT"], config.get("METRICS_ADDR", "127.0.0.1"))
+    return REGISTRY
+
+def write_metrics(config, registry):
+    if config.get("METRICS_PATH"):
+        registry.write(config["METRICS_PATH"])
+
+def run(prompt: str, logger_level:str="INFO", backend:str=None, max_actions_per_step:int=1):
     config = load_config()
     setup_logging(logger_level)
+    registry = setup_metrics(config)
     from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent
-    agent = DeploymentCmdAgent(config)
+    backend = backend or config.get("TERMINAL_BACKEND")
+    agent = DeploymentCmdAgent(config, cmd_confg={"backend": backend}, max_actions_per_step=max_actions_per_step)
     agent.run(prompt)
     agent.close()
+    write_metrics(config, registry)
+
+def fanout(task_template: str, hosts, concurrency:int=8, logger_level:str="INFO", backend:str=None, max_actions_per_step:int=1):
+    """
+    Run the same task on many hosts concurrently, e.g.
+    python run.py fanout "install htop on {host} with ssh username ubuntu" --hosts=hosts.txt
+    """
+    config = load_config()
+    setup_logging(logger_level)
+    registry = setup_metrics(config)
+    from cmd_gpt.agent.fanout import format_result_table, run_fanout
+    backend = backend or config.get("TERMINAL_BACKEND")
+    agent_kwargs = {"cmd_confg": {"backend": backend}, "max_actions_per_step": max_actions_per_step}
+    results = run_fanout(config, hosts, task_template, concurrency=concurrency, agent_kwargs=agent_kwargs)
+    print(format_result_table(results))
+    write_metrics(config, registry)
+
+def batch(tasks: str, output:str="batch_results.jsonl", workers:int=4, logger_level:str="INFO", backend:str=None, max_actions_per_step:int=1, resume:bool=True):
+    """
+    Run a YAML or JSONL file of tasks on a pool of terminal sessions, e.g.
+    python run.py batch tasks.yaml --workers=8 --output=results.jsonl
+    Results are appended to output as tasks finish; rerunning skips completed tasks.
+    """
+    config = load_config()
+    setup_logging(logger_level)
+    registry = setup_metrics(config)
+    from cmd_gpt.agent.batch import format_batch_summary, load_tasks, run_batch
+    backend = backend or config.get("TERMINAL_BACKEND")
+    agent_kwargs = {"cmd_confg": {"backend": backend}, "max_actions_per_step": max_actions_per_step}
+    start = time.monotonic()
+    results = run_batch(config, load_tasks(tasks), output, workers=workers, agent_kwargs=agent_kwargs, resume=resume)
+    print(format_batch_summary(results, time.monotonic() - start))
+    write_metrics(config, registry)
+
+def plan(task: str, concurrency:int=4, logger_level:str="INFO", backend:str=None, max_actions_per_step:int=1):
+    """
+    Split a task into a graph of subtasks with one LLM call and run independent
+    subtasks at the same time, each in its own terminal session, e.g.
+    python run.py plan "set up nginx, postgres and redis"
+    """
+    config = load_config()
+    setup_logging(logger_level)
+    registry = setup_metrics(config)
+    from cmd_gpt.agent.planner import format_plan_report, run_plan
+    backend = backend or config.get("TERMINAL_BACKEND")
+    agent_kwargs = {"cmd_confg": {"backend": backend}, "max_actions_per_step": max_actions_per_step}
+    result = run_plan(config, task, concurrency=concurrency, agent_kwargs=agent_kwargs)
+    print(format_plan_report(result))
+    write_metrics(config, registry)
+
+def daemon(logger_level:str="INFO", backend:str=None, max_actions_per_step:int=1, socket:str=None):
+    """
+    Keep an agent warm behind a Unix socket, then run tasks with the thin client:
+    python -m cmd_gpt.client "install htop"
+    """
+    config = load_config()
+    setup_logging(logger_level)
+    registry = setup_metrics(config)
+    from cmd_gpt.daemon import DEFAULT_SOCKET, run_daemon
+    backend = backend or config.get("TERMINAL_BACKEND")
+    agent_kwargs = {"cmd_confg": {"backend": backend}, "max_actions_per_step": max_actions_per_step}
+    try:
+        run_daemon(config, socket or config.get("DAEMON_SOCKET", DEFAULT_SOCKET), agent_kwargs, logger_level)
+    except KeyboardInterrupt:
+        pass
+    write_metrics(config, registry)
+
+def _trace_store(config):
+    from cmd_gpt.agent.trace import TraceStore
+    store = TraceStore.from_config(config)
+    if store is None:
+        sys.exit("Tracing is off, set TRACE_DB in config/key.yaml to record runs")
+    return store
+
+def traces_query(task:str=None, action:str=None, command:str=None, output:str=None, min_seconds:float=None, max_seconds:float=None,
+                 slow_step:float=None, status:str=None, days:float=None, limit:int=20):
+    """
+    Find recorded runs, newest first, e.g. every run where apt-get sat for over a minute:
+    python run.py traces query --command="apt-get" --slow_step=60
+    Text filters are phrases, "a|b" matches either.
+    """
+    from cmd_gpt.agent.trace import format_runs
+    store = _trace_store(load_config())
+    print(format_runs(store.query(task=task, action=action, command=command, output=output, min_seconds=min_seconds,
+                                  max_seconds=max_seconds, slow_step=slow_step, status=status, days=days, limit=limit)))
+    store.close()
+
+def traces_show(run_id: str):
+    from cmd_gpt.agent.trace import format_run
+    store = _trace_store(load_config())
+    run = store.get_run(str(run_id))
+    store.close()
+    if run is None:
+        sys.exit("No single run matches {}".format(run_id))
+    print(format_run(run))
+
+def traces_replay(run_id: str, logger_level:str="WARNING"):
+    """
+    Play a recorded run back through the agent against a simulated terminal and
+    compare the actions with the recorded ones.
+    """
+    from cmd_gpt.agent.trace import format_replay, replay_run
+    logger.remove()
+    logger.add(sys.stderr, level=logger_level)
+    store = _trace_store(load_config())
+    run = store.get_run(str(run_id))
+    store.close()
+    if run is None:
+        sys.exit("No single run matches {}".format(run_id))
+    result, rows = replay_run(run)
+    print(format_replay(result, rows))
+    if any(recorded != replayed for _, recorded, replayed in rows):
+        sys.exit(1)
+
+
+COMMANDS = {
+    "run": run,
+    "fanout": fanout,
+    "batch": batch,
+    "plan": plan,
+    "daemon": daemon,
+    "traces": {
+        "query": traces_query,
+        "show": traces_show,
+        "replay": traces_replay,
+    },
+}
 
 
 if __name__ == "__main__":
-    fire.Fire(run)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        fire.Fire(COMMANDS)
+    else: # python run.py "your prompt"
+        fire.Fire(run)
@@ -0,0 +1,82 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import errno
+import json
+import os
+import sys
+
+import pytest
+
+from cmd_gpt.tool.basic.ask import AskChannel
+
+
+@pytest.fixture
+def stdin_pipe(monkeypatch):
+    read_fd, write_fd = os.pipe()
+    monkeypatch.setattr(sys, "stdin", os.fdopen(read_fd))
+    yield write_fd
+    os.close(write_fd)
+    sys.stdin.close()
+
+
+def test_stdin_answers_questions_of_every_channel_in_order(stdin_pipe):
+    async def run():
+        first, second = AskChannel(), AskChannel()
+        a = asyncio.ensure_future(first.ask("A?"))
+        await asyncio.sleep(0.05)
+        b = asyncio.ensure_future(second.ask("B?"))
+        await asyncio.sleep(0.05)
+        os.write(stdin_pipe, b"first\nsecond\n")
+        return await asyncio.wait_for(asyncio.gather(a, b), 5)
+    assert asyncio.run(run()) == ["first", "second"]
+
+
+def test_shared_channel_answers_concurrent_askers_over_socket(tmp_path):
+    path = str(tmp_path / "ask.sock")
+
+    async def run():
+        channel = AskChannel(sources=["socket"], socket_path=path)
+        questions = [asyncio.ensure_future(channel.ask("host{}?".format(k))) for k in range(2)]
+        await asyncio.sleep(0.1)
+        reader, writer = await asyncio.open_unix_connection(path)
+        for _ in range(2):
+            message = json.loads(await reader.readline())
+            writer.write((json.dumps({"type": "answer", "id": message["id"], "text": message["question"].upper()}) + "\n").encode("utf-8"))
+        answers = await asyncio.wait_for(asyncio.gather(*questions), 5)
+        writer.close()
+        channel.close()
+        return answers
+    assert asyncio.run(run()) == ["HOST0?", "HOST1?"]
+
+
+def test_second_server_on_socket_in_use_fails(tmp_path):
+    path = str(tmp_path / "ask.sock")
+
+    async def run():
+        first, second = AskChannel(sources=["socket"], socket_path=path), AskChannel(sources=["socket"], socket_path=path)
+        question = asyncio.ensure_future(first.ask("A?"))
+        await asyncio.sleep(0.1)
+        try:
+            with pytest.raises(OSError) as error:
+                await asyncio.wait_for(second.ask("B?"), 5)
+            assert error.value.errno == errno.EADDRINUSE
+            assert os.path.exists(path)
+        finally:
+            question.cancel()
+            first.close()
+            second.close()
+    asyncio.run(run())
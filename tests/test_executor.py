@@ -0,0 +1,108 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+import pytest
+
+from cmd_gpt.tool.executor import ConfirmationPolicy, ToolExecutor
+
+
+class FakeTerminal:
+    def __init__(self, read_delay=0.0):
+        self.read_delay = read_delay
+        self.interrupts = 0
+
+    async def async_interrupt(self, key=None):
+        self.interrupts += 1
+        return "ctrl_c"
+
+    async def async_read_output(self, length=0, store_history=False):
+        await asyncio.sleep(self.read_delay)
+        return "partial output"
+
+
+async def hang(action, action_input):
+    await asyncio.sleep(10)
+
+
+@pytest.mark.parametrize("mode, action, command, expected", [
+    ("auto", "terminal_run", "rm -rf /tmp/x", False),
+    ("always", "terminal_run", "ls", True),
+    ("always", "terminal_read", "", False),
+    ("allowlist", "terminal_run", "ls -la /etc && cat /etc/hostname", False),
+    ("allowlist", "terminal_run", "cd /opt", False),
+    ("allowlist", "terminal_run", "rm -rf /tmp/x", True),
+    ("allowlist", "terminal_run", "/tmp/x/cat /etc/hostname", True),
+    ("allowlist", "terminal_run", "ls\nrm x", True),
+    ("allowlist", "terminal_run", "ls > /etc/motd", True),
+])
+def test_confirmation_policy(mode, action, command, expected):
+    assert ConfirmationPolicy(mode).needs_confirmation(action, command) is expected
+
+
+def test_confirmation_policy_extra_patterns():
+    policy = ConfirmationPolicy(patterns=[r"^make( |$)"])
+    assert not policy.needs_confirmation("terminal_run", "make test")
+    assert policy.needs_confirmation("terminal_run", "cmake .")
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        ConfirmationPolicy("never")
+
+
+def test_confirm_waits_the_delay_or_asks():
+    async def answer(text):
+        async def ask(question):
+            return text
+        return await ToolExecutor(hang, confirm="ask", ask=ask).confirm("terminal_run", "rm x")
+    assert asyncio.run(answer("")) is True
+    assert asyncio.run(answer("n")) is False
+    executor = ToolExecutor(hang, confirm_delay=0.05)
+    assert asyncio.run(executor.confirm("terminal_run", "rm x")) is True
+    assert asyncio.run(executor.confirm("terminal_run", "ls")) is True
+
+
+def test_deadline_on_other_actions():
+    executor = ToolExecutor(hang, timeouts={"probe": 0.1})
+    assert asyncio.run(executor.run("probe", "uname")) == "\n(timed out after 0.1 seconds)"
+    assert ToolExecutor(hang, timeouts={"ask": 0}).timeout("ask") is None
+
+
+def test_deadline_interrupts_terminal_action():
+    terminal = FakeTerminal()
+    executor = ToolExecutor(hang, cmd=terminal, default_timeout=0.1)
+    assert asyncio.run(executor.run("terminal_run", "sleep 100")) == "partial output\n(timed out after 0.1 seconds, sent ctrl_c)"
+    assert terminal.interrupts == 1
+
+
+def test_deadline_reports_command_still_running():
+    executor = ToolExecutor(hang, cmd=FakeTerminal(read_delay=10), default_timeout=0.1, interrupt_timeout=0.1)
+    assert asyncio.run(executor.run("terminal_run", "sleep 100")) == "\n(timed out after 0.1 seconds, sent ctrl_c, still running)"
+
+
+def test_cancelled_run_interrupts_terminal():
+    terminal = FakeTerminal()
+    executor = ToolExecutor(hang, cmd=terminal)
+
+    async def run():
+        task = asyncio.ensure_future(executor.run("terminal_run", "sleep 100"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(run())
+    assert terminal.interrupts == 1
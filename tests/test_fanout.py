@@ -0,0 +1,37 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+from cmd_gpt.agent.fanout import arun_fanout, load_hosts
+from cmd_gpt.llm.scripted import ScriptedLLM
+
+CONFIG = {"OPENAI_API_MODEL": "strong-model", "LLM_BACKEND": "http"}
+
+
+def test_load_hosts(tmp_path):
+    path = tmp_path / "hosts.txt"
+    path.write_text("web1\n# comment\n\nweb2\n")
+    assert load_hosts(str(path)) == ["web1", "web2"]
+    assert load_hosts("web1, web2") == ["web1", "web2"]
+
+
+def test_task_keeps_other_braces():
+    llm = ScriptedLLM([])
+    template = "sum column one with awk '{print $1}' on {host}"
+    results = asyncio.run(arun_fanout(CONFIG, ["web1", "web2"], template, agent_kwargs={"llm": llm, "cmd_confg": {"backend": "simulated"}}))
+    assert [(r.host, r.status) for r in results] == [("web1", "done"), ("web2", "done")]
+    for host in ["web1", "web2"]:
+        assert any("awk '{print $1}' on " + host in prompt for prompt in llm.prompts)
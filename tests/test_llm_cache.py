@@ -0,0 +1,78 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sqlite3
+import time
+
+from cmd_gpt.llm.cache import CacheMode, LLMResponseCache, make_cache_key
+from cmd_gpt.metrics import REGISTRY
+
+
+def counter(name):
+    return sum(REGISTRY.counter(name).values.values())
+
+
+def test_hit_and_miss(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite"), CacheMode.READ_WRITE)
+    hits, misses = counter("llm_cache_hits"), counter("llm_cache_misses")
+    key = make_cache_key("model", 0, "prompt")
+    assert cache.get(key) is None
+    cache.put(key, "response", "model")
+    assert cache.get(key) == "response"
+    assert (cache.hits, cache.misses, cache.writes) == (1, 1, 1)
+    assert counter("llm_cache_hits") == hits + 1 and counter("llm_cache_misses") == misses + 1
+    cache.close()
+
+
+def test_persists_across_connections_in_wal_mode(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    writer, reader = LLMResponseCache(path, CacheMode.RECORD_ONLY), LLMResponseCache(path, CacheMode.READ_ONLY)
+    writer.put("key", "response")
+    assert reader.get("key") == "response" # while the writer is still open
+    writer.close()
+    reader.close()
+    assert sqlite3.connect(path).execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert LLMResponseCache(path, CacheMode.READ_WRITE).get("key") == "response"
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite"), CacheMode.READ_WRITE, max_entries=2)
+    for key in ["a", "b"]:
+        cache.put(key, key)
+        time.sleep(0.01)
+    assert cache.get("a") == "a" # b is now the least recently used
+    time.sleep(0.01)
+    cache.put("c", "c")
+    assert [cache.get(key) for key in ["a", "b", "c"]] == ["a", None, "c"]
+    cache.close()
+
+
+def test_modes(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    LLMResponseCache(path, CacheMode.READ_WRITE).put("key", "response")
+    assert LLMResponseCache(path, CacheMode.RECORD_ONLY).get("key") is None
+    read_only = LLMResponseCache(path, CacheMode.READ_ONLY)
+    read_only.put("other", "response")
+    assert read_only.get("other") is None
+    off = LLMResponseCache(path, CacheMode.OFF)
+    assert off.get("key") is None
+
+
+def test_key_covers_model_parameters_and_prompt():
+    keys = {make_cache_key("a", 0, "p"), make_cache_key("b", 0, "p"), make_cache_key("a", 0.7, "p"), make_cache_key("a", 0, "q"),
+            make_cache_key("a", 0, "p", max_tokens=256), make_cache_key("a", 0, "p", max_tokens=512)}
+    assert len(keys) == 6
+    assert make_cache_key("a", 0, "p", max_tokens=1, stop="E:") == make_cache_key("a", 0, "p", stop="E:", max_tokens=1)
+    assert make_cache_key("a", 0, "p") == make_cache_key("a", 0, "p")
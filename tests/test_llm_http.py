@@ -0,0 +1,142 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+from cmd_gpt.llm.http import ClientPool, LLMHTTPError, OpenAIHTTPLLM, RateLimiter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmark"))
+from llm_stub_server import RESPONSE, StubLLMServer # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**kwargs):
+        server = StubLLMServer(**kwargs).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def make_llm(server, **kwargs):
+    return OpenAIHTTPLLM("stub", base_url=server.base_url, pool=ClientPool(server.base_url), **kwargs)
+
+
+def test_predict_and_stream_reuse_connections(stub):
+    server = stub(latency=0.0)
+    llm = make_llm(server)
+
+    async def run():
+        answers = [await llm.apredict("x") for _ in range(3)]
+        return answers, "".join([text async for text in llm.astream("x")])
+    answers, streamed = asyncio.run(run())
+    assert answers == [RESPONSE] * 3
+    assert streamed == RESPONSE
+    assert llm.pool.opened == 1
+
+
+def test_retries_429_after_retry_after(stub):
+    server = stub(latency=0.0, error_rate=1.0, error_statuses=[429], retry_after=0.2)
+    llm = make_llm(server, max_retries=2, backoff=0.001)
+    start = time.monotonic()
+    with pytest.raises(LLMHTTPError) as error:
+        asyncio.run(llm.apredict("x"))
+    assert error.value.status == 429
+    assert llm.retries == 2
+    assert server.stats["requests"] == 3
+    assert time.monotonic() - start >= 0.4
+
+
+def test_client_errors_are_not_retried(stub):
+    server = stub(latency=0.0, error_rate=1.0, error_statuses=[400])
+    llm = make_llm(server)
+    with pytest.raises(LLMHTTPError) as error:
+        asyncio.run(llm.apredict("x"))
+    assert error.value.status == 400 and not error.value.retryable
+    assert llm.retries == 0
+
+
+def test_timeouts_are_retried(stub):
+    server = stub(latency=0.0, slow_rate=1.0, slow_latency=1.0)
+    llm = make_llm(server, timeout=0.2, max_retries=1, backoff=0.001)
+    with pytest.raises(LLMHTTPError) as error:
+        asyncio.run(llm.apredict("x"))
+    assert error.value.status is None
+    assert llm.retries == 1
+
+
+def test_hedging_cuts_slow_calls(stub):
+    server = stub(latency=0.02, seed=3)
+    llm = make_llm(server, hedge_percentile=90, hedge_min_samples=5, timeout=10)
+
+    async def run():
+        for _ in range(5):
+            await llm.apredict("x")
+        server.slow_rate, server.slow_latency = 0.5, 3.0
+        server.rng.random = iter([0.0, 0.9, 0.9, 0.9] * 4).__next__ # slow first attempt, fast hedge
+        start = time.monotonic()
+        answer = await llm.apredict("x")
+        return answer, time.monotonic() - start
+    answer, elapsed = asyncio.run(run())
+    assert answer == RESPONSE
+    assert elapsed < 1.0
+    assert llm.hedges == 1 and llm.hedge_wins == 1
+
+
+def test_rate_limiter_spaces_calls(stub):
+    server = stub(latency=0.0)
+    llm = make_llm(server, rate_limiter=RateLimiter(600, burst_seconds=1)) # 10 a second, 10 at once
+
+    async def run():
+        await asyncio.gather(*[llm.apredict("x") for _ in range(20)])
+    start = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - start >= 0.9
+
+
+def test_stream_skips_malformed_events(stub, monkeypatch):
+    server = stub(latency=0.0, response="one two three")
+    import llm_stub_server
+    dumps = llm_stub_server.json.dumps
+
+    def corrupt(data, *args, **kwargs):
+        text = dumps(data, *args, **kwargs)
+        return "{not json" if " two" in text else text
+    monkeypatch.setattr(llm_stub_server.json, "dumps", corrupt)
+    llm = make_llm(server)
+
+    async def run():
+        return "".join([text async for text in llm.astream("x")])
+    assert asyncio.run(run()) == "one three"
+
+
+def test_sync_predict_reuses_one_loop_and_closes_its_client(stub):
+    server = stub(latency=0.0)
+    llm = make_llm(server)
+    assert [llm.predict("x") for _ in range(3)] == [RESPONSE] * 3
+    assert llm.pool.opened == 1
+    client = next(iter(llm.pool._clients.values()))
+    llm.close()
+    assert client.is_closed
+    assert llm.predict("x") == RESPONSE # a new client after close
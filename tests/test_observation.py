@@ -0,0 +1,72 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import random
+
+import pytest
+
+from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent
+from cmd_gpt.agent.observation import ObservationCompressor, clean_output, collapse_repeats
+from cmd_gpt.llm.scripted import ScriptedLLM
+from cmd_gpt.llm.tokens import count_tokens
+from cmd_gpt.tool.terminal.simulated import SimulatedTerminal
+
+
+def test_clean_output():
+    assert clean_output("\x1b[32mok\x1b[0m\r\n") == "ok\n"
+    assert clean_output("  10%\r  50%\r 100%\ndone") == " 100%\ndone"
+
+
+def test_collapse_repeats():
+    lines = ["Get:1 http://archive 12 kB", "Get:2 http://archive 40 kB", "Get:3 http://archive 7 kB", "Done", "Done"]
+    assert collapse_repeats(lines) == ["Get:3 http://archive 7 kB [x3 similar lines]", "Done [x2 similar lines]"]
+
+
+def test_small_output_is_only_cleaned():
+    assert ObservationCompressor(token_budget=100).compress("\x1b[1mhello\x1b[0m\nworld") == "hello\nworld"
+
+
+def test_keeps_head_tail_and_error_lines():
+    lines = ["unpacking package-{} version {}.{}".format(chr(97 + k % 26) * (k % 7 + 1), k, k * 7) for k in range(1000)]
+    lines[500] = "E: Unable to locate package nginx-extras"
+    compressor = ObservationCompressor(token_budget=400)
+    compressed = compressor.compress("\n".join(lines))
+    assert compressed.startswith(lines[0] + "\n")
+    assert compressed.endswith(lines[-1])
+    assert lines[500] in compressed
+    assert "lines omitted)" in compressed
+    assert count_tokens(compressed) <= 400
+
+
+@pytest.mark.parametrize("text", [
+    "x" * 100000,
+    "\n".join("".join(random.Random(k).choice("{}[]();:'\"!@#$%^&*") for _ in range(3000)) for k in range(5)),
+])
+def test_very_long_lines_fit_the_budget(text):
+    compressed = ObservationCompressor(token_budget=200).compress(text)
+    assert count_tokens(compressed) <= 200
+    assert "...(truncated)..." in compressed
+
+
+def test_requested_lines_are_not_compressed():
+    agent = DeploymentCmdAgent({"LLM_BACKEND": "http"}, llm=ScriptedLLM([]), cmd=SimulatedTerminal(), observation_token_budget=10)
+    try:
+        lines = "\n".join("{}: line {}".format(k, k) for k in range(100))
+        assert agent.compress_observation(lines, "terminal_search", "line") == lines
+        assert agent.compress_observation(lines, "terminal_read", "1-100") == lines
+        assert agent.compress_observation(lines, "terminal_read", "") != lines
+        assert agent.compress_observation(lines, "terminal_run", "seq 100") != lines
+    finally:
+        agent.close()
@@ -0,0 +1,103 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+from cmd_gpt.agent.planner import Subtask, arun_plan, parse_plan
+from cmd_gpt.llm.scripted import ScriptedLLM
+
+CONFIG = {"OPENAI_API_MODEL": "strong-model", "LLM_BACKEND": "http", "ROUTER_FAST_MODEL": "fast-model"}
+
+
+class FakeAgent:
+    def __init__(self, subtask, log, status="done", seconds=0.2):
+        self.subtask = subtask
+        self.log = log
+        self.status = status
+        self.seconds = seconds
+
+    async def arun(self, task):
+        self.log.append(("start", self.subtask.id, time.monotonic()))
+        await asyncio.sleep(self.seconds)
+        self.log.append(("end", self.subtask.id, time.monotonic()))
+        return SimpleNamespace(status=self.status, steps=1, last_observation="")
+
+    def close(self):
+        pass
+
+
+def run_plan(subtasks, failing=(), concurrency=4):
+    log, kwargs = [], []
+
+    async def make_agent(config, subtask, agent_kwargs):
+        kwargs.append(agent_kwargs)
+        return FakeAgent(subtask, log, "error" if subtask.id in failing else "done")
+    result = asyncio.run(arun_plan(CONFIG, "task", concurrency=concurrency, agent_kwargs={"ask_channel": None}, subtasks=subtasks, make_agent=make_agent))
+    return result, log, kwargs
+
+
+def times(log, event):
+    return {subtask_id: t for e, subtask_id, t in log if e == event}
+
+
+def test_parse_plan():
+    subtasks = parse_plan("1: Install postgres\n2: Install nginx\n3: Create the database (after: 1, 9)\n", "task")
+    assert [(s.id, s.after) for s in subtasks] == [("1", []), ("2", []), ("3", ["1"])]
+    assert [s.task for s in parse_plan("no plan here", "the task")] == ["the task"]
+
+
+def test_independent_subtasks_run_concurrently_and_dependents_wait():
+    subtasks = [Subtask(id="1", task="a"), Subtask(id="2", task="b"), Subtask(id="3", task="c", after=["1", "2"])]
+    result, log, _ = run_plan(subtasks)
+    starts, ends = times(log, "start"), times(log, "end")
+    assert result.status == "done"
+    assert starts["2"] < ends["1"] and starts["1"] < ends["2"]
+    assert starts["3"] >= max(ends["1"], ends["2"])
+    assert result.elapsed < 0.6 # two rounds of 0.2s, not three
+
+
+def test_dependents_of_a_failed_subtask_are_skipped():
+    subtasks = [Subtask(id="1", task="a"), Subtask(id="2", task="b", after=["1"]), Subtask(id="3", task="c", after=["2"]), Subtask(id="4", task="d")]
+    result, log, _ = run_plan(subtasks, failing=["1"])
+    assert [r.status for r in result.subtasks] == ["error", "skipped", "skipped", "done"]
+    assert set(times(log, "start")) == {"1", "4"}
+    assert result.status == "incomplete"
+
+
+def test_concurrency_limit():
+    subtasks = [Subtask(id=str(k), task="t") for k in range(4)]
+    result, log, _ = run_plan(subtasks, concurrency=2)
+    running, most = 0, 0
+    for event, _, _ in sorted(log, key=lambda e: e[2]):
+        running += 1 if event == "start" else -1
+        most = max(most, running)
+    assert most == 2
+
+
+def test_subtasks_share_llm_and_router():
+    _, _, kwargs = run_plan([Subtask(id="1", task="a"), Subtask(id="2", task="b")])
+    assert kwargs[0]["llm"] is kwargs[1]["llm"]
+    assert kwargs[0]["router"] is not None and kwargs[0]["router"] is kwargs[1]["router"]
+
+
+def test_plan_is_asked_from_the_llm():
+    llm = ScriptedLLM(["1: Install postgres\n2: Install nginx\n"])
+
+    async def make_agent(config, subtask, agent_kwargs):
+        return FakeAgent(subtask, [], seconds=0)
+    result = asyncio.run(arun_plan(CONFIG, "task", agent_kwargs={"llm": llm, "ask_channel": None}, make_agent=make_agent))
+    assert [r.task for r in result.subtasks] == ["Install postgres", "Install nginx"]
@@ -0,0 +1,105 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from cmd_gpt.compat import model_dump_json
+from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent
+from cmd_gpt.agent.playbook import Playbook, PlaybookStore, make_playbook
+from cmd_gpt.llm.scripted import ScriptedLLM
+from cmd_gpt.tool.terminal.simulated import SimulatedTerminal
+
+PROMPT = "ubuntu@sim:~$ "
+
+INSTALL_TRACE = [
+    ("terminal_run", "sudo apt install nginx", "[sudo] password for ubuntu: "),
+    ("ask", "What is the sudo password for ubuntu?", "hunter2"),
+    ("terminal_run", "hunter2", "Setting up nginx-core ...\n" + PROMPT),
+    ("terminal_run", "nginx -v", "nginx version: nginx/1.18.0\n" + PROMPT),
+]
+
+
+def test_make_playbook_parameterizes_task_words():
+    playbook = make_playbook("Make sure nginx is installed on this machine", INSTALL_TRACE)
+    assert playbook.task_template == "Make sure {p0} is installed on this machine"
+    assert [s.action_input for s in playbook.steps] == ["sudo apt install {p0}", "What is the sudo password for ubuntu?", "{ask0}", "{p0} -v"]
+    assert [s.expect_kind for s in playbook.steps] == ["question", "any", "prompt", "prompt"]
+    assert playbook.steps[0].expect_line == "[sudo] password for ubuntu:"
+    assert "hunter2" not in model_dump_json(playbook)
+
+
+def test_match_and_render():
+    playbook = make_playbook("Make sure nginx is installed on this machine", INSTALL_TRACE)
+    params = playbook.match("make sure  redis is installed on this machine")
+    assert params == {"p0": "redis"}
+    assert playbook.render(playbook.steps[0].action_input, params, {}) == "sudo apt install redis"
+    assert playbook.match("Make sure redis is running on this machine") is None
+
+
+def test_task_with_braces_matches_its_playbook():
+    task = "Count the users with awk '{print $1}' in /etc/passwd"
+    playbook = make_playbook(task, [("terminal_run", "awk -F: '{print $1}' /etc/passwd | wc -l", "31\n" + PROMPT)])
+    assert "{" in playbook.task_template and "}}" in playbook.task_template
+    params = playbook.match(task)
+    assert params is not None and "/etc/passwd" in params.values()
+    assert playbook.render(playbook.steps[0].action_input, params, {}) == "awk -F: '{print $1}' /etc/passwd | wc -l"
+    literal = Playbook(task_template="echo {{p0}} and {p0}")
+    assert literal.match("echo {p0} and x") == {"p0": "x"}
+
+
+def test_store_finds_most_specific_playbook(tmp_path):
+    store = PlaybookStore(str(tmp_path))
+    store.save(Playbook(task_template="Make sure {p0} is installed on this machine", params=["p0"], created=1))
+    store.save(Playbook(task_template="Make sure {p0} is installed on this machine with apt", params=["p0"], created=2))
+    store.save(Playbook(task_template="{p0} {p1}", params=["p0", "p1"], created=3)) # too few literal words
+    playbook, params = store.find("Make sure nginx is installed on this machine with apt")
+    assert playbook.task_template.endswith("with apt") and params == {"p0": "nginx"}
+    assert store.find("Something else entirely") == (None, None)
+
+
+def simulated_terminal():
+    return SimulatedTerminal(prompt=PROMPT, default_latency=0.0, commands=[
+        {"match": "apt install", "questions": [{"question": "[sudo] password for ubuntu: ", "output": "Setting up ..."}]},
+        {"match": r"-v$", "output": "version 1.0"},
+    ])
+
+
+def make_agent(tmp_path, llm, terminal, answer):
+    async def ask(question):
+        return answer
+    return DeploymentCmdAgent({"LLM_BACKEND": "http", "PLAYBOOK_DIR": str(tmp_path)}, llm=llm, cmd=terminal, action_delay=0,
+                              action_mapping={"terminal_run": terminal.async_run_command_and_get_reply, "terminal_read": terminal.async_read_output, "ask": ask})
+
+
+def test_recorded_run_is_replayed_without_the_llm(tmp_path):
+    llm = ScriptedLLM([
+        "A: check\nP: install -> end\nE: terminal_run[sudo apt install nginx]\n",
+        "A: password\nP: ask -> end\nE: ask[What is the sudo password for ubuntu?]\n",
+        "A: answer\nP: type it -> end\nE: terminal_run[hunter2]\n",
+        "A: verify\nP: check -> end\nE: terminal_run[nginx -v]\n",
+        "A: done\nP: end\nE: end\n",
+    ])
+    agent = make_agent(tmp_path, llm, simulated_terminal(), "hunter2")
+    try:
+        assert agent.run("Make sure nginx is installed on this machine").status == "done"
+    finally:
+        agent.close()
+
+    terminal, llm = simulated_terminal(), ScriptedLLM([])
+    agent = make_agent(tmp_path, llm, terminal, "s3cret")
+    try:
+        result = agent.run("Make sure redis is installed on this machine")
+    finally:
+        agent.close()
+    assert result.replayed_steps == 4
+    assert terminal.history[:3] == ["sudo apt install redis", "s3cret", "redis -v"]
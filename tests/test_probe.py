@@ -0,0 +1,55 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+from cmd_gpt.tool.basic.probe import check_probe_command
+
+
+@pytest.mark.parametrize("command", [
+    "uname -a",
+    "cat /etc/os-release | head -n 5",
+    "ls /opt 2>/dev/null && df -h",
+    "sort -k2 -n /etc/passwd",
+    "grep -r foo /etc 2>&1 | wc -l",
+])
+def test_allowed(command):
+    assert check_probe_command(command) is None
+
+
+@pytest.mark.parametrize("command", [
+    "rm -rf /tmp/x",
+    "cat $(which ls)",
+    "echo `id`",
+    "ls > /tmp/out",
+    "ls 2>/dev/nullx",
+    "sleep 100 &",
+    "sort -o /etc/passwd /etc/passwd",
+    "sort --out=x y",
+    "sort --compress-program=sh y",
+    "sort --compress=sh y",
+    "sort -T/tmp y",
+    "sort --temporary-directory /tmp y",
+    "find / -delete",
+    "systemctl restart sshd",
+    "/tmp/evil/cat x",
+    "./ls",
+    "ls | ../bin/wc -l",
+    "find . -fprint0 /tmp/o",
+    "ls\nrm x",
+    "ls\rrm x",
+])
+def test_refused(command):
+    assert check_probe_command(command) is not None
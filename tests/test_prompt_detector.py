@@ -0,0 +1,35 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+from cmd_gpt.tool.terminal.prompt_detector import MAX_LEARNED_PROMPTS, PromptDetector
+
+
+@pytest.mark.parametrize("line", ["Enter name:", "Continue?", "Overwrite (y/N)", "Proceed [yes/no] (yes/no)"])
+def test_learn_rejects_questions(line):
+    detector = PromptDetector()
+    assert not detector.learn(line)
+    assert detector.learned_prompts == []
+
+
+def test_learn_dedupes_and_caps():
+    detector = PromptDetector()
+    assert detector.learn("mybox %%")
+    assert not detector.learn("mybox %%")
+    for k in range(MAX_LEARNED_PROMPTS * 2):
+        detector.learn("box{} %%".format(k))
+    assert len(detector.learned_prompts) == MAX_LEARNED_PROMPTS
+    assert detector.is_prompt("mybox %%")
@@ -0,0 +1,77 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import time
+
+import pytest
+
+from cmd_gpt.tool.terminal.pty_terminal import PtyInteraction
+
+
+@pytest.fixture
+def shell():
+    terminal = PtyInteraction(quiet_period=0.1, command_timeout=10, prompt_learn_period=0.5, spool=False)
+    yield terminal
+    terminal.close()
+
+
+def test_command_completes_on_prompt(shell):
+    start = time.monotonic()
+    reply = shell.run_command_and_get_reply("echo hello")
+    assert "hello" in reply
+    assert time.monotonic() - start < 5
+
+
+def test_completion_waits_for_output_not_a_fixed_sleep(shell):
+    start = time.monotonic()
+    reply = shell.run_command_and_get_reply("sleep 0.5; echo done")
+    elapsed = time.monotonic() - start
+    assert "done" in reply
+    # the prompt after the output plus one quiet period, no fixed delay on top
+    assert 0.5 <= elapsed < 0.5 + shell.quiet_period + 0.5
+
+
+def test_quiet_output_without_prompt_keeps_waiting(shell):
+    reply = shell.run_command_and_get_reply("echo first; sleep 0.6; echo second")
+    assert "first" in reply and "second" in reply
+
+
+def test_output_after_prompt_resets_quiet_period(shell):
+    shell.quiet_period = 0.5
+    # a prompt-like line followed by more output within the quiet period is not the end
+    reply = shell.run_command_and_get_reply("echo 'user@host:~$ '; sleep 0.2; echo after")
+    assert "after" in reply
+
+
+def test_question_is_not_learned_as_prompt(shell):
+    shell.command_timeout = 2
+    shell.run_command_and_get_reply('read -p "Enter name: " name')
+    assert shell.prompt_detector.learned_prompts == []
+    shell.run_command("")
+    shell.wait_for_completion(require_change=True)
+
+
+def test_close_kills_shell_ignoring_hangup():
+    terminal = PtyInteraction(shell=["/bin/bash", "--noprofile", "--norc"], quiet_period=0.1, command_timeout=5, spool=False)
+    terminal.run_command("trap '' HUP; exit() { :; }")
+    terminal.wait_for_completion()
+    pid = terminal.pid
+    start = time.monotonic()
+    terminal.close(timeout=0.5)
+    assert time.monotonic() - start < 3
+    with pytest.raises(ChildProcessError):
+        os.waitpid(pid, os.WNOHANG)
+    terminal.close() # a second close does nothing
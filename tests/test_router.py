@@ -0,0 +1,52 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent, add_shared_models
+from cmd_gpt.llm.router import FAST, STRONG, ModelRouter
+from cmd_gpt.llm.scripted import ScriptedLLM
+from cmd_gpt.tool.terminal.simulated import SimulatedTerminal
+
+CONFIG = {"OPENAI_API_MODEL": "strong-model", "LLM_BACKEND": "http", "EXAMPLE_DB": ":memory:", "TRACE_DB": "off"}
+
+
+def test_shared_models_include_the_router():
+    agent_kwargs = add_shared_models(dict(CONFIG, ROUTER_FAST_MODEL="fast-model"), {})
+    assert agent_kwargs["llm"].model_name == "strong-model"
+    assert agent_kwargs["router"].llms[FAST].model_name == "fast-model"
+    assert agent_kwargs["router"].llms[STRONG].model_name == "strong-model"
+    assert add_shared_models(CONFIG, {})["router"] is None
+
+
+def test_given_llm_is_kept_without_router():
+    llm = ScriptedLLM([])
+    agent_kwargs = add_shared_models(dict(CONFIG, ROUTER_FAST_MODEL="fast-model"), {"llm": llm})
+    assert agent_kwargs == {"llm": llm}
+
+
+def test_agents_route_on_their_own_fork():
+    llm = ScriptedLLM([])
+    router = ModelRouter({FAST: llm.fork("fast"), STRONG: llm}, strong_first_steps=1)
+    agents = [DeploymentCmdAgent(CONFIG, llm=llm, router=router, cmd=SimulatedTerminal(), action_mapping={"ask": None}) for _ in range(2)]
+    try:
+        assert agents[0].router is not agents[1].router
+        assert agents[0].router.llms is router.llms
+        assert agents[0].router.route(0).tier == STRONG
+        # the first agent's escalation is sticky for it alone
+        assert agents[1].router.route(1).tier == FAST
+        assert agents[0].router.route(1).tier == STRONG
+        assert len(agents[1].router.decisions) == 1 and len(router.decisions) == 0
+    finally:
+        for agent in agents:
+            agent.close()
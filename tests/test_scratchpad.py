@@ -0,0 +1,75 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+from cmd_gpt.agent.scratchpad import Scratchpad
+from cmd_gpt.llm import tokens
+from cmd_gpt.llm.tokens import count_tokens
+
+
+def add_round(pad, k, observation="ok"):
+    pad.add_observation("terminal_run", "{} {}".format(observation, k))
+    pad.set_response("A: step {}".format(k), "P: next", "E: terminal_run[cmd{}]".format(k))
+
+
+def test_newest_rounds_verbatim_and_older_summarized():
+    pad = Scratchpad(max_verbatim_rounds=2, token_budget=10000)
+    for k in range(4):
+        add_round(pad, k)
+    text = pad.render()
+    assert text.startswith("(Earlier: 2 rounds compacted; last actions: terminal_run[cmd0] -> terminal_run[cmd1])\n")
+    assert "ok 2" in text and "ok 3" in text and "ok 1" not in text
+    assert pad.transcript() is not None
+
+
+def test_ring_buffer_keeps_evicted_actions_in_summary():
+    pad = Scratchpad(max_verbatim_rounds=1, token_budget=10000, max_rounds=3, max_summary_actions=2)
+    for k in range(6):
+        add_round(pad, k)
+    assert len(pad.rounds) == 3 and len(pad) == 6
+    assert pad.transcript() is None # evicted rounds cannot be shown in full
+    assert pad.render().startswith("(Earlier: 5 rounds compacted; last actions: terminal_run[cmd3] -> terminal_run[cmd4])\n")
+
+
+def test_trims_to_token_budget_but_keeps_newest_round():
+    pad = Scratchpad(max_verbatim_rounds=10, token_budget=60)
+    for k in range(3):
+        add_round(pad, k, observation="word " * 30)
+    text = pad.render()
+    assert text.startswith("(Earlier: 2 rounds compacted")
+    assert "cmd2" in text
+    big = Scratchpad(token_budget=1)
+    add_round(big, 0, observation="word " * 30)
+    assert "cmd0" in big.render() # the newest round is shown even over the budget
+
+
+def test_pending_round_is_rendered():
+    pad = Scratchpad()
+    add_round(pad, 0)
+    pad.add_observation("terminal_run", "waiting")
+    assert pad.render().endswith("M: terminal_run: waiting\n")
+    assert pad.last_observation() == "waiting"
+
+
+def test_token_count_falls_back_to_characters(monkeypatch):
+    monkeypatch.setattr(tokens, "_encodings", {"gpt-3.5-turbo": None})
+    assert count_tokens("x" * 40) == 11
+    assert count_tokens("") == 0
+
+
+def test_token_count_with_tiktoken():
+    pytest.importorskip("tiktoken")
+    assert count_tokens("hello world") == 2
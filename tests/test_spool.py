@@ -0,0 +1,113 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+from cmd_gpt.tool.terminal.spool import OutputSpool, SpoolTools, parse_line_range
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = OutputSpool(str(tmp_path))
+    yield spool
+    spool.close()
+
+
+def test_read_and_search_through_mmap(spool):
+    spool.write_lines(["line {}".format(k) for k in range(100)])
+    assert len(spool) == 100
+    assert spool.read(10, 13) == ["line 10", "line 11", "line 12"]
+    assert spool.read(98, 500) == ["line 98", "line 99"]
+    assert spool.read(-5, 1) == ["line 0"]
+    assert spool.read(50, 50) == []
+    assert spool.search(r"line 1\d$") == ([10, 11, 12, 13, 14, 15, 16, 17, 18, 19], 10)
+    assert spool.search("LINE 9", 0, 95, max_matches=2) == ([9, 90], 6)
+    assert spool.search("line", 200) == ([], 0)
+
+    spool.write_lines(["ünïcode (", "after"]) # the map grows with the file
+    assert spool.read(100, 102) == ["ünïcode (", "after"]
+    assert spool.search("(") == ([100], 1) # not a valid regex, searched as text
+    assert spool.search("^after$") == ([101], 1)
+
+
+def test_empty_spool(spool):
+    assert spool.read(0, 10) == []
+    assert spool.search("x") == ([], 0)
+
+
+def test_close_removes_the_file(tmp_path):
+    spool = OutputSpool(str(tmp_path))
+    spool.write_lines(["a"])
+    spool.read(0, 1)
+    spool.close()
+    assert not os.path.exists(spool.path)
+    spool.close()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("120-160", (120, 160)),
+    ("120:160", (120, 160)),
+    (" 120 .. 160 ", (120, 160)),
+    ("120-", (120, sys.maxsize)),
+    ("0-5", (0, 5)),
+    ("160-120", (160, 120)),
+    ("120", None),
+    ("-5", None),
+    ("a-b", None),
+    ("1-2-3", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_line_range(text, expected):
+    assert parse_line_range(text) == expected
+
+
+class SpoolingTerminal:
+    def __init__(self, spool):
+        self.spool = spool
+
+    async def async_read_output(self, action_input):
+        return "screen " + str(action_input)
+
+
+def test_read_ranges(spool):
+    tools = SpoolTools(SpoolingTerminal(spool), max_read_lines=5)
+    assert tools.read_range(1, 10) == "\nNothing has been spooled yet."
+    spool.write_lines(["line {}".format(k) for k in range(1, 21)])
+    assert asyncio.run(tools.read("2-3")) == "\nLines 2-3 of 20:\n2: line 2\n3: line 3"
+    assert asyncio.run(tools.read("18-")) == "\nLines 18-20 of 20:\n18: line 18\n19: line 19\n20: line 20"
+    assert asyncio.run(tools.read("0-1")) == "\nLines 1-1 of 20:\n1: line 1"
+    assert asyncio.run(tools.read("1-100")).startswith("\nLines 1-5 of 20:") # capped at max_read_lines
+    assert asyncio.run(tools.read("30-40")) == "\nThe output has 20 lines."
+    assert asyncio.run(tools.read("5-2")) == "\nThe output has 20 lines."
+    assert asyncio.run(tools.read("12")) == "screen 12" # not a range, the screen
+
+
+def test_search_prefers_the_last_command(spool):
+    tools = SpoolTools(SpoolingTerminal(spool), context_lines=1)
+    spool.begin_command("make")
+    spool.write_lines(["$ make", "error: old", "ok"])
+    spool.begin_command("make test")
+    spool.write_lines(["$ make test", "pass", "error: new", "pass"])
+    text = tools.search_text("error")
+    assert text.startswith("\n1 line matches 'error' in the output of `make test` (lines 5-7):")
+    assert "6: error: new" in text and "old" not in text
+    assert "in the session" in tools.search_text("error: old")
+    assert "No line matches 'missing'" in tools.search_text("missing")
+    assert tools.search_text("  ") == "\nNo pattern. Usage: terminal_search[pattern]"
@@ -0,0 +1,102 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+import pytest
+
+from cmd_gpt.agent.deployment_cmd_agent import processing_output_multi
+from cmd_gpt.llm.backend import LLMBackend
+from cmd_gpt.llm.streaming import ActionStreamParser, astream_until_action
+
+RESPONSE = "A: nginx is not installed\nP: install -> check\nE: terminal_run[sudo apt install -y nginx]\nE: terminal_run[nginx -v]\nM: made up\nE: end\n"
+
+
+def feed(parser, chunks):
+    for k, chunk in enumerate(chunks):
+        if parser.feed(chunk):
+            return k
+    return None
+
+
+class StreamingLLM(LLMBackend):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sent = 0
+        self.closed = False
+
+    async def astream(self, prompt):
+        try:
+            for chunk in self.chunks:
+                self.sent += 1
+                yield chunk
+        finally:
+            self.closed = True
+
+
+def test_stops_at_first_complete_action():
+    parser = ActionStreamParser()
+    assert feed(parser, [RESPONSE[:60], RESPONSE[60:]]) == 1
+    assert parser.finish() == "A: nginx is not installed\nP: install -> check\nE: terminal_run[sudo apt install -y nginx]\n"
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_split_chunks(size):
+    parser = ActionStreamParser()
+    feed(parser, [RESPONSE[k:k + size] for k in range(0, len(RESPONSE), size)])
+    assert parser.finish().endswith("E: terminal_run[sudo apt install -y nginx]\n")
+
+
+def test_action_line_needs_its_newline():
+    parser = ActionStreamParser()
+    assert not parser.feed("A: a\nP: b\nE: terminal_run[ls")
+    assert parser.finish() == "A: a\nP: b\nE: terminal_run[ls" # the stream ended without one
+
+
+def test_multi_action_waits_for_the_end_of_the_block():
+    parser = ActionStreamParser(multi_action=True)
+    assert not parser.feed(RESPONSE[:RESPONSE.index("M:")])
+    assert parser.feed("M: made up\n")
+    assert parser.finish() == RESPONSE[:RESPONSE.index("M:")]
+
+
+def test_stream_is_closed_after_the_action():
+    chunks = [line + "\n" for line in RESPONSE.split("\n")[:-1]]
+    llm = StreamingLLM(chunks)
+    assert asyncio.run(astream_until_action(llm, "prompt")).endswith("nginx]\n")
+    assert llm.sent == 3 and llm.closed
+
+
+def test_several_actions_per_round():
+    _, actions, done = processing_output_multi(RESPONSE, max_actions=5)
+    assert actions == [("terminal_run", "sudo apt install -y nginx"), ("terminal_run", "nginx -v")]
+    assert not done
+
+
+def test_max_actions_per_step():
+    text, actions, done = processing_output_multi(RESPONSE, max_actions=1)
+    assert actions == [("terminal_run", "sudo apt install -y nginx")]
+    assert "nginx -v" not in text and not done
+
+
+def test_actions_before_end_still_run():
+    _, actions, done = processing_output_multi("A: a\nP: b\nE: terminal_run[ls]\nE: end\n", max_actions=3)
+    assert actions == [("terminal_run", "ls")] and done
+
+
+@pytest.mark.parametrize("text", ["A: done\nP: end\nE: terminal_run[ls]\n", "A: nothing to do\n", "A: a\nP: b\nE: exit\n"])
+def test_done(text):
+    _, actions, done = processing_output_multi(text, max_actions=3)
+    assert done and actions == []
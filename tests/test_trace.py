@@ -0,0 +1,114 @@
+# Copyright (c) 2023 Jieyu Lin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+from cmd_gpt.agent.deployment_cmd_agent import DeploymentCmdAgent, StepMetrics
+from cmd_gpt.agent.trace import TraceStore, replay_run, trace_to_scenario
+from cmd_gpt.llm.scripted import ScriptedLLM
+from cmd_gpt.tool.terminal.simulated import SimulatedTerminal
+from cmd_gpt.tool.terminal.spool import SpoolTools
+
+PROMPT = "ubuntu@sim:~$ "
+
+
+def record(store, task, commands, status="done", tool_seconds=0.0, elapsed=1.0):
+    run_id = store.start_run(task, PROMPT)
+    for k, (command, output) in enumerate(commands):
+        store.add_step(run_id, k, "hash", "fast", "E: terminal_run[{}]".format(command), [("terminal_run", command)])
+        store.finish_step(run_id, k, [output + "\n" + PROMPT], StepMetrics(step=k, tool_seconds=tool_seconds))
+    store.finish_run(run_id, status)
+    store._conn.execute("UPDATE runs SET elapsed = ? WHERE id = ?", (elapsed, run_id))
+    return run_id
+
+
+def ids(runs):
+    return {r["id"] for r in runs}
+
+
+def test_query_filters():
+    store = TraceStore(":memory:")
+    nginx = record(store, "Install nginx", [("sudo apt install nginx", "E: Unable to locate package nginx")], status="max_steps", tool_seconds=5.0, elapsed=30.0)
+    disk = record(store, "Check the disk usage", [("df -h", "/dev/sda1 40G 12G")], elapsed=2.0)
+    old = record(store, "Install redis", [("sudo apt install redis", "Setting up redis")])
+    store._conn.execute("UPDATE runs SET started = ? WHERE id = ?", (time.time() - 10 * 86400, old))
+
+    assert ids(store.query()) == {nginx, disk, old}
+    assert ids(store.query(task="install")) == {nginx, old}
+    assert ids(store.query(task="disk usage|redis")) == {disk, old}
+    assert ids(store.query(action="terminal_run")) == {nginx, disk, old}
+    assert ids(store.query(action="ask")) == set()
+    assert ids(store.query(command="apt install")) == {nginx, old}
+    assert ids(store.query(output="unable to locate")) == {nginx}
+    assert ids(store.query(command="df", output="unable to locate")) == set() # both on the same action
+    assert ids(store.query(min_seconds=10)) == {nginx}
+    assert ids(store.query(max_seconds=10)) == {disk, old}
+    assert ids(store.query(slow_step=1.0)) == {nginx}
+    assert ids(store.query(output="unable", slow_step=10.0)) == set()
+    assert ids(store.query(status="done")) == {disk, old}
+    assert ids(store.query(days=1)) == {nginx, disk}
+    assert len(store.query(limit=1)) == 1
+    store.close()
+
+
+def test_prune_drops_old_runs(tmp_path):
+    path = str(tmp_path / "traces.sqlite")
+    store = TraceStore(path)
+    old = record(store, "Install redis", [("sudo apt install redis", "Setting up redis")])
+    new = record(store, "Install nginx", [("sudo apt install nginx", "Setting up nginx")])
+    store._conn.execute("UPDATE runs SET started = ? WHERE id = ?", (time.time() - 100 * 86400, old))
+    store.close()
+
+    store = TraceStore(path, retention_days=90)
+    assert ids(store.query()) == {new}
+    assert store.get_run(old) is None
+    assert ids(store.query(command="redis")) == set()
+    assert store._conn.execute("SELECT COUNT(*) FROM actions").fetchone()[0] == 1
+    store.close()
+
+
+def make_agent(config, responses, terminal):
+    return DeploymentCmdAgent(config, llm=ScriptedLLM(responses), cmd=terminal, action_delay=0, max_steps=5,
+                              action_mapping={"terminal_run": terminal.async_run_command_and_get_reply, "terminal_read": SpoolTools(terminal).read})
+
+
+def test_agent_run_is_recorded_and_replays(tmp_path):
+    path = str(tmp_path / "traces.sqlite")
+    terminal = SimulatedTerminal(prompt=PROMPT, default_latency=0.0, commands=[{"match": r"^df -h$", "output": "/dev/sda1 40G 12G 28G 30% /"}])
+    responses = [
+        "A: check\nP: look at the disks -> end\nE: terminal_run[df -h]\n",
+        "A: 30% used\nP: end\nE: end\n",
+    ]
+    agent = make_agent({"EXAMPLE_DB": ":memory:", "TRACE_DB": path}, responses, terminal)
+    try:
+        result = agent.run("Check the disk usage")
+    finally:
+        agent.close()
+
+    store = TraceStore(path)
+    run = store.get_run(result.run_id[:15])
+    store.close()
+    assert run["task"] == "Check the disk usage" and run["status"] == "done"
+    assert [a["input"] for a in run["steps"][0]["actions"]] == ["df -h"]
+    assert "30% /" in run["steps"][0]["actions"][0]["observation"]
+    assert run["steps"][0]["output"].startswith("A: check")
+
+    scenario = trace_to_scenario(run)
+    assert scenario["responses"] == [s["output"] for s in run["steps"]]
+    assert scenario["terminal"]["commands"][0]["match"] == r"^df\ \-h$"
+
+    replayed, rows = replay_run(run)
+    assert replayed.status == "done"
+    assert rows == [(0, ("terminal_run", "df -h"), ("terminal_run", "df -h"))]